@@ -0,0 +1,5 @@
+import os
+import sys
+
+# (so that `from utils.X import ...` works when running `pytest` from anywhere)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,206 @@
+import random
+
+import numpy as np
+import pytest
+import torch as t
+from tokenizers import Tokenizer, decoders, models, pre_tokenizers, processors, trainers
+from transformers import PreTrainedTokenizerFast
+
+from utils.IOI_dataset import (
+    NAMES, PLACES, OBJECTS, BABA_TEMPLATES, ABC_TEMPLATES, BAC_TEMPLATES,
+    FlipPlan, IOIDataset, IOIPromptStream, get_idx_dict, tokenize_prompts,
+)
+
+
+@pytest.fixture(scope="module")
+def tokenizer() -> PreTrainedTokenizerFast:
+    # A byte-level BPE tokenizer (like GPT-2's) trained on the IOI templates and words, so that the tests don't need to
+    # download one. Every name is a single token, and BOS = EOS = padding (token 1, so that it isn't token 0), like GPT-2.
+    corpus = BABA_TEMPLATES + ABC_TEMPLATES + BAC_TEMPLATES + [" " + " ".join(words) for words in [NAMES, PLACES, OBJECTS]]
+    tokenizer = Tokenizer(models.BPE())
+    tokenizer.pre_tokenizer = pre_tokenizers.ByteLevel(add_prefix_space=False)
+    tokenizer.decoder = decoders.ByteLevel()
+    trainer = trainers.BpeTrainer(vocab_size=4000, special_tokens=["<|unused|>", "<|endoftext|>"], initial_alphabet=pre_tokenizers.ByteLevel.alphabet())
+    tokenizer.train_from_iterator(corpus, trainer)
+    tokenizer.post_processor = processors.ByteLevel(trim_offsets=True)
+    return PreTrainedTokenizerFast(tokenizer_object=tokenizer, bos_token="<|endoftext|>", eos_token="<|endoftext|>", pad_token="<|endoftext|>")
+
+
+def get_idx_dict_per_prompt(prompts, tokenizer, prepend_bos):
+    '''The word indices computed the old way, by tokenizing (and decoding) each prompt and name separately.'''
+    texts = [(tokenizer.bos_token if prepend_bos else "") + prompt["text"] for prompt in prompts]
+    toks = t.Tensor(tokenizer(texts, padding=True).input_ids).long()
+    IO_idxs, S1_idxs, S2_idxs, punct_idxs, end_idxs = [], [], [], [], []
+    for prompt, prompt_toks in zip(prompts, toks):
+        prefix = tokenizer.tokenize(" ".join(prompt["text"].split(" ")[:-1]))
+        IO_tok, S_tok = tokenizer.tokenize(" " + prompt["IO"])[0], tokenizer.tokenize(" " + prompt["S"])[0]
+        IO_idxs.append(int(prepend_bos) + prefix.index(IO_tok))
+        S1_idxs.append(int(prepend_bos) + prefix.index(S_tok))
+        S2_idxs.append(int(prepend_bos) + len(prefix) - 1 - prefix[::-1].index(S_tok))
+
+        decoded = [tokenizer.decode(tok) for tok in tokenizer(prompt["text"])["input_ids"]]
+        for word in [",", "."]:
+            if word in prompt["text"]:
+                punct_idx = len(decoded) - 1 - decoded[::-1].index(tokenizer.decode(tokenizer(word)["input_ids"][0]))
+        punct_idxs.append(punct_idx)
+
+        pad_posns = (prompt_toks == tokenizer.pad_token_id).nonzero().squeeze(-1).tolist()
+        end_idxs.append((pad_posns[int(prepend_bos)] if tokenizer.pad_token_id in prompt_toks[1:] else len(prompt_toks)) - 2)
+
+    IO_idxs, S1_idxs, S2_idxs, end_idxs = map(t.tensor, (IO_idxs, S1_idxs, S2_idxs, end_idxs))
+    return toks, {
+        "IO": IO_idxs, "IO-1": IO_idxs - 1, "IO+1": IO_idxs + 1,
+        "S1": S1_idxs, "S1-1": S1_idxs - 1, "S1+1": S1_idxs + 1,
+        "S2": S2_idxs, "end": end_idxs, "starts": t.zeros_like(end_idxs), "punct": t.tensor(punct_idxs),
+    }
+
+
+def assert_word_idx_equal(word_idx, expected):
+    assert word_idx.keys() == expected.keys()
+    for k in expected:
+        assert t.equal(word_idx[k].cpu(), expected[k]), k
+
+
+@pytest.mark.parametrize("prepend_bos", [False, True])
+@pytest.mark.parametrize("prompt_type", ["ABBA", "BABA", "ABC"])
+def test_idx_dict_matches_per_prompt(tokenizer, prompt_type, prepend_bos):
+    dataset = IOIDataset(prompt_type, N=40, tokenizer=tokenizer, prepend_bos=prepend_bos, seed=3, device="cpu")
+    expected_toks, expected_word_idx = get_idx_dict_per_prompt(dataset.ioi_prompts, tokenizer, prepend_bos)
+
+    toks, attention_mask = tokenize_prompts(dataset.ioi_prompts, tokenizer, prepend_bos)
+    assert t.equal(toks, expected_toks)
+    assert_word_idx_equal(get_idx_dict(dataset.ioi_prompts, tokenizer, prepend_bos=prepend_bos), expected_word_idx)
+    assert_word_idx_equal(get_idx_dict(dataset.ioi_prompts, tokenizer, prepend_bos, toks, attention_mask), expected_word_idx)
+
+    assert t.equal(dataset.toks, expected_toks)
+    assert_word_idx_equal(dataset.word_idx, expected_word_idx)
+    assert dataset.max_len == max(len(tokenizer(prompt["text"]).input_ids) for prompt in dataset.ioi_prompts)
+    assert dataset.io_tokenIDs == [tokenizer.encode(" " + prompt["IO"])[0] for prompt in dataset.ioi_prompts]
+    assert dataset.s_tokenIDs == [tokenizer.encode(" " + prompt["S"])[0] for prompt in dataset.ioi_prompts]
+    assert dataset.tokenized_prompts == ["|".join(tokenizer.decode(tok) for tok in row) for row in expected_toks]
+
+
+def assert_datasets_equal(dataset, expected):
+    assert len(dataset) == dataset.N == expected.N
+    assert t.equal(dataset.toks, expected.toks)
+    assert_word_idx_equal(dataset.word_idx, expected.word_idx)
+    assert t.equal(dataset.seq_lens, expected.seq_lens)
+    assert dataset.max_len == expected.max_len
+    for field in ["ioi_prompts", "sentences", "templates_by_prompt", "io_tokenIDs", "s_tokenIDs", "tokenized_prompts", "prepend_bos"]:
+        assert getattr(dataset, field) == getattr(expected, field), field
+    assert [group.tolist() for group in dataset.groups] == [group.tolist() for group in expected.groups]
+
+
+@pytest.mark.parametrize("prepend_bos", [False, True])
+def test_slice_and_copy_match_new_dataset(tokenizer, prepend_bos):
+    dataset = IOIDataset("mixed", N=30, tokenizer=tokenizer, prepend_bos=prepend_bos, device="cpu")
+    keys = [slice(3, 11), slice(None, None, 4), slice(5, 5), 7, [12, 2, 2, 20], np.array([0, 29]), t.tensor([4, 1]), np.arange(30) % 3 == 0]
+    for key in keys:
+        idxs = np.arange(30)[[key] if isinstance(key, int) else key.numpy() if isinstance(key, t.Tensor) else key].tolist()
+        if len(idxs) == 0:
+            assert len(dataset[key]) == 0
+            continue
+        # (the templates have different lengths, so this also checks we remove the padding which the slice doesn't need)
+        expected = IOIDataset("mixed", N=len(idxs), tokenizer=tokenizer, prompts=[dataset.ioi_prompts[i] for i in idxs], prepend_bos=prepend_bos, device="cpu")
+        assert_datasets_equal(dataset[key], expected)
+
+    copied = dataset.copy()
+    assert_datasets_equal(copied, dataset)
+    # The copy doesn't share any state with the original
+    copied.toks[:] = 0
+    copied.word_idx["IO"][:] = 0
+    copied.ioi_prompts[0]["IO"] = "nobody"
+    copied.io_tokenIDs[0] = 0
+    assert_datasets_equal(dataset, IOIDataset("mixed", N=30, tokenizer=tokenizer, prompts=dataset.ioi_prompts, prepend_bos=prepend_bos, device="cpu"))
+    assert dataset.ioi_prompts[0]["IO"] != "nobody"
+
+
+@pytest.mark.parametrize("symmetric", [False, True])
+def test_stream_prompts_dont_depend_on_batch_size(tokenizer, symmetric):
+    def get_prompts(batch_size):
+        stream = IOIPromptStream("mixed", N=20, batch_size=batch_size, tokenizer=tokenizer, symmetric=symmetric, seed=5, device="cpu")
+        batches = list(stream)
+        assert len(batches) == len(stream)
+        assert [len(batch) for batch in batches] == [min(batch_size, 20 - i) for i in range(0, 20, batch_size)]
+        # Any batch can be regenerated on its own
+        assert stream[len(stream) - 1].ioi_prompts == batches[-1].ioi_prompts
+        return [prompt for batch in batches for prompt in batch.ioi_prompts]
+
+    prompts = get_prompts(20)
+    assert len(set(prompt["text"] for prompt in prompts)) > 10
+    for batch_size in [2, 4, 6]:
+        assert get_prompts(batch_size) == prompts
+    if symmetric:
+        assert all(prompts[i]["IO"] == prompts[i + 1]["S"] for i in range(0, 20, 2))
+
+    stream = IOIPromptStream("mixed", N=20, batch_size=6, tokenizer=tokenizer, symmetric=symmetric, seed=6, device="cpu")
+    assert stream[0].ioi_prompts != prompts[:6]
+
+
+def test_same_seed_same_dataset_without_global_state(tokenizer):
+    random.seed(0)
+    np.random.seed(0)
+    t.manual_seed(0)
+    states = random.getstate(), np.random.get_state(), t.get_rng_state()
+
+    def make_datasets(seed):
+        dataset = IOIDataset("mixed", N=20, tokenizer=tokenizer, seed=seed, device="cpu")
+        abc_dataset = IOIDataset("ABC mixed", N=20, tokenizer=tokenizer, seed=seed, device="cpu")
+        return [dataset, abc_dataset, dataset.gen_flipped_prompts("ABB -> XYZ, BAB -> XYZ"), abc_dataset.gen_flipped_prompts("ABC -> DEF, BAC -> DEF")]
+
+    datasets = make_datasets(seed=1)
+    for dataset, expected in zip(make_datasets(seed=1), datasets):
+        assert_datasets_equal(dataset, expected)
+        assert dataset.templates == expected.templates
+    assert all(dataset.ioi_prompts != other.ioi_prompts for dataset, other in zip(make_datasets(seed=2), datasets))
+
+    assert random.getstate() == states[0]
+    assert all((a == b).all() if isinstance(a, np.ndarray) else a == b for a, b in zip(np.random.get_state(), states[1]))
+    assert t.equal(t.get_rng_state(), states[2])
+
+
+def get_flip_pattern(orig_prompt, prompt):
+    '''
+    Where each of the first three names (and the S and IO names) of a flipped prompt came from: ("orig", i) for the i-th name
+    of the orig prompt, or "random". Two flips with the same pattern only differ in which random names they drew.
+    '''
+    orig_names = [word for word in orig_prompt["text"].split(" ") if word in NAMES][:3]
+    names = [word for word in prompt["text"].split(" ") if word in NAMES][:3]
+    return [("orig", orig_names.index(name)) if name in orig_names else "random" for name in names + [prompt["S"], prompt["IO"]]]
+
+
+DETERMINISTIC_FLIPS = ["ABB -> BAB, BAB -> ABB", "ABB -> ABA, BAB -> BAA", "ABB -> AAB, BAB -> BBA"]
+RANDOM_FLIPS = ["ABB -> XYZ, BAB -> XYZ", "ABB -> CBB, BAB -> BCB", "ABB -> AXX, BAB -> XAX"]
+
+
+@pytest.mark.parametrize("prepend_bos", [False, True])
+def test_flip_plan_matches_per_prompt_flips(tokenizer, prepend_bos):
+    dataset = IOIDataset("mixed", N=40, tokenizer=tokenizer, prepend_bos=prepend_bos, seed=4, device="cpu")
+    assert dataset.get_flip_names() is not None
+
+    for flip in DETERMINISTIC_FLIPS + RANDOM_FLIPS:
+        flipped = dataset.gen_flipped_prompts(flip)
+        assert_datasets_equal(dataset.gen_flipped_prompts(FlipPlan(flip)), flipped)
+        expected = dataset.gen_flipped_prompts_per_prompt(flip, flipped.seed)
+        assert flipped.has_been_flipped and (flipped.seed == expected.seed)
+
+        if flip in DETERMINISTIC_FLIPS:
+            assert_datasets_equal(flipped, expected)
+            continue
+
+        # Random names are drawn from a different generator, so we check they came from the same place
+        flip_dict = dict(template_flip.strip().split(" -> ") for template_flip in flip.split(","))
+        for orig_prompt, template, prompt, expected_prompt in zip(dataset.ioi_prompts, dataset.templates_by_prompt, flipped.ioi_prompts, expected.ioi_prompts):
+            assert get_flip_pattern(orig_prompt, prompt) == get_flip_pattern(orig_prompt, expected_prompt)
+            # (and a letter which appears twice in the flip is the same name both times)
+            names = [word for word in prompt["text"].split(" ") if word in NAMES][:3]
+            flip_new = flip_dict[template[:-1]]
+            assert all(names[i] == names[j] for i in range(3) for j in range(3) if flip_new[i] == flip_new[j])
+        assert flipped.ioi_prompts != expected.ioi_prompts
+        # The tokens (which we substitute rather than tokenizing again) are the same as tokenizing the flipped prompts
+        rebuilt = IOIDataset("mixed", N=40, tokenizer=tokenizer, prompts=flipped.ioi_prompts, prepend_bos=prepend_bos, device="cpu")
+        assert t.equal(flipped.toks, rebuilt.toks)
+        for field in ["sentences", "templates_by_prompt", "io_tokenIDs", "s_tokenIDs", "tokenized_prompts"]:
+            assert getattr(flipped, field) == getattr(rebuilt, field), field
+        # (flipped datasets keep the orig word_idx)
+        assert_word_idx_equal(flipped.word_idx, dataset.word_idx)
@@ -0,0 +1,85 @@
+import os
+import pytest
+import torch as t
+from transformer_lens import HookedTransformer, HookedTransformerConfig
+
+from utils.activation_store import ActivationStore
+from utils.path_patching import IterNode, Node, get_activation_names, get_cache, path_patch
+
+
+def make_model(**cfg_kwargs) -> HookedTransformer:
+    # Default config, so e.g. hook_q_input, hook_attn_in and hook_mlp_in exist in hook_dict but never fire
+    cfg = HookedTransformerConfig(**{
+        **dict(n_layers=2, d_model=32, n_ctx=16, d_head=8, n_heads=4, d_mlp=64, d_vocab=50, act_fn="gelu", normalization_type="LN", device="cpu"),
+        **cfg_kwargs,
+    })
+    t.manual_seed(0)
+    return HookedTransformer(cfg).eval()
+
+
+@pytest.fixture
+def model():
+    return make_model()
+
+
+@pytest.fixture
+def tokens():
+    t.manual_seed(1)
+    return t.randint(0, 50, (3, 6))
+
+
+def test_get_cache_all_names(model, tokens, tmp_path):
+    store = ActivationStore(str(tmp_path))
+    _, expected = model.run_with_cache(tokens, return_type=None)
+    cache = store.get_cache(model, tokens)
+    assert set(cache.keys()) == set(expected.keys())
+    assert "blocks.0.hook_q_input" not in cache
+    for name in expected.keys():
+        t.testing.assert_close(cache[name], expected[name])
+
+    # The hooks which never fire are remembered, so the second call doesn't run the model at all
+    with model.hooks(fwd_hooks=[("hook_embed", lambda embed, hook: pytest.fail("model was rerun"))]):
+        cache = store.get_cache(model, tokens)
+    assert set(cache.keys()) == set(expected.keys())
+
+
+def test_get_cache_q_receivers(model, tokens, tmp_path):
+    store = ActivationStore(str(tmp_path))
+    names = get_activation_names(model, IterNode(["q", "pattern"]), receiver=True)
+    assert not any(name.endswith("_input") for name in names)
+    cache = get_cache(model, tokens, names, activation_store=store)
+    assert set(cache.keys()) == set(names)
+
+    # A list of names which includes hooks that don't fire, like we'd get from `model.hook_dict`
+    cache = store.get_cache(model, tokens, names_filter=["blocks.1.hook_q_input", "blocks.1.attn.hook_q"])
+    assert list(cache.keys()) == ["blocks.1.attn.hook_q"]
+
+
+def test_path_patch_with_store(model, tokens, tmp_path):
+    new_tokens = tokens.flip(0)
+    kwargs = dict(sender_nodes=Node("z", layer=0), receiver_nodes=IterNode("q"), patching_metric=lambda logits: logits[:, -1].mean())
+    expected = path_patch(model, tokens, new_tokens, **kwargs)
+    store = ActivationStore(str(tmp_path))
+    for _ in range(2):
+        results = path_patch(model, tokens, new_tokens, activation_store=store, **kwargs)
+        t.testing.assert_close(results, expected)
+
+
+def test_edited_weights_dont_reuse_activations(model, tokens, tmp_path):
+    store = ActivationStore(str(tmp_path))
+    name = "blocks.1.hook_resid_post"
+    cache = store.get_cache(model, tokens, names_filter=[name])
+    original = cache[name].clone()
+    original_weight = model.blocks[0].mlp.W_out[3, 5].item()
+    with t.no_grad():
+        model.blocks[0].mlp.W_out[3, 5] += 1.0
+    _, expected = model.run_with_cache(tokens, return_type=None, names_filter=[name])
+    edited = store.get_cache(model, tokens, names_filter=[name])[name]
+    t.testing.assert_close(edited, expected[name])
+    assert not t.allclose(edited, original)
+
+    # Clearing the edited model's activations leaves the original model's ones
+    store.clear(model)
+    with t.no_grad():
+        model.blocks[0].mlp.W_out[3, 5] = original_weight
+    assert os.path.exists(store.get_directory(model, tokens))
@@ -0,0 +1,82 @@
+import random
+
+import numpy as np
+
+from utils.case_store import CaseStore
+from utils.prompt_interface import Prompt, PromptFamily
+
+
+def make_family() -> PromptFamily:
+    rng = random.Random(0)
+    prompts = [
+        Prompt(
+            name="max",
+            prompt_fn=lambda inputs: f"The largest number in {inputs[0]} is",
+            transform_fn=lambda inputs: max(inputs[0]),
+            random_input_fn=lambda: [[rng.randrange(10) for _ in range(rng.randrange(1, 6))]],
+        ),
+        Prompt(
+            name="repeat",
+            prompt_fn=lambda inputs: f"Repeat {inputs[1]} {inputs[0]} times:",
+            transform_fn=lambda inputs: " ".join([inputs[1]] * inputs[0]),
+            random_input_fn=lambda: [rng.randrange(1, 4), rng.choice(["cat", "dog"])],
+        ),
+    ]
+    wraps = {
+        "plain": lambda core, inputs: core,
+        "qa": lambda core, inputs: f"Q: {core}\nA:",
+    }
+    return PromptFamily("test", prompts=prompts, wraps=wraps)
+
+
+def get_output(case) -> str:
+    # Half the cases are right, and the wrong outputs repeat a lot (so they should be interned)
+    return str(case.ground_truth) if case.task_id.endswith(("0", "2", "4", "6", "8")) else "wrong"
+
+
+def test_filter_record_save_load_round_trip(tmp_path):
+    family = make_family()
+    cases = family.generate_all(n=10)
+    store = CaseStore.from_cases(family, cases)
+
+    # Record outputs through a filtered store and through the original store
+    filtered = store.filter(prompt_name="max")
+    for case in filtered:
+        case.record_output(get_output(case))
+    for case in store:
+        if case.prompt_name != "max":
+            case.record_output(get_output(case))
+    for case in cases:
+        case.record_output(get_output(case))
+
+    outputs = store.tables["output"]
+    assert len(outputs) == len(set(outputs)) == len({get_output(case) for case in cases})
+
+    store.save(str(tmp_path / "all"))
+    filtered.save(str(tmp_path / "max"))
+    loaded = CaseStore.load(str(tmp_path / "all"), family)
+    loaded_filtered = CaseStore.load(str(tmp_path / "max"), family)
+
+    assert len(loaded) == len(cases)
+    for view, case in zip(loaded, cases):
+        assert view.task_id == case.task_id
+        assert view.inputs == case.inputs
+        assert view.prompt == case.prompt
+        assert view.ground_truth == case.ground_truth
+        assert view.generated_output == case.generated_output
+        assert view.evaluation_result == case.evaluation_result
+
+    max_cases = [case for case in cases if case.metadata["prompt_name"] == "max"]
+    assert [view.task_id for view in loaded_filtered] == [case.task_id for case in max_cases]
+    assert [view.evaluation_result for view in loaded_filtered] == [case.evaluation_result for case in max_cases]
+
+
+def test_filtered_stores_share_intern_map():
+    family = make_family()
+    store = CaseStore.from_cases(family, family.generate_all(n=4))
+    by_wrap = store.filter(wrap_name="qa")
+    assert by_wrap.table_ids is store.table_ids
+    by_wrap[0].record_output("same")
+    store[0].record_output("same")
+    by_wrap[np.arange(len(by_wrap)) % 2 == 1][0].record_output("same")
+    assert store.tables["output"] == ["same"]
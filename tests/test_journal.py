@@ -0,0 +1,93 @@
+from functools import partial
+
+import pytest
+import torch as t
+
+from utils.journal import SweepJournal
+from utils.path_patching import IterNode, Node, act_patch, path_patch
+from test_activation_store import make_model
+
+
+class Interrupted(Exception):
+    pass
+
+
+# Number of times `counting_metric` has been called, and the call at which it raises (to simulate a dead kernel)
+calls = {"n": 0, "interrupt_at": None}
+
+
+def counting_metric(logits):
+    calls["n"] += 1
+    if calls["n"] == calls["interrupt_at"]:
+        raise Interrupted()
+    return logits[:, -1].mean().item()
+
+
+def run_interrupted(run, interrupt_at):
+    calls.update(n=0, interrupt_at=interrupt_at)
+    with pytest.raises(Interrupted):
+        run()
+    calls.update(n=0, interrupt_at=None)
+    return run()
+
+
+@pytest.fixture
+def tokens():
+    t.manual_seed(1)
+    return t.randint(0, 50, (3, 6)), t.randint(0, 50, (3, 6))
+
+
+def test_act_patch_resumes_from_journal(tokens, tmp_path):
+    model = make_model()
+    tokens, new_tokens = tokens
+    run = lambda journal=None: act_patch(model, tokens, IterNode(["z", "resid_pre"]), counting_metric, new_input=new_tokens, journal=journal)
+    n_nodes = 2 * model.cfg.n_heads + model.cfg.n_layers
+    expected = run()
+
+    path = str(tmp_path / "act_patch.jsonl")
+    results = run_interrupted(lambda: run(path), interrupt_at=6)
+    # The 5 nodes which finished before the interruption are read from the journal, not recomputed
+    assert calls["n"] == n_nodes - 5
+    for name in expected:
+        t.testing.assert_close(results[name], expected[name])
+
+    # Rerunning a finished sweep doesn't compute anything
+    calls["n"] = 0
+    results = run(path)
+    assert calls["n"] == 0
+    for name in expected:
+        t.testing.assert_close(results[name], expected[name])
+    assert len(SweepJournal(path).get_results()) == n_nodes
+
+
+def test_path_patch_resumes_from_journal(tokens, tmp_path):
+    model = make_model()
+    tokens, new_tokens = tokens
+    run = lambda journal=None: path_patch(
+        model, tokens, new_tokens, sender_nodes=Node("z", layer=0), receiver_nodes=IterNode(["q", "v"]),
+        patching_metric=counting_metric, journal=journal,
+    )
+    expected = run()
+
+    path = str(tmp_path / "path_patch.jsonl")
+    calls["n"] = 0
+    run(path)
+    n_calls = calls["n"]
+    SweepJournal(path).clear()
+
+    results = run_interrupted(lambda: run(path), interrupt_at=4)
+    assert calls["n"] == n_calls - 3
+    for name in expected:
+        t.testing.assert_close(results[name], expected[name])
+
+
+def test_metric_key_rejects_unstable_names(tmp_path):
+    for metric in [lambda logits: logits.mean(), partial(counting_metric)]:
+        with pytest.raises(ValueError):
+            SweepJournal.get_metric_key(metric)
+        assert SweepJournal.get_metric_key(metric, metric_key="mean logit") == "mean logit"
+    assert SweepJournal.get_metric_key(counting_metric) == f"{__name__}.counting_metric"
+    assert SweepJournal.get_metric_key("loss") == "loss"
+
+    with pytest.raises(ValueError):
+        act_patch(make_model(), t.zeros(1, 4, dtype=t.long), IterNode("z"), lambda logits: logits.mean().item(), new_cache="zero", journal=str(tmp_path / "journal.jsonl"))
@@ -0,0 +1,53 @@
+import os
+import sys
+
+import numpy as np
+import pytest
+
+# (list_prompt_family imports the registries as top-level modules, like the notebooks in utils/ do)
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "utils"))
+
+from utils.list_prompt_family import ListPromptFamily
+
+FILL_MODES = ["random", "uniform", "single_outlier"]
+
+
+@pytest.mark.parametrize("fill_mode", FILL_MODES)
+def test_batch_ground_truths_match_transform_fn(fill_mode):
+    np.random.seed(0)
+    # (a small range of values, so that find_index has lists which contain every value, and targets which aren't in the list)
+    family = ListPromptFamily(min_val=0, max_val=4, fill_mode=fill_mode)
+    for name, prompt in family.prompts.items():
+        batch = family.generate_batch_inputs(name, 500)
+        ground_truths = family.get_batch_ground_truths(name, batch).tolist()
+        for inputs, ground_truth in zip(family.batch_to_inputs(name, batch), ground_truths):
+            assert (ground_truth if ground_truth != -1 else "Not Found") == prompt.transform_fn(inputs), (name, inputs)
+        for case in family.create_cases(name, 50):
+            assert case.ground_truth == prompt.transform_fn(case.inputs)
+
+    if fill_mode == "random":
+        lists = family.generate_batch_inputs("find_index", 2000)["lists"]
+        targets = family.random_targets_not_in(lists)
+        in_list = (lists == targets[:, None]).any(1)
+        full = np.array([len(set(lst)) == 4 for lst in lists.tolist()])
+        # A list with every value has no target which isn't in it, so it gets one of its own values (rather than looping forever)
+        assert full.any() and (~full).any()
+        assert (in_list == full).all()
+        assert ((targets >= 0) & (targets < 4)).all()
+
+
+@pytest.mark.parametrize("fill_mode", FILL_MODES)
+def test_store_views_match_cases(fill_mode):
+    family = ListPromptFamily(fill_mode=fill_mode)
+    np.random.seed(1)
+    store = family.generate_store("all", "all", n=20)
+    np.random.seed(1)
+    cases = ListPromptFamily(fill_mode=fill_mode).generate("all", "all", n=20)
+    assert len(store) == len(cases) == 20 * len(family.prompts) * len(family.wraps)
+
+    for view, case in zip(store, cases):
+        standalone = view.to_case()
+        assert view.prompt == standalone.prompt == case.prompt
+        assert view.ground_truth == standalone.ground_truth == case.ground_truth
+        assert view.task_id == standalone.task_id == case.task_id
+        assert view.inputs == case.inputs
@@ -0,0 +1,97 @@
+import json
+import asyncio
+
+import httpx
+import pytest
+
+from utils.model_backend import OllamaBackend
+
+
+class StubOllama:
+    '''
+    In-process stub of Ollama's `/api/generate`, which streams back the prompt reversed (one character per chunk, after a
+    delay which depends on the prompt so that the requests finish out of order).
+
+    `fail` maps a prompt to a list of status codes to return (one per attempt) before it succeeds.
+    '''
+    def __init__(self, fail=None, delay=0.01):
+        self.fail = {prompt: list(codes) for prompt, codes in (fail or {}).items()}
+        self.delay = delay
+        self.payloads = []
+        self.in_flight = 0
+        self.max_in_flight = 0
+
+    async def __call__(self, request: httpx.Request) -> httpx.Response:
+        assert request.url.path == "/api/generate"
+        payload = json.loads(request.content)
+        self.payloads.append(payload)
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        try:
+            await asyncio.sleep(self.delay * (len(payload["prompt"]) % 5))
+        finally:
+            self.in_flight -= 1
+        if self.fail.get(payload["prompt"]):
+            return httpx.Response(self.fail[payload["prompt"]].pop(0), json={"error": "stub error"})
+        response = payload["prompt"][::-1][:payload["options"]["num_predict"]]
+        lines = [json.dumps({"response": c, "done": False}) for c in response] + [json.dumps({"response": "", "done": True})]
+        return httpx.Response(200, content="\n".join(lines).encode())
+
+
+def make_backend(stub, **kwargs):
+    return OllamaBackend("stub-model", transport=httpx.MockTransport(stub), backoff=0.0, verbose=False, **kwargs)
+
+
+PROMPTS = ["abc", "hello world", "x", "four", "a longer prompt", "12345"]
+
+
+def test_outputs_in_prompt_order():
+    stub = StubOllama()
+    outputs = make_backend(stub).generate(PROMPTS, max_tokens=100)
+    assert outputs == [prompt[::-1].strip() for prompt in PROMPTS]
+    assert sorted(payload["prompt"] for payload in stub.payloads) == sorted(PROMPTS)
+
+
+def test_concurrency_cap():
+    stub = StubOllama(delay=0.02)
+    make_backend(stub, max_concurrency=3).generate(PROMPTS * 4)
+    assert stub.max_in_flight == 3
+
+
+def test_retries_server_errors():
+    stub = StubOllama(fail={"abc": [503, 503]})
+    outputs = make_backend(stub, max_retries=2).generate(PROMPTS)
+    assert outputs[0] == "cba"
+    assert [payload["prompt"] for payload in stub.payloads].count("abc") == 3
+
+    stub = StubOllama(fail={"abc": [503, 503]})
+    with pytest.raises(httpx.HTTPStatusError):
+        make_backend(stub, max_retries=1).generate(PROMPTS)
+
+
+def test_no_retry_on_client_error():
+    stub = StubOllama(fail={"abc": [404]})
+    with pytest.raises(httpx.HTTPStatusError) as e:
+        make_backend(stub, max_retries=3).generate(PROMPTS)
+    assert e.value.response.status_code == 404
+    assert [payload["prompt"] for payload in stub.payloads].count("abc") == 1
+
+
+def test_decoding_options_forwarded():
+    stub = StubOllama()
+    outputs = make_backend(stub, options={"seed": 0}).generate(["hello world"], max_tokens=4, stop_sequences=["\n", "."])
+    assert outputs == ["dlro"]
+    options = stub.payloads[0]["options"]
+    assert options == {"temperature": 0.0, "num_predict": 4, "stop": ["\n", "."], "seed": 0}
+    assert stub.payloads[0]["model"] == "stub-model"
+
+    stub = StubOllama()
+    make_backend(stub).generate(["hello world"], max_tokens=4)
+    assert "stop" not in stub.payloads[0]["options"]
+
+
+def test_generate_inside_event_loop():
+    # (like in a Jupyter notebook, where there's already a running event loop)
+    async def main():
+        return make_backend(StubOllama()).generate(PROMPTS[:2])
+    assert asyncio.run(main()) == ["cba", "dlrow olleh"]
@@ -0,0 +1,52 @@
+import pytest
+import torch as t
+
+from utils.output_cache import OutputCache, get_model_id
+from utils.prompt_interface import PromptCase, PromptFamily
+
+from test_prompt_interface import PROMPTS, make_model, make_tokenizer
+
+
+@pytest.fixture(scope="module")
+def tokenizer(tmp_path_factory):
+    return make_tokenizer(tmp_path_factory.mktemp("tokenizer"), prepends_bos=False)
+
+
+def make_family(prompts):
+    family = PromptFamily("test", prompts=[], wraps={})
+    family.cases = [PromptCase(task_id="test", inputs=[prompt], prompt_fn=lambda inputs: inputs[0], ground_truth="") for prompt in prompts]
+    return family
+
+
+def test_model_id(tokenizer):
+    model = make_model(tokenizer)
+    model_id = get_model_id(model)
+    assert get_model_id(make_model(tokenizer)) == model_id
+    assert get_model_id(make_model(tokenizer, default_prepend_bos=False)) != model_id
+    with t.no_grad():
+        model.blocks[0].mlp.W_out[3, 5] += 0.1
+    assert get_model_id(model) != model_id
+
+
+def test_hooked_model_is_not_cached(tokenizer, tmp_path):
+    model = make_model(tokenizer)
+    output_cache = OutputCache(str(tmp_path / "outputs.sqlite"))
+    family = make_family(PROMPTS)
+    family.run_cases(model, max_tokens=4, output_cache=output_cache)
+    outputs = [case.generated_output for case in family.cases]
+    assert len(output_cache) == len(PROMPTS)
+
+    def hook(resid, hook):
+        return resid * 0.0
+
+    with model.hooks(fwd_hooks=[("blocks.1.hook_resid_post", hook)]):
+        family.run_cases(model, max_tokens=4, output_cache=output_cache)
+        hooked_outputs = [case.generated_output for case in family.cases]
+        case = family.cases[0].copy()
+        case.run_model(model, max_tokens=4, output_cache=output_cache)
+        assert case.generated_output == hooked_outputs[0]
+    assert hooked_outputs != outputs
+    assert len(output_cache) == len(PROMPTS)
+
+    family.run_cases(model, max_tokens=4, output_cache=output_cache)
+    assert [case.generated_output for case in family.cases] == outputs
@@ -0,0 +1,305 @@
+import pytest
+import torch as t
+from transformer_lens import ActivationCache
+
+from utils.path_patching import ActivationStats, IterNode, Node, act_patch, act_patch_attribution, get_mean_cache, path_patch
+
+from test_activation_store import make_model
+
+
+def tensor_metric(logits):
+    return logits[:, -1, 0].mean()
+
+
+def float_metric(logits):
+    return tensor_metric(logits).item()
+
+
+COMPONENTS = ["z", "pattern", "attn_scores", "attn_out", "post", "resid_pre"]
+
+
+def test_act_patch_attribution_matches_act_patch_delta():
+    # Attribution is a linear approximation, so for a small enough change to the activations it should agree with the exact
+    # change in the metric (up to second order terms)
+    model = make_model(dtype=t.float64)
+    t.manual_seed(1)
+    orig_tokens = t.randint(0, 50, (3, 6))
+    names_filter = lambda name: any(name.endswith(f"hook_{c}") for c in COMPONENTS)
+    _, orig_cache = model.run_with_cache(orig_tokens, names_filter=names_filter)
+    # (the masked attention scores stay -inf)
+    new_cache = ActivationCache({name: act + 1e-4 * t.randn_like(act) for name, act in orig_cache.items()}, model)
+
+    nodes = IterNode(COMPONENTS)
+    # (act_patch stacks the results into a float32 tensor, so we subtract the clean metric before that)
+    clean_metric = tensor_metric(model(orig_tokens))
+    delta = act_patch(model, orig_tokens, nodes, lambda logits: (tensor_metric(logits) - clean_metric).item(), new_cache=new_cache)
+    attribution = act_patch_attribution(model, orig_tokens, nodes, tensor_metric, new_cache=new_cache)
+    for name in COMPONENTS:
+        assert attribution[name].shape == delta[name].shape, name
+        assert delta[name].abs().max() > 1e-7, name
+        t.testing.assert_close(attribution[name].float(), delta[name], atol=1e-8, rtol=1e-2, msg=name)
+
+
+@pytest.mark.parametrize("new_cache", [None, "zero", "mean"])
+def test_act_patch_attribution_is_finite(new_cache):
+    model = make_model()
+    t.manual_seed(1)
+    orig_tokens, new_tokens = t.randint(0, 50, (2, 3, 6))
+    new_input = new_tokens if new_cache is None else None
+    results = act_patch_attribution(model, orig_tokens, IterNode(COMPONENTS), tensor_metric, new_input=new_input, new_cache=new_cache)
+    for name in COMPONENTS:
+        assert results[name].isfinite().all(), name
+
+
+def float_metric(logits):
+    return logits[:, -1, 0].mean().item()
+
+
+@pytest.fixture
+def tokens():
+    t.manual_seed(1)
+    orig_tokens, new_tokens = t.randint(0, 50, (2, 3, 6))
+    return orig_tokens, new_tokens
+
+
+@pytest.mark.parametrize("node", [
+    Node("embed"), Node("resid_pre", 0), Node("resid_pre", 1), Node("z", 0, head=1), Node("pattern", 1, head=2),
+    Node("attn_out", 1), Node("post", 0),
+], ids=repr)
+def test_act_patch_resume_from_patched_layer(tokens, node):
+    model = make_model()
+    orig_tokens, new_tokens = tokens
+    expected = act_patch(model, orig_tokens, node, float_metric, new_input=new_tokens)
+    assert expected != act_patch(model, orig_tokens, [], float_metric, new_input=new_tokens)
+    assert act_patch(model, orig_tokens, node, float_metric, new_input=new_tokens, resume_from_patched_layer=True) == pytest.approx(expected, abs=1e-5)
+
+
+@pytest.mark.parametrize("chunk_size", [None, 3])
+def test_act_patch_iter_resume_from_patched_layer(tokens, chunk_size):
+    model = make_model()
+    orig_tokens, new_tokens = tokens
+    nodes = IterNode(["resid_pre", "z", "post"])
+    expected = act_patch(model, orig_tokens, nodes, float_metric, new_input=new_tokens)
+    results = act_patch(model, orig_tokens, nodes, float_metric, new_input=new_tokens, chunk_size=chunk_size, resume_from_patched_layer=True)
+    for name in expected:
+        t.testing.assert_close(results[name], expected[name], atol=1e-5, rtol=1e-5)
+
+
+@pytest.mark.parametrize("seq_pos", [None, 4, [5, 3, 4]])
+@pytest.mark.parametrize("receiver_name", ["q", "k", "v"])
+def test_direct_path_patch_per_head_receivers(tokens, seq_pos, receiver_name):
+    # Patching the direct path into all heads at once is the same as patching into each head separately, whether the heads
+    # are indexed alongside slices (seq_pos=None) or tensors of positions
+    model = make_model(use_split_qkv_input=True)
+    orig_tokens, new_tokens = tokens
+    kwargs = dict(patching_metric=float_metric, seq_pos=seq_pos, direct_includes_mlps=False)
+    sender = Node("z", 0, head=1)
+    all_heads = path_patch(model, orig_tokens, new_tokens, sender, Node(receiver_name, 1), **kwargs)
+    per_head = path_patch(model, orig_tokens, new_tokens, sender, [Node(receiver_name, 1, head=h) for h in range(model.cfg.n_heads)], **kwargs)
+    assert per_head == pytest.approx(all_heads, abs=1e-5)
+
+    # Batched receivers (chunk_size) match the serial results
+    iter_kwargs = dict(patching_metric=float_metric, direct_includes_mlps=False)
+    receivers = IterNode(receiver_name, seq_pos=seq_pos)
+    serial = path_patch(model, orig_tokens, new_tokens, sender, receivers, **iter_kwargs)[receiver_name]
+    batched = path_patch(model, orig_tokens, new_tokens, sender, receivers, chunk_size=3, **iter_kwargs)[receiver_name]
+    t.testing.assert_close(batched, serial, atol=1e-5, rtol=1e-5)
+    assert serial[0].tolist() == [pytest.approx(float_metric(model(orig_tokens)), abs=1e-5)] * model.cfg.n_heads
+    assert serial[1, 2] == pytest.approx(path_patch(model, orig_tokens, new_tokens, sender, Node(receiver_name, 1, head=2), **kwargs), abs=1e-5)
+
+
+@pytest.mark.parametrize("batch_size", [1, 2, 4])
+def test_activation_stats_match_full_batch(batch_size, tmp_path):
+    model = make_model()
+    t.manual_seed(2)
+    tokens = t.randint(0, 50, (7, 6))
+    names_filter = lambda name: any(name.endswith(f"hook_{c}") for c in COMPONENTS)
+    stats = ActivationStats.from_dataset(model, tokens, batch_size=batch_size, names_filter=names_filter)
+    mean_cache = get_mean_cache(model, tokens, names_filter=names_filter)
+    _, cache = model.run_with_cache(tokens, return_type=None, names_filter=names_filter)
+    assert set(stats.keys()) == set(mean_cache.keys())
+    stats.save(str(tmp_path / "stats.pt"))
+    for stats in [stats, ActivationStats.load(str(tmp_path / "stats.pt"))]:
+        for name in mean_cache.keys():
+            # (the masked attention scores are -inf in the means, and nan in the variances)
+            t.testing.assert_close(stats[name], mean_cache[name], atol=1e-5, rtol=1e-5, msg=name)
+            t.testing.assert_close(stats.var(name), cache[name].var(0, unbiased=False, keepdim=True), atol=1e-5, rtol=1e-4, equal_nan=True, msg=name)
+    assert stats["blocks.0.attn.hook_attn_scores"].isneginf().any()
+
+
+def assert_results_close(results, expected):
+    # (act_patch / path_patch return floats, tensors, or dicts / lists of them)
+    if isinstance(expected, dict):
+        assert results.keys() == expected.keys()
+        for k in expected: assert_results_close(results[k], expected[k])
+    elif isinstance(expected, list):
+        assert len(results) == len(expected)
+        for r, e in zip(results, expected): assert_results_close(r, e)
+    else:
+        t.testing.assert_close(t.as_tensor(results).float(), t.as_tensor(expected).float(), atol=1e-5, rtol=1e-4)
+
+
+MINIBATCH_METRICS = {
+    "mean": lambda logits: logits[:, -1, 0].mean().item(),
+    "sum": lambda logits: logits[:, -1, 0].sum().item(),
+    "cat": lambda logits: logits[:, -1, 0].detach(),
+}
+
+
+@pytest.fixture(scope="module")
+def minibatch_setup():
+    model = make_model()
+    t.manual_seed(3)
+    orig_tokens, new_tokens = t.randint(0, 50, (2, 7, 6))
+    _, new_cache = model.run_with_cache(new_tokens, return_type=None)
+    return model, orig_tokens, new_tokens, new_cache
+
+
+def get_new_kwargs(new_cache_type, new_tokens, new_cache):
+    if new_cache_type is None:
+        return dict(new_input=new_tokens)
+    return dict(new_cache=new_cache if new_cache_type == "cache" else new_cache_type)
+
+
+@pytest.mark.parametrize("new_cache_type", [None, "zero", "mean", "cache"])
+@pytest.mark.parametrize("metric_reduction", ["mean", "sum", "cat"])
+def test_act_patch_minibatches_match_full_batch(minibatch_setup, metric_reduction, new_cache_type):
+    model, orig_tokens, new_tokens, new_cache = minibatch_setup
+    kwargs = dict(
+        patching_nodes=IterNode(["z", "attn_scores", "resid_pre"]), patching_metric=MINIBATCH_METRICS[metric_reduction],
+        **get_new_kwargs(new_cache_type, new_tokens, new_cache),
+    )
+    expected = act_patch(model, orig_tokens, **kwargs)
+    for batch_size in [3, 7]:
+        results = act_patch(model, orig_tokens, batch_size=batch_size, metric_reduction=metric_reduction, **kwargs)
+        assert_results_close(results, expected)
+
+
+@pytest.mark.parametrize("new_cache_type", [None, "zero", "mean", "cache"])
+@pytest.mark.parametrize("metric_reduction", ["mean", "sum", "cat"])
+def test_path_patch_minibatches_match_full_batch(minibatch_setup, metric_reduction, new_cache_type):
+    model, orig_tokens, new_tokens, new_cache = minibatch_setup
+    kwargs = dict(
+        sender_nodes=IterNode("z"), receiver_nodes=Node("resid_post", 1), patching_metric=MINIBATCH_METRICS[metric_reduction],
+        **get_new_kwargs(new_cache_type, new_tokens, new_cache),
+    )
+    expected = path_patch(model, orig_tokens, **kwargs)
+    for batch_size in [3, 7]:
+        results = path_patch(model, orig_tokens, batch_size=batch_size, metric_reduction=metric_reduction, **kwargs)
+        assert_results_close(results, expected)
+
+
+@pytest.mark.parametrize("seq_pos", [None, "each", [5, 3, 4]])
+@pytest.mark.parametrize("chunk_size", [1, 4, 1000])
+def test_act_patch_chunks_match_serial(tokens, chunk_size, seq_pos):
+    model = make_model()
+    orig_tokens, new_tokens = tokens
+    # (patching each neuron at each position separately is slow, so we only do neurons for the other seq_pos values)
+    components = ["z", "resid_pre", "attn_out"] + (["post"] if seq_pos != "each" else []) + (["pattern"] if seq_pos is None else [])
+    nodes = IterNode(components, seq_pos=seq_pos)
+    expected = act_patch(model, orig_tokens, nodes, float_metric, new_input=new_tokens)
+    results = act_patch(model, orig_tokens, nodes, float_metric, new_input=new_tokens, chunk_size=chunk_size)
+    assert_results_close(results, expected)
+
+
+PATH_PATCH_CASES = {
+    "iter_senders": dict(sender_nodes=IterNode(["z", "post", "mlp_out"]), receiver_nodes=[Node("resid_post", 1), Node("v", 1, head=0)]),
+    "iter_senders_each": dict(sender_nodes=IterNode(["z", "resid_pre"], seq_pos="each"), receiver_nodes=Node("resid_post", 1)),
+    "iter_receivers": dict(sender_nodes=Node("z", 0, head=1), receiver_nodes=IterNode(["q", "k", "v", "pattern", "resid_pre"])),
+    "iter_receivers_seq_pos": dict(sender_nodes=Node("attn_out", 0), receiver_nodes=IterNode(["v", "pre"], seq_pos=[5, 3, 4])),
+}
+
+
+@pytest.mark.parametrize("direct_includes_mlps", [True, False])
+@pytest.mark.parametrize("case", PATH_PATCH_CASES)
+def test_path_patch_chunks_match_serial(tokens, case, direct_includes_mlps):
+    model = make_model(d_mlp=16, use_split_qkv_input=True)
+    orig_tokens, new_tokens = tokens
+    kwargs = dict(patching_metric=float_metric, direct_includes_mlps=direct_includes_mlps, **PATH_PATCH_CASES[case])
+    expected = path_patch(model, orig_tokens, new_tokens, **kwargs)
+    for chunk_size in [3, 1000]:
+        assert_results_close(path_patch(model, orig_tokens, new_tokens, chunk_size=chunk_size, **kwargs), expected)
+
+
+@pytest.mark.parametrize("chunk_size", [None, 3])
+@pytest.mark.parametrize("direct_includes_mlps", [True, False])
+@pytest.mark.parametrize("case", PATH_PATCH_CASES)
+def test_path_patch_resume_from_patched_layer(tokens, case, direct_includes_mlps, chunk_size):
+    # Skipping the layers which are the same as the orig run (before the senders / after the receivers) doesn't change anything
+    model = make_model(n_layers=3, d_mlp=16, use_split_qkv_input=True)
+    orig_tokens, new_tokens = tokens
+    kwargs = dict(patching_metric=float_metric, direct_includes_mlps=direct_includes_mlps, chunk_size=chunk_size, **PATH_PATCH_CASES[case])
+    expected = path_patch(model, orig_tokens, new_tokens, **kwargs)
+    assert_results_close(path_patch(model, orig_tokens, new_tokens, resume_from_patched_layer=True, **kwargs), expected)
+
+
+def test_path_patch_resume_from_later_layers(tokens):
+    # Senders and receivers in the middle of a deeper model, so there are layers to skip at both ends
+    model = make_model(n_layers=4, d_mlp=16)
+    orig_tokens, new_tokens = tokens
+    for kwargs in [
+        dict(sender_nodes=Node("z", 1, head=2), receiver_nodes=IterNode(["q", "pre", "resid_mid"])),
+        dict(sender_nodes=IterNode(["z", "post"]), receiver_nodes=[Node("k", 2, head=1), Node("resid_post", 2)]),
+    ]:
+        expected = path_patch(model, orig_tokens, new_tokens, patching_metric=float_metric, **kwargs)
+        results = path_patch(model, orig_tokens, new_tokens, patching_metric=float_metric, resume_from_patched_layer=True, **kwargs)
+        assert_results_close(results, expected)
+
+
+@pytest.mark.parametrize("resume_from_patched_layer", [False, True])
+def test_path_patch_sender_aliasing_receiver(tokens, resume_from_patched_layer):
+    # resid_pre at layer 2 is the same tensor as resid_post at layer 1, but comes after it, so there's no path between them
+    model = make_model(n_layers=3)
+    orig_tokens, new_tokens = tokens
+    result = path_patch(model, orig_tokens, new_tokens, Node("resid_pre", 2), Node("resid_post", 1), float_metric, resume_from_patched_layer=resume_from_patched_layer)
+    assert result == pytest.approx(float_metric(model(orig_tokens)), abs=1e-5)
+
+
+@pytest.mark.parametrize("resume_from_patched_layer", [False, True])
+@pytest.mark.parametrize("direct_includes_mlps", [True, False])
+@pytest.mark.parametrize("case", PATH_PATCH_CASES)
+def test_path_patch_filtered_caches_match_full_caches(tokens, case, direct_includes_mlps, resume_from_patched_layer):
+    # By default path_patch only caches the activations it needs, which should give the same results as full caches
+    model = make_model(d_mlp=16, use_split_qkv_input=True)
+    orig_tokens, new_tokens = tokens
+    kwargs = dict(
+        patching_metric=float_metric, direct_includes_mlps=direct_includes_mlps, resume_from_patched_layer=resume_from_patched_layer,
+        chunk_size=3, **PATH_PATCH_CASES[case],
+    )
+    _, orig_cache = model.run_with_cache(orig_tokens, return_type=None)
+    _, new_cache = model.run_with_cache(new_tokens, return_type=None)
+    expected = path_patch(model, orig_tokens, orig_cache=orig_cache, new_cache=new_cache, **kwargs)
+    assert_results_close(path_patch(model, orig_tokens, new_tokens, **kwargs), expected)
+
+
+@pytest.mark.parametrize("resume_from_patched_layer", [False, True])
+def test_act_patch_filtered_cache_matches_full_cache(tokens, resume_from_patched_layer):
+    model = make_model(d_mlp=16)
+    orig_tokens, new_tokens = tokens
+    _, new_cache = model.run_with_cache(new_tokens, return_type=None)
+    kwargs = dict(patching_nodes=IterNode(["z", "pattern", "post", "resid_mid"]), patching_metric=float_metric, chunk_size=5, resume_from_patched_layer=resume_from_patched_layer)
+    expected = act_patch(model, orig_tokens, new_cache=new_cache, **kwargs)
+    assert_results_close(act_patch(model, orig_tokens, new_input=new_tokens, **kwargs), expected)
+
+
+@pytest.mark.parametrize("chunk_size", [None, 4])
+def test_act_patch_zero_ablation_matches_zero_cache(tokens, chunk_size):
+    model = make_model(d_mlp=16)
+    orig_tokens, _ = tokens
+    _, cache = model.run_with_cache(orig_tokens, return_type=None)
+    zero_cache = ActivationCache({name: t.zeros_like(act) for name, act in cache.items()}, model)
+    kwargs = dict(patching_nodes=IterNode(["z", "attn_scores", "post", "resid_pre"]), patching_metric=float_metric, chunk_size=chunk_size)
+    expected = act_patch(model, orig_tokens, new_cache=zero_cache, **kwargs)
+    assert_results_close(act_patch(model, orig_tokens, new_cache="zero", **kwargs), expected)
+
+
+@pytest.mark.parametrize("direct_includes_mlps", [True, False])
+@pytest.mark.parametrize("case", PATH_PATCH_CASES)
+def test_path_patch_zero_ablation_matches_zero_cache(tokens, case, direct_includes_mlps):
+    model = make_model(d_mlp=16, use_split_qkv_input=True)
+    orig_tokens, _ = tokens
+    _, cache = model.run_with_cache(orig_tokens, return_type=None)
+    zero_cache = ActivationCache({name: t.zeros_like(act) for name, act in cache.items()}, model)
+    kwargs = dict(patching_metric=float_metric, direct_includes_mlps=direct_includes_mlps, chunk_size=3, **PATH_PATCH_CASES[case])
+    expected = path_patch(model, orig_tokens, new_cache=zero_cache, **kwargs)
+    assert_results_close(path_patch(model, orig_tokens, new_cache="zero", **kwargs), expected)
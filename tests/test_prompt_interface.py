@@ -0,0 +1,148 @@
+import random
+
+import pytest
+import torch as t
+from tokenizers import Tokenizer, decoders, models, pre_tokenizers, processors, trainers
+from transformers import AutoTokenizer, PreTrainedTokenizerFast
+from transformer_lens import HookedTransformer, HookedTransformerConfig
+
+from utils.prompt_interface import (
+    PrefixCache, PromptFamily, generate_greedy, generate_greedy_batched, generate_outputs, schedule_batches, score_answers_batched,
+    tokenize_prompts,
+)
+
+CORPUS = [
+    "When Mary and John went to the store, John gave a drink to Mary",
+    "Then, Alice and Bob had a long argument. Afterwards Alice said to Bob",
+    "Input: [3, 1, 4, 1, 5]. Output: the largest number in the list is 5",
+    "The quick brown fox jumps over the lazy dog, and then the dog sleeps",
+]
+
+PROMPTS = [
+    "When Mary and John went to the store,",
+    "When Mary and John went to the park,",
+    "Then, Alice and Bob had a",
+    "Input: [3, 1, 4]. Output:",
+    "The quick brown fox",
+]
+
+
+def make_tokenizer(path, prepends_bos: bool) -> PreTrainedTokenizerFast:
+    # A small byte-level BPE tokenizer (like GPT-2's), trained on CORPUS so that the tests don't need to download one.
+    # The special tokens start at id 1, so that neither the padding nor the BOS token is token 0.
+    special_tokens = ["<|unused|>", "<|endoftext|>"] + (["<s>"] if prepends_bos else [])
+    tokenizer = Tokenizer(models.BPE())
+    tokenizer.pre_tokenizer = pre_tokenizers.ByteLevel(add_prefix_space=False)
+    tokenizer.decoder = decoders.ByteLevel()
+    trainer = trainers.BpeTrainer(vocab_size=300, special_tokens=special_tokens, initial_alphabet=pre_tokenizers.ByteLevel.alphabet())
+    tokenizer.train_from_iterator(CORPUS, trainer)
+    if prepends_bos:
+        # Like e.g. Llama's tokenizer, which adds a BOS token to everything it tokenizes
+        tokenizer.post_processor = processors.TemplateProcessing(single="<s> $A", special_tokens=[("<s>", tokenizer.token_to_id("<s>"))])
+        bos_token = "<s>"
+    else:
+        tokenizer.post_processor = processors.ByteLevel(trim_offsets=True)
+        bos_token = "<|endoftext|>"
+    tokenizer = PreTrainedTokenizerFast(tokenizer_object=tokenizer, bos_token=bos_token, eos_token="<|endoftext|>", pad_token="<|endoftext|>")
+    # (`HookedTransformer.set_tokenizer` reloads the tokenizer from its path)
+    tokenizer.save_pretrained(path)
+    return AutoTokenizer.from_pretrained(path)
+
+
+def make_model(tokenizer, default_prepend_bos: bool = True) -> HookedTransformer:
+    cfg = HookedTransformerConfig(
+        n_layers=2, d_model=64, n_ctx=128, d_head=16, n_heads=4, d_mlp=128, d_vocab=len(tokenizer), act_fn="gelu",
+        normalization_type="LN", default_prepend_bos=default_prepend_bos, device="cpu",
+    )
+    t.manual_seed(0)
+    model = HookedTransformer(cfg, tokenizer=tokenizer)
+    with t.no_grad():
+        # Sharper logits, so that greedy generation doesn't depend on tiny numerical differences between batch shapes
+        model.W_U.mul_(8.0)
+    return model.eval()
+
+
+@pytest.fixture(scope="module", params=[False, True], ids=["gpt2_style", "prepends_bos"])
+def tokenizer(request, tmp_path_factory):
+    return make_tokenizer(tmp_path_factory.mktemp("tokenizer"), prepends_bos=request.param)
+
+
+@pytest.mark.parametrize("default_prepend_bos", [True, False])
+def test_tokenize_prompts_matches_to_tokens(tokenizer, default_prepend_bos):
+    model = make_model(tokenizer, default_prepend_bos=default_prepend_bos)
+    assert model.cfg.tokenizer_prepends_bos == (tokenizer.bos_token == "<s>")
+    for prompt, tokens in zip(PROMPTS, tokenize_prompts(model, PROMPTS)):
+        assert tokens == model.to_tokens(prompt)[0].tolist()
+
+
+@pytest.mark.parametrize("share_prefixes", [False, True])
+def test_generate_greedy_batched_matches_generate(tokenizer, share_prefixes):
+    model = make_model(tokenizer)
+    expected = [generate_greedy(model, prompt, max_tokens=8) for prompt in PROMPTS]
+    prefix_cache = PrefixCache(model, min_prefix_len=2) if share_prefixes else None
+    # (the first two prompts share a long prefix, so with share_prefixes that prefix comes from the prefix cache)
+    outputs = generate_greedy_batched(model, PROMPTS[:2], max_tokens=8, prefix_cache=prefix_cache)
+    outputs += generate_greedy_batched(model, PROMPTS[2:], max_tokens=8, prefix_cache=prefix_cache)
+    assert outputs == expected
+
+
+@pytest.mark.parametrize("batch_size, max_batch_tokens", [(32, None), (8, 300), (1, None), (None, 400), (None, 10)])
+def test_schedule_batches_respects_limits(batch_size, max_batch_tokens):
+    rng = random.Random(0)
+    token_lists = [[rng.randrange(5) for _ in range(rng.randrange(1, 40))] for _ in range(200)]
+    batches = schedule_batches(token_lists, max_tokens=10, batch_size=batch_size, max_batch_tokens=max_batch_tokens)
+    assert sorted(i for batch in batches for i in batch) == list(range(200))
+    for batch in batches:
+        assert len(batch) > 0
+        if batch_size is not None:
+            assert len(batch) <= batch_size
+        # (a prompt which is over the budget on its own gets a batch to itself)
+        if max_batch_tokens is not None:
+            assert len(batch) * (max(len(token_lists[i]) for i in batch) + 10) <= max_batch_tokens or len(batch) == 1
+
+
+def test_generate_outputs_in_prompt_order(tokenizer):
+    model = make_model(tokenizer)
+    prompts = PROMPTS * 2
+    random.Random(0).shuffle(prompts)
+    expected = [generate_greedy(model, prompt, max_tokens=8) for prompt in prompts]
+    assert len(set(expected)) > 1
+    assert generate_outputs(model, prompts, max_tokens=8, batch_size=None) == expected
+    for batch_size, max_batch_tokens in [(3, None), (32, 60)]:
+        assert generate_outputs(model, prompts, max_tokens=8, batch_size=batch_size, max_batch_tokens=max_batch_tokens) == expected
+
+
+def test_score_answers_batched_matches_forward(tokenizer):
+    model = make_model(tokenizer)
+    with t.no_grad():
+        # (so that some answer tokens are the model's top prediction)
+        model.b_U[tokenizer.encode(" Bob", add_special_tokens=False)] += 100.0
+    answers = [" John gave a drink", " Bob", " long argument", " the largest", " jumps over the lazy dog"]
+    results = score_answers_batched(model, PROMPTS, answers)
+    assert results[1]["greedy_match"] and not results[0]["greedy_match"]
+    for prompt, answer, result in zip(PROMPTS, answers, results):
+        tokens, prompt_tokens = model.to_tokens(prompt + answer)[0], model.to_tokens(prompt)[0]
+        start = next(i for i, (a, b) in enumerate(zip(tokens.tolist(), prompt_tokens.tolist() + [None])) if a != b)
+        with t.inference_mode():
+            logits = model(tokens.unsqueeze(0))[0, start - 1: -1]
+        logprobs = logits.log_softmax(-1).gather(-1, tokens[start:].unsqueeze(-1)).squeeze(-1)
+        correct = (logits.argmax(-1) == tokens[start:]).tolist()
+        assert result["answer_logprobs"] == pytest.approx(logprobs.tolist(), rel=1e-5, abs=1e-4)
+        assert result["answer_logprob"] == pytest.approx(logprobs.sum().item(), rel=1e-5, abs=1e-4)
+        assert result["greedy_agreement"] == sum(correct) / len(correct)
+        assert result["greedy_match"] == all(correct)
+
+
+
+def test_score_answers_batched_without_answer_tokens(tokenizer):
+    model = make_model(tokenizer)
+    results = score_answers_batched(model, PROMPTS[:2], ["", " John"])
+    assert results[0]["answer_logprobs"] == [] and results[0]["answer_logprob"] == 0.0
+    assert results[0]["greedy_agreement"] == 0.0
+    assert not results[0]["greedy_match"]
+    assert len(results[1]["answer_logprobs"]) > 0
+
+
+def test_score_all_without_cases(tokenizer):
+    family = PromptFamily("test", prompts=[], wraps={})
+    assert family.score_all(make_model(tokenizer)) == []
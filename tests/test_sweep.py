@@ -0,0 +1,44 @@
+import torch as t
+
+from utils.path_patching import IterNode, Node, act_patch, path_patch
+from utils.sweep import act_patch_sweep, path_patch_sweep
+from test_activation_store import make_model
+
+
+# (the model factory and metric are sent to spawned workers, so they have to be defined at the top level of a module)
+def logit_metric(logits):
+    return logits[:, -1].mean().item()
+
+
+def make_tokens():
+    t.manual_seed(1)
+    return t.randint(0, 50, (3, 6)), t.randint(0, 50, (3, 6))
+
+
+def test_act_patch_sweep_matches_act_patch():
+    model = make_model()
+    tokens, new_tokens = make_tokens()
+    expected = act_patch(model, tokens, IterNode(["z", "resid_pre"]), logit_metric, new_input=new_tokens)
+    for chunk_size in [None, 2]:
+        results = act_patch_sweep(
+            make_model, tokens, IterNode(["z", "resid_pre"]), logit_metric, new_input=new_tokens,
+            model=model, n_workers=2, chunk_size=chunk_size,
+        )
+        assert results.keys() == expected.keys()
+        for name in expected:
+            t.testing.assert_close(results[name], expected[name])
+
+
+def test_path_patch_sweep_matches_path_patch():
+    model = make_model()
+    tokens, new_tokens = make_tokens()
+    cases = [
+        dict(sender_nodes=Node("z", layer=0), receiver_nodes=IterNode(["q", "v"])),
+        dict(sender_nodes=IterNode("z"), receiver_nodes=Node("resid_post", layer=1)),
+    ]
+    for kwargs in cases:
+        expected = path_patch(model, tokens, new_tokens, patching_metric=logit_metric, **kwargs)
+        results = path_patch_sweep(make_model, tokens, new_tokens, patching_metric=logit_metric, model=model, n_workers=2, **kwargs)
+        assert results.keys() == expected.keys()
+        for name in expected:
+            t.testing.assert_close(results[name], expected[name])
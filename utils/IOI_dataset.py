@@ -14,8 +14,9 @@ def set_global_seed(seed: int):
     t.cuda.manual_seed(seed)
     t.cuda.manual_seed_all(seed)
 
-set_global_seed(0)
-# TODO - for some reason global seeds still don't work in notebook, ABC dataset is different each time. need to fix this
+# Note - we don't use the global seed for generating datasets (each dataset has its own `random.Random` object, seeded with
+# its `seed` argument), so building datasets doesn't change global state and gives the same result in any thread / process
+# (if you build datasets in several threads, give each thread its own tokenizer, since HF fast tokenizers can't be shared)
 
 NAMES = [
     "Aaron",
@@ -213,6 +214,9 @@ for TEMPLATES in [ABBA_TEMPLATES, ABBA_LATE_IOS, ABBA_EARLY_IOS]:
                 first_clause = False
                 TEMPLATES[i] = TEMPLATES[i][:j] + "B" + TEMPLATES[i][j + 1 :]
 
+# Sorted names (flip plans refer to names by their index in this list)
+FLIP_NAMES = sorted(set(NAMES))
+
 VERBS = [" tried", " said", " decided", " wanted", " gave"]
 
 PLACES = [
@@ -238,33 +242,35 @@ OBJECTS = [
 ]
 
 def gen_prompt_uniform(
-    templates, names, nouns_dict, N, symmetric, prefixes=None, abc=False
+    templates, names, nouns_dict, N, symmetric, prefixes=None, abc=False, rng: Optional[random.Random] = None
 ):
+    # If no random number generator is given, we use the global one
+    rng = random if rng is None else rng
     nb_gen = 0
     ioi_prompts = []
     while nb_gen < N:
-        temp = random.choice(templates)
+        temp = rng.choice(templates)
         temp_id = templates.index(temp)
         name_1 = ""
         name_2 = ""
         name_3 = ""
         while len(set([name_1, name_2, name_3])) < 3:
-            name_1 = random.choice(names)
-            name_2 = random.choice(names)
-            name_3 = random.choice(names)
+            name_1 = rng.choice(names)
+            name_2 = rng.choice(names)
+            name_3 = rng.choice(names)
 
         nouns = {}
         ioi_prompt = {}
         for k in nouns_dict:
-            nouns[k] = random.choice(nouns_dict[k])
+            nouns[k] = rng.choice(nouns_dict[k])
             ioi_prompt[k] = nouns[k]
         prompt = temp
         for k in nouns_dict:
             prompt = prompt.replace(k, nouns[k])
 
         if prefixes is not None:
-            L = random.randint(30, 40)
-            pref = ".".join(random.choice(prefixes).split(".")[:L])
+            L = rng.randint(30, 40)
+            pref = ".".join(rng.choice(prefixes).split(".")[:L])
             pref += "<|endoftext|>"
         else:
             pref = ""
@@ -295,7 +301,7 @@ def gen_prompt_uniform(
     return ioi_prompts
     
 
-def gen_flipped_prompts(prompts: List[dict], templates_by_prompt: List[str], flip: str, names: List[str], seed: int) -> List[dict]:
+def gen_flipped_prompts(prompts: List[dict], templates_by_prompt: List[str], flip: str, names: List[str], seed: int, rng: Optional[random.Random] = None) -> List[dict]:
     '''
     Flip prompts in a way described by the flip argument. Returns new prompts.
 
@@ -312,7 +318,10 @@ def gen_flipped_prompts(prompts: List[dict], templates_by_prompt: List[str], fli
         list of names, for when flip involves random tokens
 
     seed: int
-        provides reproducibility
+        provides reproducibility (we use it to seed a new random number generator, unless `rng` is given)
+
+    rng: Optional[random.Random]
+        random number generator for the random names (this function doesn't use or change the global random state)
 
     Note that we don't bother flipping the last token in the prompt (IO2), since
     we don't use it for anything (intuitively, we use this function to create 
@@ -320,7 +329,7 @@ def gen_flipped_prompts(prompts: List[dict], templates_by_prompt: List[str], fli
     the original uncorrupted IOI database as our "correct answer", so we don't 
     care about what the correct answer (IO2) for the corrupted set is).
     '''
-    set_global_seed(seed)
+    rng = random.Random(seed) if rng is None else rng
 
     abba_flip, baba_flip = flip.split(",")
     flip_dict = {
@@ -356,11 +365,11 @@ def gen_flipped_prompts(prompts: List[dict], templates_by_prompt: List[str], fli
         assert len(orig_names_key) == len(set(flip_orig))
         
         # Get all random names we'll need, in the form of a dictionary
-        # set_global_seed(seed + idx)
+        # (we sort the letters, because the iteration order of a set of strings changes between Python processes)
         name_choices = sorted(list(set(names) - set(orig_names)))
         rand_names = {
-            letter: random.choice(name_choices)
-            for letter in set(flip_new) - set(flip_orig)
+            letter: rng.choice(name_choices)
+            for letter in sorted(set(flip_new) - set(flip_orig))
         }
         
         # Get a "full dictionary" which maps letters in flip_new to the new values they will have
@@ -393,57 +402,74 @@ def gen_flipped_prompts(prompts: List[dict], templates_by_prompt: List[str], fli
 
 
 
-def get_name_idxs(prompts, tokenizer, idx_types=["IO", "S1", "S2"], prepend_bos=False):
-    name_idx_dict = dict((idx_type, []) for idx_type in idx_types)
-    for prompt in prompts:
-        text_split = prompt["text"].split(" ")
-        toks = tokenizer.tokenize(" ".join(text_split[:-1]))
+def tokenize_prompts(prompts, tokenizer, prepend_bos=False):
+    """Tokenizes all the prompts in a single batch. Returns the (right-padded) tokens and the attention mask."""
+    texts = [(tokenizer.bos_token if prepend_bos else "") + prompt["text"] for prompt in prompts]
+    tokenized = tokenizer(texts, padding=True, return_tensors="pt")
+    return tokenized["input_ids"].long(), tokenized["attention_mask"]
+
+
+def get_name_token_ids(tokenizer, names):
+    """Table of name -> token ID of " " + name (the first token, if it's more than one), with one tokenizer call for all names."""
+    names = sorted(set(names))
+    return {name: ids[0] for name, ids in zip(names, tokenizer([" " + name for name in names], add_special_tokens=False)["input_ids"])}
+
+
+def get_match_idxs(matches, last=False):
+    """Given a boolean tensor of shape (batch, pos), returns the first (or last) position of a match in each row."""
+    if not matches.any(-1).all():
+        raise ValueError(f"No match found in rows {(~matches.any(-1)).nonzero().squeeze(-1).tolist()}")
+    if last:
+        return matches.shape[-1] - 1 - matches.flip(-1).int().argmax(-1)
+    return matches.int().argmax(-1)
+
+
+def get_name_idxs(prompts, tokenizer, idx_types=["IO", "S1", "S2"], prepend_bos=False, toks=None, attention_mask=None):
+    if (toks is None) or (attention_mask is None):
+        toks, attention_mask = tokenize_prompts(prompts, tokenizer, prepend_bos)
+    name_token_ids = get_name_token_ids(tokenizer, [prompt["IO"] for prompt in prompts] + [prompt["S"] for prompt in prompts])
+    IO_ids = t.tensor([name_token_ids[prompt["IO"]] for prompt in prompts])
+    S_ids = t.tensor([name_token_ids[prompt["S"]] for prompt in prompts])
+
+    # We only look for names before the last word (because that's the IO token we're predicting). We get its length by
+    # tokenizing the unique last words, rather than the whole prompt without it
+    last_words = [prompt["text"].split(" ")[-1] for prompt in prompts]
+    unique_last_words = sorted(set(last_words))
+    last_word_lens = dict(zip(unique_last_words, map(len, tokenizer([" " + word for word in unique_last_words], add_special_tokens=False)["input_ids"])))
+    prefix_lens = attention_mask.sum(-1) - t.tensor([last_word_lens[word] for word in last_words])
+    valid = t.arange(toks.shape[-1]) < prefix_lens.unsqueeze(-1)
+
+    name_idx_dict = {
         # Get the first instance of IO token
-        name_idx_dict["IO"].append(
-            toks.index(tokenizer.tokenize(" " + prompt["IO"])[0])
-        )
+        "IO": get_match_idxs((toks == IO_ids.unsqueeze(-1)) & valid),
         # Get the first instance of S token
-        name_idx_dict["S1"].append(
-            toks.index(tokenizer.tokenize(" " + prompt["S"])[0])
-        )
+        "S1": get_match_idxs((toks == S_ids.unsqueeze(-1)) & valid),
         # Get the last instance of S token
-        name_idx_dict["S2"].append(
-            len(toks) - toks[::-1].index(tokenizer.tokenize(" " + prompt["S"])[0]) - 1
-        )
-
-    return [
-        int(prepend_bos) + t.tensor(name_idx_dict[idx_type])
-        for idx_type in idx_types
-    ]
+        "S2": get_match_idxs((toks == S_ids.unsqueeze(-1)) & valid, last=True),
+    }
+    # (toks already includes the BOS token if prepend_bos, so we don't need to add it)
+    return [name_idx_dict[idx_type] for idx_type in idx_types]
 
 
-def get_word_idxs(prompts, word_list, tokenizer):
+def get_word_idxs(prompts, word_list, tokenizer, toks=None, attention_mask=None, prepend_bos=False):
     """Get the index of the words in word_list in the prompts. Exactly one of the word_list word has to be present in each prompt"""
-    idxs = []
-    tokenized_words = [
-        tokenizer.decode(tokenizer(word)["input_ids"][0]) for word in word_list
-    ]
-    for prompt in prompts:
-        toks = [
-            tokenizer.decode(t)
-            for t in tokenizer(prompt["text"], return_tensors="pt", padding=True)[
-                "input_ids"
-            ][0]
-        ]
-        idx = None
-        for i, w_tok in enumerate(tokenized_words):
-            if word_list[i] in prompt["text"]:
-                try:
-                    idx = toks.index(w_tok)
-                    if toks.count(w_tok) > 1:
-                        idx = len(toks) - toks[::-1].index(w_tok) - 1
-                except:
-                    idx = toks.index(w_tok)
-                    # raise ValueError(toks, w_tok, prompt["text"])
-        if idx is None:
-            raise ValueError(f"Word {word_list} and {i} not found {prompt}")
-        idxs.append(idx)
-    return t.tensor(idxs)
+    if (toks is None) or (attention_mask is None):
+        toks, attention_mask = tokenize_prompts(prompts, tokenizer, prepend_bos)
+    # These indices are relative to the prompt text (i.e. not counting the BOS token)
+    valid = attention_mask.bool() & (t.arange(toks.shape[-1]) >= int(prepend_bos))
+
+    idxs = t.full((len(prompts),), -1)
+    for word in word_list:
+        word_id = tokenizer(word)["input_ids"][0]
+        in_prompt = t.tensor([word in prompt["text"] for prompt in prompts])
+        matches = (toks == word_id) & valid
+        if (in_prompt & ~matches.any(-1)).any():
+            raise ValueError(f"Word {word!r} is in the text but not the tokens of prompts {(in_prompt & ~matches.any(-1)).nonzero().squeeze(-1).tolist()}")
+        # Later words in word_list take priority, and we take the last instance of the word
+        idxs = t.where(in_prompt, toks.shape[-1] - 1 - matches.flip(-1).int().argmax(-1), idxs)
+    if (idxs < 0).any():
+        raise ValueError(f"Words {word_list} not found in prompts {(idxs < 0).nonzero().squeeze(-1).tolist()}")
+    return idxs - int(prepend_bos)
 
 
 def get_end_idxs(toks, tokenizer, name_tok_len=1, prepend_bos=False):
@@ -453,39 +479,36 @@ def get_end_idxs(toks, tokenizer, name_tok_len=1, prepend_bos=False):
     # then we need make special arrangements
 
     pad_token_id = tokenizer.pad_token_id
-
-    end_idxs_raw = []
-    for i in range(toks.shape[0]):
-        if pad_token_id not in toks[i][1:]:
-            end_idxs_raw.append(toks.shape[1])
-            continue
-        nonzers = (toks[i] == pad_token_id).nonzero()[relevant_idx][0].item()
-        end_idxs_raw.append(nonzers)
-    end_idxs = t.tensor(end_idxs_raw)
-    end_idxs = end_idxs - 1 - name_tok_len
-
-    for i in range(toks.shape[0]):
-        assert toks[i][end_idxs[i] + 1] != 0 and (
-            toks.shape[1] == end_idxs[i] + 2 or toks[i][end_idxs[i] + 2] == pad_token_id
-        ), (
-            toks[i],
-            end_idxs[i],
-            toks[i].shape,
-            "the END idxs aren't properly formatted",
-        )
+    batch_size, seq_len = toks.shape
+
+    # End is the (relevant_idx)-th pad token, or the end of the sequence if there's no padding
+    is_pad = toks == pad_token_id
+    nth_pad_idxs = (is_pad & (is_pad.cumsum(-1) == relevant_idx + 1)).int().argmax(-1)
+    end_idxs_raw = t.where(is_pad[:, 1:].any(-1), nth_pad_idxs, seq_len)
+    end_idxs = end_idxs_raw - 1 - name_tok_len
+
+    rows = t.arange(batch_size)
+    next_is_end = (end_idxs + 2 == seq_len) | (toks[rows, (end_idxs + 2).clamp(max=seq_len - 1)] == pad_token_id)
+    assert ((toks[rows, end_idxs + 1] != 0) & next_is_end).all(), (
+        toks[~next_is_end],
+        end_idxs[~next_is_end],
+        "the END idxs aren't properly formatted",
+    )
 
     return end_idxs
 
 
+def get_idx_dict(ioi_prompts, tokenizer, prepend_bos=False, toks=None, attention_mask=None):
+    if (toks is None) or (attention_mask is None):
+        toks, attention_mask = tokenize_prompts(ioi_prompts, tokenizer, prepend_bos)
 
-
-
-def get_idx_dict(ioi_prompts, tokenizer, prepend_bos=False, toks=None):
     (IO_idxs, S1_idxs, S2_idxs,) = get_name_idxs(
         ioi_prompts,
         tokenizer,
         idx_types=["IO", "S1", "S2"],
         prepend_bos=prepend_bos,
+        toks=toks,
+        attention_mask=attention_mask,
     )
 
     end_idxs = get_end_idxs(
@@ -495,7 +518,7 @@ def get_idx_dict(ioi_prompts, tokenizer, prepend_bos=False, toks=None):
         prepend_bos=prepend_bos,
     )
 
-    punct_idxs = get_word_idxs(ioi_prompts, [",", "."], tokenizer)
+    punct_idxs = get_word_idxs(ioi_prompts, [",", "."], tokenizer, toks=toks, attention_mask=attention_mask, prepend_bos=prepend_bos)
 
     return {
         "IO": IO_idxs,
@@ -511,6 +534,150 @@ def get_idx_dict(ioi_prompts, tokenizer, prepend_bos=False, toks=None):
     }
 
 
+def get_tokenized_prompts(toks, tokenizer):
+    """Each prompt as a string of "|"-separated tokens. We decode each unique token once, rather than every token separately."""
+    unique_toks, inverse = t.unique(toks, return_inverse=True)
+    decoded = np.array([tokenizer.decode(tok) for tok in unique_toks.tolist()], dtype=object)[inverse.numpy()]
+    return ["|".join(row) for row in decoded]
+
+
+def get_templates_by_prompt(prompts):
+    """For each prompt, whether it's ABBA or BABA (i.e. whether the IO or S name comes first)."""
+    return ["ABBA" if prompt["text"].index(prompt["IO"]) < prompt["text"].index(prompt["S"]) else "BABA" for prompt in prompts]
+
+
+def get_template_groups(prompts):
+    """Groups of prompt indices which use the same template."""
+    all_ids_ar = np.array([prompt["TEMPLATE_IDX"] for prompt in prompts])
+    return [np.where(all_ids_ar == id)[0] for id in list(set(all_ids_ar.tolist()))]
+
+
+def get_substituted_toks(toks, name_posns, orig_prompts, new_prompts, tokenizer, names=NAMES):
+    """
+    Returns `toks` with the first three names of each of `orig_prompts` (which are at the token positions `name_posns`)
+    replaced by the first three names of `new_prompts`. This is how we get the tokens of flipped prompts without re-tokenizing
+    them, since the flips only change these names.
+
+    Returns None if we can't do this by swapping tokens, i.e. if a name is more than one token, or the names aren't at
+    `name_posns` (e.g. for ABC prompts, where the third name isn't S2).
+    """
+    orig_names = [[word for word in prompt["text"].split(" ") if word in names][:3] for prompt in orig_prompts]
+    new_names = [[word for word in prompt["text"].split(" ") if word in names][:3] for prompt in new_prompts]
+    if any(len(names_) != 3 for names_ in orig_names + new_names):
+        return None
+
+    all_names = sorted(set(name for names_ in orig_names + new_names for name in names_))
+    name_toks = tokenizer([" " + name for name in all_names], add_special_tokens=False)["input_ids"]
+    if any(len(tok) != 1 for tok in name_toks):
+        return None
+    name_token_ids = {name: tok[0] for name, tok in zip(all_names, name_toks)}
+
+    name_posns = name_posns.to(toks.device)
+    orig_ids = t.tensor([[name_token_ids[name] for name in names_] for names_ in orig_names], device=toks.device)
+    if not (toks.gather(1, name_posns) == orig_ids).all():
+        return None
+    new_ids = t.tensor([[name_token_ids[name] for name in names_] for names_ in new_names], device=toks.device)
+    return toks.scatter(1, name_posns, new_ids)
+
+
+def get_templates(prompt_type: Union[str, List[str]], nb_templates: Optional[int], rng: random.Random) -> List[str]:
+    """The templates for this prompt type (`rng` shuffles the mixed ones)."""
+    if nb_templates is None:
+        nb_templates = len(BABA_TEMPLATES)
+
+    if prompt_type == "ABBA":
+        templates = ABBA_TEMPLATES[:nb_templates].copy()
+    elif prompt_type == "BABA":
+        templates = BABA_TEMPLATES[:nb_templates].copy()
+    elif prompt_type == "mixed":
+        templates = (
+            BABA_TEMPLATES[: nb_templates // 2].copy()
+            + ABBA_TEMPLATES[: nb_templates // 2].copy()
+        )
+        rng.shuffle(templates)
+    elif prompt_type == "ABC":
+        templates = ABC_TEMPLATES[:nb_templates].copy()
+    elif prompt_type == "BAC":
+        templates = BAC_TEMPLATES[:nb_templates].copy()
+    elif prompt_type == "ABC mixed":
+        templates = (
+            ABC_TEMPLATES[: nb_templates // 2].copy()
+            + BAC_TEMPLATES[: nb_templates // 2].copy()
+        )
+        rng.shuffle(templates)
+    elif isinstance(prompt_type, list):
+        templates = prompt_type
+    else:
+        raise ValueError(prompt_type)
+    return templates
+
+
+class FlipPlan:
+    '''
+    A flip string (e.g. "ABB -> XYZ, BAB -> XYZ", see `gen_flipped_prompts`) compiled into index arrays, so it can be applied
+    to all the prompts in a dataset at once, rather than being parsed again for every prompt.
+
+    For each template type ("ABB" or "BAB") and each of the three names in the flipped prompt, `sources` says where the new
+    name comes from: i >= 0 means it's the i-th orig name, and -1-j means it's the j-th random name. `s_posns` and `io_posns`
+    say which of the three new names become the S and IO names (same rules as `gen_flipped_prompts`).
+
+    Usage:
+        plan = FlipPlan("ABB -> XYZ, BAB -> XYZ")
+        abc_dataset = ioi_dataset.gen_flipped_prompts(plan)
+    '''
+    def __init__(self, flip: str):
+        self.flip = flip
+        abba_flip, baba_flip = flip.split(",")
+        self.sources, self.n_random, self.s_posns, self.io_posns = {}, {}, {}, {}
+
+        for template, template_flip in zip(["ABB", "BAB"], [abba_flip, baba_flip]):
+            flip_orig, flip_new = [f.strip() for f in template_flip.split("->")]
+            assert len(flip_orig) == len(flip_new) == 3, f"Invalid flip {template_flip!r}, should be of the form 'ABB -> XYZ'."
+            # (if a letter appears more than once in flip_orig, we use its last appearance, same as `gen_flipped_prompts`)
+            random_letters = sorted(set(flip_new) - set(flip_orig))
+            self.sources[template] = np.array([
+                flip_orig.rindex(letter) if letter in flip_orig else -1 - random_letters.index(letter)
+                for letter in flip_new
+            ])
+            self.n_random[template] = len(random_letters)
+            # S is the last name. IO is the unique non-duplicated name of the first two (or the second name if there isn't one)
+            self.s_posns[template] = 2
+            possible_IOs = [i for i, letter in enumerate(flip_new[:2]) if flip_new.count(letter) == 1]
+            self.io_posns[template] = possible_IOs[0] if len(possible_IOs) == 1 else 1
+
+    def apply(self, orig_names: np.ndarray, templates_by_prompt: List[str], n_names: int, rng: np.random.Generator):
+        '''
+        Given orig_names, an array of shape (N, 3) of indices into the list of names (the first three names in each prompt),
+        returns the indices of the new names, and of the new S and IO names.
+
+        Random names are drawn uniformly from all names except the orig ones, in one vectorized pass: we draw an index into
+        the list of non-excluded names, then shift it past each excluded name (in ascending order) which it's not below.
+        '''
+        N = orig_names.shape[0]
+        templates = np.array([template[:-1] for template in templates_by_prompt])
+        assert np.isin(templates, list(self.sources)).all(), "All prompts should be ABBA or BABA to use a flip plan."
+
+        # Get the random names (excluding orig names for each prompt)
+        sorted_orig = np.sort(orig_names, axis=-1)
+        is_new = np.concatenate([np.ones((N, 1), dtype=bool), sorted_orig[:, 1:] != sorted_orig[:, :-1]], axis=-1)
+        n_random = max(self.n_random.values())
+        rand_names = rng.integers(0, n_names - is_new.sum(-1, keepdims=True), size=(N, n_random))
+        for i in range(3):
+            rand_names += is_new[:, [i]] & (rand_names >= sorted_orig[:, [i]])
+
+        new_names = np.zeros_like(orig_names)
+        s_names = np.zeros(N, dtype=orig_names.dtype)
+        io_names = np.zeros(N, dtype=orig_names.dtype)
+        for template, sources in self.sources.items():
+            rows = templates == template
+            for i, source in enumerate(sources):
+                new_names[rows, i] = orig_names[rows, source] if source >= 0 else rand_names[rows, -1 - source]
+            s_names[rows] = new_names[rows, self.s_posns[template]]
+            io_names[rows] = new_names[rows, self.io_posns[template]]
+
+        return new_names, s_names, io_names
+
+
 
 
 
@@ -532,7 +699,7 @@ class IOIDataset:
         device="cuda"
     ):
         self.seed = seed
-        set_global_seed(seed)
+        rng = random.Random(seed)
         if not (
             N == 1
             or prepend_bos == False
@@ -546,33 +713,7 @@ class IOIDataset:
         ), f"{symmetric} {N}"
         self.prompt_type = prompt_type
 
-        if nb_templates is None:
-            nb_templates = len(BABA_TEMPLATES)
-
-        if prompt_type == "ABBA":
-            self.templates = ABBA_TEMPLATES[:nb_templates].copy()
-        elif prompt_type == "BABA":
-            self.templates = BABA_TEMPLATES[:nb_templates].copy()
-        elif prompt_type == "mixed":
-            self.templates = (
-                BABA_TEMPLATES[: nb_templates // 2].copy()
-                + ABBA_TEMPLATES[: nb_templates // 2].copy()
-            )
-            random.shuffle(self.templates)
-        elif prompt_type == "ABC":
-            self.templates = ABC_TEMPLATES[:nb_templates].copy()
-        elif prompt_type == "BAC":
-            self.templates = BAC_TEMPLATES[:nb_templates].copy()
-        elif prompt_type == "ABC mixed":
-            self.templates = (
-                ABC_TEMPLATES[: nb_templates // 2].copy()
-                + BAC_TEMPLATES[: nb_templates // 2].copy()
-            )
-            random.shuffle(self.templates)
-        elif isinstance(prompt_type, list):
-            self.templates = prompt_type
-        else:
-            raise ValueError(prompt_type)
+        self.templates = get_templates(prompt_type, nb_templates, rng)
 
         if tokenizer is None:
             self.tokenizer = AutoTokenizer.from_pretrained("gpt2")
@@ -591,111 +732,217 @@ class IOIDataset:
                 symmetric=symmetric,
                 prefixes=self.prefixes,
                 abc=(prompt_type in ["ABC", "ABC mixed", "BAC"]),
+                rng=rng,
             )
         else:
             assert N == len(prompts), f"{N} and {len(prompts)}"
             self.ioi_prompts = prompts
 
-        all_ids = [prompt["TEMPLATE_IDX"] for prompt in self.ioi_prompts]
-        all_ids_ar = np.array(all_ids)
-        self.groups = []
-        for id in list(set(all_ids)):
-            self.groups.append(np.where(all_ids_ar == id)[0])
-
-        small_groups = []
-        for group in self.groups:
-            if len(group) < 5:
-                small_groups.append(len(group))
+        self.groups = get_template_groups(self.ioi_prompts)
 
         self.sentences = [
             prompt["text"] for prompt in self.ioi_prompts
         ]  # a list of strings. Renamed as this should NOT be forward passed
 
-        self.templates_by_prompt = []  # for each prompt if it's ABBA or BABA
-        for i in range(N):
-            if self.sentences[i].index(self.ioi_prompts[i]["IO"]) < self.sentences[i].index(self.ioi_prompts[i]["S"]):
-                self.templates_by_prompt.append("ABBA")
-            else:
-                self.templates_by_prompt.append("BABA")
+        self.templates_by_prompt = get_templates_by_prompt(self.ioi_prompts)  # for each prompt if it's ABBA or BABA
 
-        texts = [
-            (self.tokenizer.bos_token if prepend_bos else "") + prompt["text"]
-            for prompt in self.ioi_prompts
-        ]
-        self.toks = t.Tensor(self.tokenizer(texts, padding=True).input_ids).long()
+        # Tokenize everything once, and compute all the word indices from these tokens
+        self.toks, attention_mask = tokenize_prompts(self.ioi_prompts, self.tokenizer, prepend_bos)
 
         self.word_idx = get_idx_dict(
             self.ioi_prompts,
             self.tokenizer,
             prepend_bos=prepend_bos,
             toks=self.toks,
+            attention_mask=attention_mask,
         )
         self.prepend_bos = prepend_bos
         if manual_word_idx is not None:
             self.word_idx = manual_word_idx
 
         self.N = N
-        self.max_len = max([
-            len(self.tokenizer(prompt["text"]).input_ids)
-            for prompt in self.ioi_prompts
-        ])
+        self.seq_lens = attention_mask.sum(-1)
+        self.max_len = self.seq_lens.max().item() - int(prepend_bos)
 
-        self.io_tokenIDs = [self.tokenizer.encode(" " + prompt["IO"])[0] for prompt in self.ioi_prompts]
-        self.s_tokenIDs = [self.tokenizer.encode(" " + prompt["S"])[0] for prompt in self.ioi_prompts]
+        name_token_ids = get_name_token_ids(self.tokenizer, [prompt["IO"] for prompt in self.ioi_prompts] + [prompt["S"] for prompt in self.ioi_prompts])
+        self.io_tokenIDs = [name_token_ids[prompt["IO"]] for prompt in self.ioi_prompts]
+        self.s_tokenIDs = [name_token_ids[prompt["S"]] for prompt in self.ioi_prompts]
 
-        self.tokenized_prompts = []
-
-        for i in range(self.N):
-            self.tokenized_prompts.append(
-                "|".join([self.tokenizer.decode(tok) for tok in self.toks[i]])
-            )
+        self.tokenized_prompts = get_tokenized_prompts(self.toks, self.tokenizer)
 
         self.device = device
         self.to(device)
     
-    def gen_flipped_prompts(self, flip):
+    def get_flip_names(self):
+        """
+        Returns the word positions (in the text) and token positions of the first three names in each prompt, and their
+        indices in `FLIP_NAMES`. This is what `gen_flipped_prompts` needs to apply a `FlipPlan`, and we only compute it once per
+        dataset (so generating lots of different flips is cheap).
+
+        Returns None if we can't apply flip plans to this dataset (e.g. if the names aren't single tokens, or aren't at the
+        IO / S1 / S2 positions, like for ABC prompts). Then flips fall back to `gen_flipped_prompts` on each prompt.
+        """
+        if not hasattr(self, "_flip_names"):
+            self._flip_names = self._get_flip_names()
+        return self._flip_names
+
+    def _get_flip_names(self):
+        name_toks = self.tokenizer([" " + name for name in FLIP_NAMES], add_special_tokens=False)["input_ids"]
+        if any(len(tok) != 1 for tok in name_toks):
+            return None
+        name_token_ids = t.tensor([tok[0] for tok in name_toks])
+
+        names_set = set(FLIP_NAMES)
+        name_idx = {name: i for i, name in enumerate(FLIP_NAMES)}
+        word_posns, orig_names = [], []
+        for prompt in self.ioi_prompts:
+            words = prompt["text"].split(" ")
+            posns = [i for i, word in enumerate(words) if word in names_set][:3]
+            if len(posns) != 3:
+                return None
+            word_posns.append(posns)
+            orig_names.append([name_idx[words[i]] for i in posns])
+        word_posns, orig_names = np.array(word_posns), np.array(orig_names)
+
+        # Check the names are where we expect them to be in the tokens
+        token_posns = t.stack([self.word_idx["IO"], self.word_idx["S1"], self.word_idx["S2"]], dim=-1).sort(dim=-1).values
+        if not (self.toks.cpu().gather(1, token_posns) == name_token_ids[t.from_numpy(orig_names)]).all():
+            return None
+
+        return word_posns, token_posns, orig_names, name_token_ids
+
+    def gen_flipped_prompts(self, flip: Union[str, FlipPlan]):
+        """
+        Returns a new dataset with the prompts flipped according to `flip` (see the `gen_flipped_prompts` function). This
+        can be a flip string, or a `FlipPlan` (if we're using the same flip on lots of datasets).
+        """
         # Check if it's already been flipped (shouldn't string 2 flips together)
         if self.has_been_flipped:
             warnings.warn("This dataset has already been flipped. Generally, you should try and apply flips in one step, because this can lead to errors.")
+        plan = flip if isinstance(flip, FlipPlan) else FlipPlan(flip)
 
         # Redefine seed (so it's different depending on what the flip is, e.g. we don't want (IO, RAND) then (S, RAND) to give us the same rand names)
-        seed = self.seed + sum(map(ord, list("".join(flip))))
-        
-        # Get flipped prompts
+        seed = self.seed + sum(map(ord, list("".join(plan.flip))))
+
+        flip_names = self.get_flip_names()
+        if flip_names is None:
+            return self.gen_flipped_prompts_per_prompt(plan.flip, seed)
+        word_posns, token_posns, orig_names, name_token_ids = flip_names
+
+        # Get all the new names at once, then put them into the text and tokens
+        new_names, s_names, io_names = plan.apply(orig_names, self.templates_by_prompt, len(FLIP_NAMES), np.random.default_rng(seed))
+        flipped_prompts = []
+        for prompt, posns, names, s_name, io_name in zip(self.ioi_prompts, word_posns.tolist(), new_names.tolist(), s_names.tolist(), io_names.tolist()):
+            words = prompt["text"].split(" ")
+            for posn, name in zip(posns, names):
+                words[posn] = FLIP_NAMES[name]
+            flipped_prompts.append({**prompt, "text": " ".join(words), "S": FLIP_NAMES[s_name], "IO": FLIP_NAMES[io_name]})
+        new_names, s_names, io_names = map(t.from_numpy, (new_names, s_names, io_names))
+        flipped_toks = self.toks.scatter(1, token_posns.to(self.toks.device), name_token_ids[new_names].to(self.toks.device))
+
+        flipped_ioi_dataset = self._replace(
+            ioi_prompts=flipped_prompts,
+            sentences=[prompt["text"] for prompt in flipped_prompts],
+            templates_by_prompt=get_templates_by_prompt(flipped_prompts),
+            toks=flipped_toks,
+            io_tokenIDs=name_token_ids[io_names].tolist(),
+            s_tokenIDs=name_token_ids[s_names].tolist(),
+            tokenized_prompts=get_tokenized_prompts(flipped_toks.cpu(), self.tokenizer),
+            has_been_flipped=True,
+            seed=seed,
+        )
+        return flipped_ioi_dataset
+
+    def gen_flipped_prompts_per_prompt(self, flip: str, seed: int):
+        """Flips the prompts one at a time with the `gen_flipped_prompts` function (for datasets which flip plans don't work on)."""
         flipped_prompts = gen_flipped_prompts(self.ioi_prompts, self.templates_by_prompt, flip, NAMES, seed)
 
-        flipped_ioi_dataset = IOIDataset(
-            prompt_type=self.prompt_type,
-            N=self.N,
-            tokenizer=self.tokenizer,
-            prompts=flipped_prompts,
-            prefixes=self.prefixes,
-            prepend_bos=self.prepend_bos,
-            manual_word_idx=self.word_idx,
+        # The flip only changes the first three names (which are at the IO, S1 and S2 positions), so we can usually just swap
+        # those tokens rather than tokenizing everything again
+        name_posns = t.stack([self.word_idx["IO"], self.word_idx["S1"], self.word_idx["S2"]], dim=-1).sort(dim=-1).values
+        flipped_toks = get_substituted_toks(self.toks, name_posns, self.ioi_prompts, flipped_prompts, self.tokenizer)
+        if flipped_toks is None:
+            return IOIDataset(
+                prompt_type=self.prompt_type,
+                N=self.N,
+                tokenizer=self.tokenizer,
+                prompts=flipped_prompts,
+                prefixes=self.prefixes,
+                prepend_bos=self.prepend_bos,
+                manual_word_idx=self.word_idx,
+                has_been_flipped=True,
+                seed=seed,
+                device=self.device,
+            )
+
+        name_token_ids = get_name_token_ids(self.tokenizer, [prompt["IO"] for prompt in flipped_prompts] + [prompt["S"] for prompt in flipped_prompts])
+        flipped_ioi_dataset = self._replace(
+            ioi_prompts=flipped_prompts,
+            sentences=[prompt["text"] for prompt in flipped_prompts],
+            templates_by_prompt=get_templates_by_prompt(flipped_prompts),
+            toks=flipped_toks,
+            io_tokenIDs=[name_token_ids[prompt["IO"]] for prompt in flipped_prompts],
+            s_tokenIDs=[name_token_ids[prompt["S"]] for prompt in flipped_prompts],
+            tokenized_prompts=get_tokenized_prompts(flipped_toks.cpu(), self.tokenizer),
             has_been_flipped=True,
-            seed=seed
+            seed=seed,
         )
         return flipped_ioi_dataset
 
+    def _replace(self, **fields):
+        """Returns a shallow copy of this dataset with some fields replaced, so we don't need to tokenize anything again."""
+        dataset = copy.copy(self)
+        dataset.__dict__.update(fields)
+        # (the cached name positions are for our prompts, not the new ones)
+        dataset.__dict__.pop("_flip_names", None)
+        return dataset
+
     def copy(self):
-        copy_ioi_dataset = IOIDataset(
-            prompt_type=self.prompt_type,
-            N=self.N,
-            tokenizer=self.tokenizer,
-            prompts=self.ioi_prompts.copy(),
+        copy_ioi_dataset = self._replace(
+            ioi_prompts=[copy.copy(prompt) for prompt in self.ioi_prompts],
+            sentences=self.sentences.copy(),
+            templates_by_prompt=self.templates_by_prompt.copy(),
+            groups=[group.copy() for group in self.groups],
+            toks=self.toks.clone(),
+            seq_lens=self.seq_lens.clone(),
+            word_idx={k: v.clone() for k, v in self.word_idx.items()},
+            io_tokenIDs=self.io_tokenIDs.copy(),
+            s_tokenIDs=self.s_tokenIDs.copy(),
+            tokenized_prompts=self.tokenized_prompts.copy(),
             prefixes=self.prefixes.copy() if self.prefixes is not None else self.prefixes,
         )
         return copy_ioi_dataset
 
     def __getitem__(self, key):
-        sliced_prompts = self.ioi_prompts[key]
-        sliced_dataset = IOIDataset(
-            prompt_type=self.prompt_type,
-            N=len(sliced_prompts),
-            tokenizer=self.tokenizer,
-            prompts=sliced_prompts,
-            prefixes=self.prefixes,
-            prepend_bos=self.prepend_bos,
+        """
+        Returns the prompts indexed by `key` (an int, slice, or list / array / tensor of indices) as a dataset. Rather than
+        building a new dataset from the sliced prompts, we index into the tokens, word_idx etc (if `key` is a slice then the
+        tensors are views of ours).
+        """
+        if isinstance(key, int):
+            key = [key]
+        idxs = np.arange(self.N)[key.cpu().numpy() if isinstance(key, t.Tensor) else key]
+        tensor_key = key if isinstance(key, slice) else t.from_numpy(idxs)
+
+        # Remove any padding which is only there because of prompts which aren't in the slice
+        seq_lens = self.seq_lens[tensor_key]
+        max_seq_len = seq_lens.max().item() if len(idxs) > 0 else 0
+        sliced_prompts = [self.ioi_prompts[i] for i in idxs]
+        sliced_toks = self.toks[tensor_key.to(self.toks.device) if isinstance(tensor_key, t.Tensor) else tensor_key, :max_seq_len]
+
+        sliced_dataset = self._replace(
+            ioi_prompts=sliced_prompts,
+            sentences=[self.sentences[i] for i in idxs],
+            templates_by_prompt=[self.templates_by_prompt[i] for i in idxs],
+            groups=get_template_groups(sliced_prompts),
+            toks=sliced_toks,
+            seq_lens=seq_lens,
+            word_idx={k: v[tensor_key] for k, v in self.word_idx.items()},
+            io_tokenIDs=[self.io_tokenIDs[i] for i in idxs],
+            s_tokenIDs=[self.s_tokenIDs[i] for i in idxs],
+            tokenized_prompts=get_tokenized_prompts(sliced_toks.cpu(), self.tokenizer),
+            N=len(idxs),
+            max_len=max_seq_len - int(self.prepend_bos),
         )
         return sliced_dataset
 
@@ -714,3 +961,125 @@ class IOIDataset:
     def to(self, device):
         self.toks = self.toks.to(device)
         return self
+
+
+class IOIPromptStream:
+    '''
+    Streaming source of IOI prompts, for when we want more prompts than fit in memory (or than we want to tokenize up front).
+
+    Rather than building one big `IOIDataset`, we generate batches on demand: batch `i` is a small `IOIDataset` of `batch_size`
+    prompts (with its own `toks`, `word_idx`, `io_tokenIDs` etc). Each prompt is generated with a seed which only depends on
+    `seed` and the prompt's index in the stream (for symmetric prompts, the index of the pair), so any batch can be regenerated
+    on its own (e.g. `stream[i]`) without generating the batches before it, and the stream is the same sequence of prompts
+    whatever `batch_size` is. Memory stays the same however many prompts we go through.
+
+    Args:
+        N:
+            Total number of prompts (the last batch can be smaller). If None, the stream is infinite.
+        flip:
+            If given, each batch is a tuple (dataset, flipped dataset), using `IOIDataset.gen_flipped_prompts`, so it can be
+            passed straight to the patching functions as orig & new input. Random names in the flip are drawn per batch, so
+            (unlike the unflipped prompts) they depend on `batch_size`.
+        Everything else is the same as for `IOIDataset`.
+
+    Usage:
+        stream = IOIPromptStream("mixed", N=100_000, batch_size=64, flip="ABB -> XYZ, BAB -> XYZ", device=device)
+        for ioi_dataset, abc_dataset in stream:
+            results = act_patch(model, ioi_dataset.toks, ..., new_input=abc_dataset.toks)
+    '''
+    def __init__(
+        self,
+        prompt_type: Union[str, List[str]],
+        N: Optional[int] = None,
+        batch_size: int = 32,
+        tokenizer=None,
+        symmetric=False,
+        prefixes=None,
+        nb_templates=None,
+        prepend_bos=False,
+        flip: Optional[str] = None,
+        seed=0,
+        device="cuda",
+    ):
+        assert not (symmetric and batch_size % 2 == 1), "Batch size must be even if the prompts are symmetric."
+        # (otherwise the last batch would have an odd number of prompts)
+        assert not (symmetric and N is not None and N % 2 == 1), "N must be even if the prompts are symmetric."
+        self.prompt_type = prompt_type
+        self.N = N
+        self.batch_size = batch_size
+        self.symmetric = symmetric
+        self.prefixes = prefixes
+        self.nb_templates = nb_templates
+        self.prepend_bos = prepend_bos
+        self.flip = flip
+        self.seed = seed
+        self.device = device
+
+        # The templates are shared by every batch (so each prompt's TEMPLATE_IDX means the same thing in every batch)
+        self.templates = get_templates(prompt_type, nb_templates, random.Random(seed))
+
+        # Load the tokenizer once, rather than once per batch
+        if tokenizer is None:
+            self.tokenizer = AutoTokenizer.from_pretrained("gpt2")
+            self.tokenizer.pad_token = self.tokenizer.eos_token
+        else:
+            self.tokenizer = tokenizer
+
+    def get_batch_seed(self, batch_idx: int) -> int:
+        '''Seed for batch `batch_idx` (we hash the pair, so that e.g. seed=0 batch=1 and seed=1 batch=0 are different).'''
+        return int(np.random.SeedSequence([self.seed, batch_idx]).generate_state(1)[0])
+
+    def get_prompt_seed(self, prompt_idx: int) -> int:
+        '''Seed for prompt `prompt_idx` (or for pair `prompt_idx`, if the prompts are symmetric).'''
+        return int(np.random.SeedSequence([self.seed, prompt_idx], spawn_key=[1]).generate_state(1)[0])
+
+    def __getitem__(self, batch_idx: int):
+        if self.N is not None:
+            assert 0 <= batch_idx < len(self), f"Batch index {batch_idx} out of range for {len(self)} batches."
+            batch_size = min(self.batch_size, self.N - batch_idx * self.batch_size)
+        else:
+            batch_size = self.batch_size
+
+        # Generate each prompt (or symmetric pair of prompts) from its own seed
+        prompts_per_seed = 2 if self.symmetric else 1
+        start = batch_idx * self.batch_size // prompts_per_seed
+        prompts = []
+        for prompt_idx in range(start, start + batch_size // prompts_per_seed):
+            prompts.extend(gen_prompt_uniform(
+                self.templates,
+                NAMES,
+                nouns_dict={"[PLACE]": PLACES, "[OBJECT]": OBJECTS},
+                N=prompts_per_seed,
+                symmetric=self.symmetric,
+                prefixes=self.prefixes,
+                abc=(self.prompt_type in ["ABC", "ABC mixed", "BAC"]),
+                rng=random.Random(self.get_prompt_seed(prompt_idx)),
+            ))
+
+        ioi_dataset = IOIDataset(
+            prompt_type=self.prompt_type,
+            N=batch_size,
+            tokenizer=self.tokenizer,
+            prompts=prompts,
+            symmetric=self.symmetric,
+            prefixes=self.prefixes,
+            nb_templates=self.nb_templates,
+            prepend_bos=self.prepend_bos,
+            seed=self.get_batch_seed(batch_idx),
+            device=self.device,
+        )
+        # (IOIDataset shuffles its own copy of the templates, but the prompts' TEMPLATE_IDX refer to ours)
+        ioi_dataset.templates = self.templates
+        if self.flip is None:
+            return ioi_dataset
+        return ioi_dataset, ioi_dataset.gen_flipped_prompts(self.flip)
+
+    def __iter__(self):
+        batch_idx = 0
+        while (self.N is None) or (batch_idx < len(self)):
+            yield self[batch_idx]
+            batch_idx += 1
+
+    def __len__(self):
+        assert self.N is not None, "Infinite stream has no length."
+        return -(-self.N // self.batch_size)
@@ -0,0 +1,167 @@
+# %%
+
+import os
+import shutil
+import hashlib
+from collections.abc import Mapping
+from typing import Optional, Union, List, Callable, Iterator
+import numpy as np
+import torch as t
+from torch import Tensor
+from jaxtyping import Int
+from transformer_lens import HookedTransformer, ActivationCache
+
+from utils.output_cache import get_model_id
+
+# %%
+
+class LazyTensorDict(Mapping):
+    '''
+    Dict of hook name -> activations, where the activations are memory-mapped `.npy` files which we only open when they're
+    indexed. The OS only pages in the parts of the file which we actually read, so e.g. indexing into a few layers of a big
+    cache is cheap.
+    '''
+    def __init__(self, directory: str, names: List[str], dtype: Optional[t.dtype] = None, device: Optional[Union[str, t.device]] = None):
+        self.directory = directory
+        self.names = list(names)
+        self.dtype = dtype
+        self.device = device
+        self._tensors = {}
+
+    def __getitem__(self, name: str) -> Tensor:
+        if name not in self.names:
+            raise KeyError(name)
+        if name not in self._tensors:
+            # mmap_mode="c" is copy-on-write, so the tensor is writable but we never modify the file on disk
+            tensor = t.from_numpy(np.load(get_activation_path(self.directory, name), mmap_mode="c"))
+            if self.dtype is not None: tensor = tensor.to(self.dtype)
+            if self.device is not None: tensor = tensor.to(self.device)
+            self._tensors[name] = tensor
+        return self._tensors[name]
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.names)
+
+    def __len__(self) -> int:
+        return len(self.names)
+
+    def __contains__(self, name) -> bool:
+        return name in self.names
+
+
+def get_activation_path(directory: str, name: str) -> str:
+    return os.path.join(directory, f"{name}.npy")
+
+
+# (hook names never contain whitespace, so we can store them one per line)
+UNUSED_NAMES_FILE = "unused_names.txt"
+
+
+class ActivationStore:
+    '''
+    Persistent store of activations on disk, so we don't have to recompute the orig and new caches every time we restart the
+    kernel. Activations are keyed by (model name, model hash, hash of the input tokens, hook name), and stored like this:
+
+        root/<model name>/<model hash>/<tokens hash>/<hook name>.npy
+        root/<model name>/<model hash>/<tokens hash>/unused_names.txt    (hooks which don't fire for this model, e.g. hook_q_input)
+
+    The model hash is from `get_model_id` (the config and a fingerprint of the weights), so a fine-tuned model, or one with
+    edited weights, doesn't reuse the original model's activations.
+
+    `get_cache` only runs the model for the hooks which aren't already stored, and returns a lazy `ActivationCache` which
+    memory-maps the files (see `LazyTensorDict`).
+
+    Usage:
+        store = ActivationStore("activations")
+        orig_cache = store.get_cache(model, ioi_dataset.toks, names_filter=relevant_names_filter)
+        results = path_patch(model, orig_input, new_input, ..., activation_store=store)   # uses the store for its caches
+    '''
+    def __init__(self, root: str, model_name: Optional[str] = None):
+        self.root = root
+        self.model_name = model_name
+
+    @staticmethod
+    def hash_tokens(tokens: Int[Tensor, "batch seq_len"]) -> str:
+        tokens = tokens.detach().cpu().long().numpy()
+        return hashlib.sha1(str(tokens.shape).encode() + tokens.tobytes()).hexdigest()[:16]
+
+    def get_model_directory(self, model: HookedTransformer) -> str:
+        model_name = (self.model_name or model.cfg.model_name).replace("/", "__")
+        model_hash = get_model_id(model).rsplit(":", 1)[-1]
+        return os.path.join(self.root, model_name, model_hash)
+
+    def get_directory(self, model: HookedTransformer, tokens: Int[Tensor, "batch seq_len"]) -> str:
+        return os.path.join(self.get_model_directory(model), self.hash_tokens(tokens))
+
+    def get_cache(
+        self,
+        model: HookedTransformer,
+        input: Union[str, List[str], Int[Tensor, "batch seq_len"]],
+        names_filter: Optional[Union[Callable, List[str]]] = None,
+        device: Optional[Union[str, t.device]] = None,
+    ) -> ActivationCache:
+        '''
+        Returns a lazy cache of the activations on `input` at all hooks which pass `names_filter` (same format as for
+        `model.run_with_cache`). Anything which isn't stored yet gets computed (in a single forward pass) and written to disk.
+
+        The activations are put on `device` when they're indexed (by default the model's device).
+        '''
+        tokens = input if isinstance(input, Tensor) else model.to_tokens(input)
+        directory = self.get_directory(model, tokens)
+
+        if names_filter is None:
+            names = list(model.hook_dict.keys())
+        elif callable(names_filter):
+            names = [name for name in model.hook_dict.keys() if names_filter(name)]
+        else:
+            names = [names_filter] if isinstance(names_filter, str) else list(names_filter)
+
+        # Some hook points never fire for this config (e.g. hook_q_input without use_split_qkv_input), so we remember which
+        # names we've already tried to compute, and don't rerun the model for them every time
+        unused_names = self.get_unused_names(directory)
+        missing_names = [
+            name for name in names if (name not in unused_names) and not os.path.exists(get_activation_path(directory, name))
+        ]
+        if len(missing_names) > 0:
+            os.makedirs(directory, exist_ok=True)
+            _, cache = model.run_with_cache(tokens, return_type=None, names_filter=lambda name: name in missing_names)
+            for name in cache.keys():
+                # numpy doesn't support bfloat16, so we save as float32 (we cast back to the model's dtype when we load)
+                activation = cache[name].detach().cpu()
+                if activation.dtype == t.bfloat16: activation = activation.float()
+                # Write to a temporary file first, so a crash never leaves a half-written activation in the store
+                path = get_activation_path(directory, name)
+                with open(f"{path}.tmp", "wb") as f:
+                    np.save(f, activation.numpy())
+                os.replace(f"{path}.tmp", path)
+            new_unused_names = [name for name in missing_names if name not in cache.keys()]
+            if len(new_unused_names) > 0:
+                with open(os.path.join(directory, UNUSED_NAMES_FILE), "a") as f:
+                    f.write("".join(f"{name}\n" for name in new_unused_names))
+            del cache
+
+        # Only the names which actually have a file, so the cache doesn't advertise activations which don't exist
+        names = [name for name in names if os.path.exists(get_activation_path(directory, name))]
+        return ActivationCache(
+            LazyTensorDict(directory, names, dtype=model.cfg.dtype, device=device or model.cfg.device),
+            model=model,
+        )
+
+    @staticmethod
+    def get_unused_names(directory: str) -> List[str]:
+        '''Returns the names of the hooks which didn't fire when we ran the model on these tokens.'''
+        path = os.path.join(directory, UNUSED_NAMES_FILE)
+        if not os.path.exists(path):
+            return []
+        with open(path) as f:
+            return f.read().split()
+
+    def clear(self, model: Optional[HookedTransformer] = None, tokens: Optional[Int[Tensor, "batch seq_len"]] = None):
+        '''Deletes stored activations: all of them, or just for this model (and these tokens, if given).'''
+        if model is None:
+            directory = self.root
+        elif tokens is None:
+            directory = self.get_model_directory(model)
+        else:
+            directory = self.get_directory(model, tokens)
+        shutil.rmtree(directory, ignore_errors=True)
@@ -0,0 +1,342 @@
+# %%
+
+import os
+import json
+import numbers
+from typing import Optional, Union, Dict, List, Any, Iterator
+import numpy as np
+
+from utils.prompt_interface import PromptCase, PromptFamily
+
+# %%
+
+# Result columns, and the value they take before a case has been run / scored
+RESULT_COLUMNS = {
+    "output_id": (np.int32, -1),
+    "exact_match": (np.bool_, False),
+    "substring_match": (np.bool_, False),
+    "answer_logprob": (np.float32, np.nan),
+    "greedy_agreement": (np.float32, np.nan),
+    "first_divergence": (np.int32, -1),
+    "greedy_match": (np.bool_, False),
+}
+
+
+class CaseStore:
+    '''
+    Columnar storage for a family's prompt cases, for when there are too many cases to keep as `PromptCase` objects. Rather
+    than a dataclass per case (with its own closures, metadata dict and evaluation_result dict), we store numpy arrays:
+
+        prompt_id, wrap_id  - indices into `prompt_names` / `wrap_names` (the prompt & wrap functions come from the family)
+        case_number         - the task_id is f"{prompt_name}-{case_number}"
+        input_j_<kind>      - the j-th input of every case whose prompt has that kind of input there (`input_kinds` has the
+                              kinds of each prompt's inputs): for lists a 2D array (plus `input_j_list_len`, the length
+                              of each list), for ints a 1D array, and for strings an index into `tables["input_j_str"]`
+        output_id, ...      - results (see `RESULT_COLUMNS`), where outputs are indices into `tables["output"]`, so
+                              identical outputs are only stored once
+
+    Indexing with an int gives a `CaseView`, which behaves like a `PromptCase` (so the store can be used as `family.cases`,
+    and `evaluate_all` / `score_all` write their results into the columns). Indexing with a slice, a boolean mask or an array
+    of indices gives a new store with the same columns, i.e. filtering doesn't copy anything (and results written through the
+    filtered store end up in the original one).
+
+    Note, any metadata other than prompt_name, inputs and wrap_name isn't stored, and the per-token log-probs from
+    `score_all` aren't either (only the columns in `RESULT_COLUMNS`).
+
+    Usage:
+        family.generate_all(n=1000)
+        family.cases = CaseStore.from_cases(family, family.cases)
+        family.evaluate_all(model)
+        family.cases.save("results/list_cases")
+    '''
+    def __init__(
+        self,
+        family: PromptFamily,
+        columns: Dict[str, np.ndarray],
+        prompt_names: List[str],
+        wrap_names: List[str],
+        input_kinds: Dict[str, List[str]],
+        tables: Optional[Dict[str, List[str]]] = None,
+        rows: Optional[np.ndarray] = None,
+        table_ids: Optional[Dict[str, Dict[str, int]]] = None,
+    ):
+        self.family = family
+        self.columns = columns
+        self.prompt_names = prompt_names
+        self.wrap_names = wrap_names
+        self.input_kinds = input_kinds
+        self.tables = {"output": []} if tables is None else tables
+        # Maps each string in each table to its index (so we can intern new outputs). Filtered stores share this with the
+        # store they came from, so an output recorded through either of them is only added to the table once
+        if table_ids is None:
+            table_ids = {name: {value: i for i, value in enumerate(table)} for name, table in self.tables.items()}
+        self.table_ids = table_ids
+        self.rows = rows
+
+        n_rows = len(columns["prompt_id"])
+        for name, (dtype, default) in RESULT_COLUMNS.items():
+            if name not in self.columns:
+                self.columns[name] = np.full(n_rows, default, dtype=dtype)
+
+    @classmethod
+    def from_cases(cls, family: PromptFamily, cases: List[PromptCase]) -> "CaseStore":
+        prompt_names = list(family.prompts.keys())
+        wrap_names = list(family.wraps.keys())
+        prompt_ids = {name: i for i, name in enumerate(prompt_names)}
+        wrap_ids = {name: i for i, name in enumerate(wrap_names)}
+
+        columns = {
+            "prompt_id": np.array([prompt_ids[case.metadata["prompt_name"]] for case in cases], dtype=np.int16),
+            # (cases without a wrap get wrap_id -1)
+            "wrap_id": np.array([wrap_ids.get(case.metadata.get("wrap_name"), -1) for case in cases], dtype=np.int16),
+        }
+        case_numbers = [case.task_id.rsplit("-", 1) for case in cases]
+        assert all(len(parts) == 2 and parts[1].isdigit() for parts in case_numbers), "Task ids must be of the form f'{prompt_name}-{case_number}'."
+        columns["case_number"] = np.array([int(parts[1]) for parts in case_numbers], dtype=np.int64)
+
+        # Each prompt has its own inputs, e.g. [list, int, int, str] for swap_indices, so we record the kinds of inputs for
+        # each prompt, and have a column for each (position, kind)
+        input_kinds = {}
+        for case in cases:
+            kinds = [get_input_kind(value) for value in case.inputs]
+            assert input_kinds.setdefault(case.metadata["prompt_name"], kinds) == kinds, f"Inputs of {case.task_id} don't match the other {case.metadata['prompt_name']} cases."
+
+        tables = {"output": []}
+        column_names = {f"input_{j}_{kind}" for kinds in input_kinds.values() for j, kind in enumerate(kinds)}
+        for name in sorted(column_names):
+            j, kind = int(name.split("_")[1]), name.split("_")[2]
+            rows = [i for i, case in enumerate(cases) if len(case.inputs) > j and input_kinds[case.metadata["prompt_name"]][j] == kind]
+            values = [cases[i].inputs[j] for i in rows]
+            if kind == "list":
+                lens = np.zeros(len(cases), dtype=np.int32)
+                lens[rows] = [len(value) for value in values]
+                column = np.zeros((len(cases), lens.max(initial=0)), dtype=np.int64)
+                for i, value in zip(rows, values):
+                    column[i, :len(value)] = value
+                columns[f"{name}_len"] = lens
+            elif kind == "int":
+                column = np.zeros(len(cases), dtype=np.int64)
+                column[rows] = values
+            else:
+                tables[name] = list(dict.fromkeys(str(value) for value in values))
+                table_ids = {value: i for i, value in enumerate(tables[name])}
+                column = np.zeros(len(cases), dtype=np.int32)
+                column[rows] = [table_ids[str(value)] for value in values]
+            columns[name] = column
+
+        store = cls(family, columns, prompt_names, wrap_names, input_kinds, tables)
+        for i, case in enumerate(cases):
+            if case.generated_output is not None:
+                store[i].record_output(case.generated_output)
+        return store
+
+    # === Rows ===
+
+    def get_rows(self) -> np.ndarray:
+        '''Indices into the columns of the rows in this store.'''
+        return np.arange(len(self.columns["prompt_id"])) if self.rows is None else self.rows
+
+    def __len__(self) -> int:
+        return len(self.columns["prompt_id"]) if self.rows is None else len(self.rows)
+
+    def __getitem__(self, idx) -> Union["CaseView", "CaseStore"]:
+        if isinstance(idx, numbers.Integral):
+            if idx < 0:
+                idx += len(self)
+            if not 0 <= idx < len(self):
+                raise IndexError(idx)
+            return CaseView(self, int(idx) if self.rows is None else int(self.rows[idx]))
+        # Same columns & tables, just a different set of rows
+        return CaseStore(
+            self.family, self.columns, self.prompt_names, self.wrap_names, self.input_kinds, self.tables,
+            rows=self.get_rows()[idx], table_ids=self.table_ids,
+        )
+
+    def __iter__(self) -> Iterator["CaseView"]:
+        for row in self.get_rows().tolist():
+            yield CaseView(self, row)
+
+    def filter(self, prompt_name: Optional[str] = None, wrap_name: Optional[str] = None) -> "CaseStore":
+        mask = np.ones(len(self), dtype=bool)
+        if prompt_name is not None:
+            mask &= self.get_column("prompt_id") == self.prompt_names.index(prompt_name)
+        if wrap_name is not None:
+            mask &= self.get_column("wrap_id") == self.wrap_names.index(wrap_name)
+        return self[mask]
+
+    def get_column(self, name: str) -> np.ndarray:
+        '''Values of a column for the rows in this store (this is a copy if the store has been filtered).'''
+        return self.columns[name] if self.rows is None else self.columns[name][self.rows]
+
+    def get_outputs(self) -> List[Optional[str]]:
+        return [self.tables["output"][output_id] if output_id >= 0 else None for output_id in self.get_column("output_id").tolist()]
+
+    def intern(self, table: str, value: str) -> int:
+        if value not in self.table_ids[table]:
+            self.table_ids[table][value] = len(self.tables[table])
+            self.tables[table].append(value)
+        return self.table_ids[table][value]
+
+    # === Saving & loading ===
+
+    def save(self, directory: str):
+        '''Saves the rows in this store, as one `.npy` file per column plus a json file of the names and string tables.'''
+        os.makedirs(directory, exist_ok=True)
+        for name in self.columns:
+            np.save(os.path.join(directory, f"{name}.npy"), self.get_column(name))
+        with open(os.path.join(directory, "store.json"), "w") as f:
+            json.dump({
+                "columns": list(self.columns.keys()),
+                "prompt_names": self.prompt_names,
+                "wrap_names": self.wrap_names,
+                "input_kinds": self.input_kinds,
+                "tables": self.tables,
+            }, f)
+
+    @classmethod
+    def load(cls, directory: str, family: PromptFamily, mmap: bool = True) -> "CaseStore":
+        '''
+        Loads a store saved with `save`. If mmap, the columns are memory-mapped (copy-on-write, so results can still be
+        written to them, but the files on disk are never modified).
+        '''
+        with open(os.path.join(directory, "store.json")) as f:
+            info = json.load(f)
+        columns = {
+            name: np.load(os.path.join(directory, f"{name}.npy"), mmap_mode="c" if mmap else None)
+            for name in info["columns"]
+        }
+        return cls(family, columns, info["prompt_names"], info["wrap_names"], info["input_kinds"], info["tables"])
+
+
+def get_input_kind(value: Any) -> str:
+    if isinstance(value, list):
+        return "list"
+    elif isinstance(value, numbers.Integral):
+        return "int"
+    assert isinstance(value, str), f"Can only store list, int and str inputs, not {type(value)}."
+    return "str"
+
+
+class CaseView:
+    '''
+    One row of a `CaseStore`, with the same attributes & methods as a `PromptCase`. Everything is read from (and results
+    are written to) the store's columns, so views are cheap to create and don't hold any state of their own.
+    '''
+    __slots__ = ("store", "row")
+
+    def __init__(self, store: CaseStore, row: int):
+        self.store = store
+        self.row = row
+
+    @property
+    def prompt_name(self) -> str:
+        return self.store.prompt_names[self.store.columns["prompt_id"][self.row]]
+
+    @property
+    def wrap_name(self) -> Optional[str]:
+        wrap_id = self.store.columns["wrap_id"][self.row]
+        return self.store.wrap_names[wrap_id] if wrap_id >= 0 else None
+
+    @property
+    def task_id(self) -> str:
+        return f"{self.prompt_name}-{self.store.columns['case_number'][self.row]}"
+
+    @property
+    def inputs(self) -> List[Any]:
+        inputs = []
+        for j, kind in enumerate(self.store.input_kinds[self.prompt_name]):
+            name = f"input_{j}_{kind}"
+            value = self.store.columns[name][self.row]
+            if kind == "list":
+                inputs.append(value[:self.store.columns[f"{name}_len"][self.row]].tolist())
+            elif kind == "int":
+                inputs.append(int(value))
+            else:
+                inputs.append(self.store.tables[name][value])
+        return inputs
+
+    @property
+    def prompt_fn(self):
+        return self.store.family.prompts[self.prompt_name].prompt_fn
+
+    @property
+    def wrap_fn(self):
+        return self.store.family.wraps[self.wrap_name] if self.wrap_name is not None else None
+
+    @property
+    def ground_truth(self) -> Any:
+        transform_fn = self.store.family.prompts[self.prompt_name].transform_fn
+        inputs = self.inputs
+        return transform_fn(inputs) if transform_fn else inputs
+
+    @property
+    def metadata(self) -> Dict:
+        metadata = {"prompt_name": self.prompt_name, "inputs": self.inputs}
+        if self.wrap_name is not None:
+            metadata["wrap_name"] = self.wrap_name
+        return metadata
+
+    @property
+    def prompt(self) -> str:
+        inputs = self.inputs
+        core = self.prompt_fn(inputs)
+        return self.wrap_fn(core, inputs) if self.wrap_fn else core
+
+    @property
+    def generated_output(self) -> Optional[str]:
+        output_id = self.store.columns["output_id"][self.row]
+        return self.store.tables["output"][output_id] if output_id >= 0 else None
+
+    @property
+    def evaluation_result(self) -> Dict:
+        columns = self.store.columns
+        result = {}
+        if columns["output_id"][self.row] >= 0:
+            result.update({
+                "exact_match": bool(columns["exact_match"][self.row]),
+                "substring_match": bool(columns["substring_match"][self.row]),
+                "output": self.generated_output,
+            })
+        if not np.isnan(columns["answer_logprob"][self.row]):
+            result.update({
+                "answer_logprob": float(columns["answer_logprob"][self.row]),
+                "greedy_agreement": float(columns["greedy_agreement"][self.row]),
+                "first_divergence": int(columns["first_divergence"][self.row]) if columns["first_divergence"][self.row] >= 0 else None,
+                "greedy_match": bool(columns["greedy_match"][self.row]),
+            })
+        return result
+
+    # Only uses `prompt` and `record_output`, so works the same on a view
+    run_model = PromptCase.run_model
+
+    def record_output(self, decoded: str) -> Dict:
+        ground_truth = str(self.ground_truth).strip()
+        columns = self.store.columns
+        columns["output_id"][self.row] = self.store.intern("output", decoded)
+        columns["exact_match"][self.row] = ground_truth == decoded
+        columns["substring_match"][self.row] = ground_truth in decoded
+        return self.evaluation_result
+
+    def record_scores(self, scores: Dict) -> Dict:
+        columns = self.store.columns
+        columns["answer_logprob"][self.row] = scores["answer_logprob"]
+        columns["greedy_agreement"][self.row] = scores["greedy_agreement"]
+        columns["first_divergence"][self.row] = -1 if scores["first_divergence"] is None else scores["first_divergence"]
+        columns["greedy_match"][self.row] = scores["greedy_match"]
+        return self.evaluation_result
+
+    def to_case(self) -> PromptCase:
+        '''Converts the view into a standalone `PromptCase`.'''
+        return PromptCase(
+            task_id=self.task_id,
+            inputs=self.inputs,
+            prompt_fn=self.prompt_fn,
+            ground_truth=self.ground_truth,
+            metadata=self.metadata,
+            wrap_fn=self.wrap_fn,
+            generated_output=self.generated_output,
+            evaluation_result=self.evaluation_result,
+        )
+
+    def copy(self, **overrides) -> PromptCase:
+        return self.to_case().copy(**overrides)
@@ -0,0 +1,155 @@
+# %%
+
+import os
+import json
+import hashlib
+from functools import partial
+from typing import Optional, Union, Dict, List, Tuple, Callable
+import torch as t
+from torch import Tensor
+from jaxtyping import Float
+
+from utils.activation_store import ActivationStore
+
+# %%
+
+class SweepJournal:
+    '''
+    On-disk record of the results of a patching sweep (i.e. `act_patch` or `path_patch` with an `IterNode`), so that if the
+    kernel dies partway through a long sweep, we don't lose everything we've already computed.
+
+    Every time a node finishes, we append a line to a jsonl file:
+
+        {"key": <hash of the sweep's inputs>, "node": <node identity>, "result": <metric value>}
+
+    The "key" is a hash of everything which defines the sweep apart from the node we're iterating over (the model, the orig &
+    new tokens, the fixed senders / receivers, etc). When we rerun the same call with the same journal, any node which already
+    has a result for this key gets skipped, so the sweep picks up where it left off. You can also stop a sweep early, and read
+    the partial results with `get_results`.
+
+    The patching metric is identified by its module & name, so lambdas, `functools.partial`s and functions defined inside
+    other functions (whose names don't say what they compute, or change every session) need an explicit `metric_key`.
+
+    Usage:
+        journal = SweepJournal("results/ioi_qkv.jsonl")
+        results = path_patch(model, orig_input, new_input, ..., receiver_nodes=IterNode(["q", "k", "v"], seq_pos="each"), journal=journal)
+    '''
+    def __init__(self, path: str):
+        self.path = path
+        self.results = {}
+        if os.path.exists(path):
+            with open(path) as f:
+                for line in f:
+                    # If we crashed in the middle of writing a line then the last line can be incomplete, so we skip it
+                    try:
+                        entry = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue
+                    self.results[(entry["key"], entry["node"])] = entry["result"]
+
+    @staticmethod
+    def get_sweep_key(**description) -> str:
+        '''
+        Hashes a description of the sweep (tensors of tokens are hashed with `ActivationStore.hash_tokens`, everything else is
+        converted to a string).
+        '''
+        description = {
+            k: ActivationStore.hash_tokens(v) if isinstance(v, Tensor) else str(v)
+            for k, v in sorted(description.items())
+        }
+        return hashlib.sha1(json.dumps(description).encode()).hexdigest()[:16]
+
+    @staticmethod
+    def get_cache_key(new_cache) -> Optional[str]:
+        '''
+        Identity of the `new_cache` argument: None, "zero" and "mean" are kept as they are, and an `ActivationCache` (or
+        `ActivationStats`) is hashed by the contents of each of its hooks.
+        '''
+        if (new_cache is None) or isinstance(new_cache, str):
+            return new_cache
+        hashes = {name: hash_tensor(new_cache[name]) for name in sorted(new_cache.keys())}
+        return type(new_cache).__name__ + ":" + hashlib.sha1(json.dumps(hashes).encode()).hexdigest()[:16]
+
+    @staticmethod
+    def get_metric_key(patching_metric: Union[Callable, str], metric_key: Optional[str] = None) -> str:
+        '''
+        Identity of the patching metric: `metric_key` if it's given, otherwise the metric's module & name. Raises an error if the
+        metric has no stable name (lambdas, partials, functions defined inside other functions, callable objects), since then
+        different metrics would share results (or a restarted kernel would never find its results).
+        '''
+        if metric_key is not None:
+            return metric_key
+        if isinstance(patching_metric, str):
+            return patching_metric
+        qualname = getattr(patching_metric, "__qualname__", None)
+        if isinstance(patching_metric, partial) or (qualname is None) or ("<lambda>" in qualname) or ("<locals>" in qualname):
+            raise ValueError(
+                f"Can't identify the patching metric {patching_metric!r} in the journal, since it doesn't have a stable name. "
+                "Pass a `metric_key` (any string which identifies what the metric computes)."
+            )
+        return f"{patching_metric.__module__}.{qualname}"
+
+    @staticmethod
+    def get_node_key(node_name: str, seq_pos, node) -> str:
+        '''
+        Identity of a node in the sweep (i.e. its activation name, head / neuron, and sequence position). For `seq_pos="each"`
+        the sequence position is the same for every sequence in the batch, so we just record that one int.
+        '''
+        if isinstance(seq_pos, Tensor):
+            seq_pos = seq_pos.flatten()[0].item() if (seq_pos == seq_pos.flatten()[0]).all() else ActivationStore.hash_tokens(seq_pos)
+        return f"{node_name}:{node!r}:seq_pos={seq_pos}"
+
+    def __contains__(self, key) -> bool:
+        return key in self.results
+
+    def __getitem__(self, key) -> Union[float, Float[Tensor, "..."]]:
+        result = self.results[key]
+        return t.tensor(result["tensor"]) if isinstance(result, dict) else result
+
+    def add(self, key, result: Union[float, Float[Tensor, "..."]]):
+        '''Records a result, and appends it to the file straight away (flushing it to disk, so it survives a crash).'''
+        if isinstance(result, Tensor):
+            result = {"tensor": result.detach().cpu().tolist()}
+        assert isinstance(result, (float, int, dict)), f"Can only record float or tensor results in the journal, not {type(result)}."
+        self.results[key] = result
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        with open(self.path, "a") as f:
+            f.write(json.dumps({"key": key[0], "node": key[1], "result": result}) + "\n")
+            f.flush()
+            os.fsync(f.fileno())
+
+    def get_results(self, sweep_key: Optional[str] = None) -> Dict[str, Union[float, Float[Tensor, "..."]]]:
+        '''
+        Returns all the results recorded so far as a dict of {node identity: result}, e.g. to look at the partial results of a
+        sweep which was stopped early. If `sweep_key` is given, we only return results for that sweep (otherwise the journal
+        should only be used for one sweep, or node identities from different sweeps will overwrite each other).
+        '''
+        return {node_key: self[(key, node_key)] for (key, node_key) in self.results if (sweep_key is None) or (key == sweep_key)}
+
+    def clear(self):
+        self.results = {}
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    def get_entries(self, sweep_key: str, node_name: str, node_list: List[Tuple]) -> Tuple[List, List[Tuple[str, str]], List[int]]:
+        '''
+        For a list of (seq_pos, node) from `IterNode.get_node_dict`, returns:
+            results   - the recorded result for each node, or None if it hasn't been done yet
+            node_keys - the key we record each node's result under
+            todo      - the indices of the nodes which haven't been done yet
+        '''
+        node_keys = [(sweep_key, self.get_node_key(node_name, seq_pos, node)) for (seq_pos, node) in node_list]
+        results = [self[key] if key in self else None for key in node_keys]
+        todo = [j for j, key in enumerate(node_keys) if key not in self]
+        return results, node_keys, todo
+
+
+def hash_tensor(tensor: Tensor) -> str:
+    tensor = tensor.detach().cpu().contiguous()
+    # (numpy doesn't support bfloat16, but we only need the bytes)
+    if tensor.dtype == t.bfloat16: tensor = tensor.view(t.int16)
+    return hashlib.sha1(f"{tuple(tensor.shape)}{tensor.dtype}".encode() + tensor.numpy().tobytes()).hexdigest()[:16]
+
+
+def get_journal(journal: Optional[Union[str, SweepJournal]]) -> Optional[SweepJournal]:
+    return SweepJournal(journal) if isinstance(journal, str) else journal
@@ -1,4 +1,5 @@
 from utils.prompt_interface import PromptFamily, PromptCase, Prompt
+from utils.case_store import CaseStore
 from transformer_lens import HookedTransformer
 from typing import List, Dict
 from prompt_registry import PROMPT_REGISTRY
@@ -113,6 +114,186 @@ class ListPromptFamily(PromptFamily):
             raise ValueError(f"Unrecognized prompt name: {name}")
 
 
+    # === Batched generation ===
+
+    def random_lists(self, n: int) -> np.ndarray:
+        # Same distribution as `rand_list` for each fill_mode, but all n lists at once, as an (n, list_size) array
+        if self.fill_mode == "random":
+            return np.random.randint(self.min_val, self.max_val, size=(n, self.list_size))
+
+        if self.fill_mode not in {"uniform", "single_outlier"}:
+            raise ValueError(f"Unrecognized fill_mode: {self.fill_mode}")
+        fill_vals = np.random.randint(self.min_val, self.max_val, size=n)
+        lists = np.repeat(fill_vals[:, None], self.list_size, axis=1)
+        if self.fill_mode == "single_outlier":
+            if self.max_val - self.min_val < 2:
+                raise ValueError("fill_mode='single_outlier' needs at least 2 possible values.")
+            # Uniform over every value except the fill value
+            outlier_vals = np.random.randint(self.min_val, self.max_val - 1, size=n)
+            outlier_vals += (outlier_vals >= fill_vals)
+            lists[np.arange(n), np.random.randint(self.list_size, size=n)] = outlier_vals
+        return lists
+
+    def random_targets_not_in(self, lists: np.ndarray) -> np.ndarray:
+        # Values in [min_val, max_val) which aren't in each list (by rejection sampling, resampling only the rejected rows).
+        # If a list contains every possible value, there's no such target, so we pick one of the list's values instead
+        n = len(lists)
+        sorted_lists = np.sort(lists, axis=1)
+        n_distinct = 1 + (np.diff(sorted_lists, axis=1) != 0).sum(1)
+        full = n_distinct >= self.max_val - self.min_val
+        targets = lists[np.arange(n), np.random.randint(self.list_size, size=n)]
+        todo = np.nonzero(~full)[0]
+        while len(todo) > 0:
+            targets[todo] = np.random.randint(self.min_val, self.max_val, size=len(todo))
+            todo = todo[(lists[todo] == targets[todo, None]).any(1)]
+        return targets
+
+    def generate_batch_inputs(self, name: str, n: int) -> Dict[str, np.ndarray]:
+        '''
+        Inputs for n cases of prompt `name` at once, as a dict of arrays (rather than calling `random_input_fn` n times):
+
+            lists     - (n, list_size) array
+            values    - the value to append / add / insert (for append, add_all, insert_middle)
+            i1, i2    - the indices to swap (for swap_indices)
+            target    - the value to find (for find_index)
+            indexing  - array of "zero" / "one" (for swap_indices, find_index)
+        '''
+        batch = {"lists": self.random_lists(n)}
+
+        if name in {"append", "add_all", "insert_middle"}:
+            batch["values"] = np.random.randint(self.append_min, self.append_max, size=n)
+
+        elif name == "swap_indices":
+            batch["indexing"] = np.random.choice(["zero", "one"], size=n)
+            one_indexed = batch["indexing"] == "one"
+            batch["i1"] = np.random.randint(0, self.list_size, size=n) + one_indexed
+            batch["i2"] = np.random.randint(0, self.list_size, size=n) + one_indexed
+
+        elif name == "find_index":
+            batch["indexing"] = np.random.choice(["zero", "one"], size=n)
+            lists = batch["lists"]
+            if self.fill_mode == "single_outlier":
+                # The first value which only appears once
+                counts = (lists[:, :, None] == lists[:, None, :]).sum(-1)
+                batch["target"] = lists[np.arange(n), (counts == 1).argmax(1)]
+            else:
+                # 80% of the time the target is one of the list's values, otherwise it's a value which isn't in the list.
+                # Deliberate change from `make_find_index_inputs`: if a list contains every value in [min_val, max_val) then
+                # there's no such value, and the old rejection loop never finished. Now `random_targets_not_in` gives one of
+                # the list's values instead, so that case gets an index as its ground truth rather than "Not Found"
+                in_list = np.random.rand(n) < 0.8
+                batch["target"] = np.where(
+                    in_list,
+                    lists[np.arange(n), np.random.randint(self.list_size, size=n)],
+                    self.random_targets_not_in(lists),
+                )
+
+        elif name != "print":
+            raise ValueError(f"Unrecognized prompt name: {name}")
+
+        return batch
+
+    def get_batch_ground_truths(self, name: str, batch: Dict[str, np.ndarray]) -> np.ndarray:
+        '''
+        Same as each prompt's `transform_fn`, but for a whole batch from `generate_batch_inputs` at once. Returns an (n, len)
+        array of lists, except for find_index where it's an array of indices (-1 if the target isn't in the list).
+        '''
+        lists = batch["lists"]
+        n = len(lists)
+
+        if name == "print":
+            return lists
+        elif name == "append":
+            return np.concatenate([lists, batch["values"][:, None]], axis=1)
+        elif name == "add_all":
+            return lists + batch["values"][:, None]
+        elif name == "insert_middle":
+            return np.concatenate([lists[:, :3], batch["values"][:, None], lists[:, 3:]], axis=1)
+
+        elif name == "swap_indices":
+            one_indexed = batch["indexing"] == "one"
+            i1, i2 = batch["i1"] - one_indexed, batch["i2"] - one_indexed
+            out_of_bounds = (i1 < 0) | (i1 >= lists.shape[1]) | (i2 < 0) | (i2 >= lists.shape[1])
+            if out_of_bounds.any():
+                j = out_of_bounds.argmax()
+                raise IndexError(f"Index out of bounds for swap: {i1[j]}, {i2[j]} on list of length {lists.shape[1]}")
+            swapped = lists.copy()
+            swapped[np.arange(n), i1] = lists[np.arange(n), i2]
+            swapped[np.arange(n), i2] = lists[np.arange(n), i1]
+            return swapped
+
+        elif name == "find_index":
+            matches = lists == batch["target"][:, None]
+            return np.where(matches.any(1), matches.argmax(1) + (batch["indexing"] == "one"), -1)
+
+        raise ValueError(f"Unrecognized prompt name: {name}")
+
+    def batch_to_inputs(self, name: str, batch: Dict[str, np.ndarray]) -> List[List]:
+        # Converts a batch into the list of inputs for each case (same format as `random_input_fn`)
+        columns = [batch["lists"].tolist()]
+        if name in {"append", "add_all", "insert_middle"}:
+            columns.append(batch["values"].tolist())
+        elif name == "swap_indices":
+            columns += [batch["i1"].tolist(), batch["i2"].tolist(), batch["indexing"].tolist()]
+        elif name == "find_index":
+            columns += [batch["target"].tolist(), batch["indexing"].tolist()]
+        return [list(inputs) for inputs in zip(*columns)]
+
+    def create_cases(self, prompt_name: str, n: int) -> List[PromptCase]:
+        prompt = self.prompts[prompt_name]
+        batch = self.generate_batch_inputs(prompt_name, n)
+        ground_truths = self.get_batch_ground_truths(prompt_name, batch).tolist()
+        if prompt_name == "find_index":
+            ground_truths = [index if index >= 0 else "Not Found" for index in ground_truths]
+        return [
+            prompt.create_case(inputs=inputs, ground_truth=ground_truth)
+            for inputs, ground_truth in zip(self.batch_to_inputs(prompt_name, batch), ground_truths)
+        ]
+
+    def generate_store(self, prompt_name: str, wrap_name: str, n: int) -> CaseStore:
+        '''
+        Same cases as `generate`, but built straight into a `CaseStore` from the batched inputs (without creating a
+        `PromptCase` for each case), for generating millions of cases. Also sets `self.cases` to the store.
+        '''
+        prompt_names = list(self.prompts.keys()) if prompt_name == "all" else [prompt_name]
+        wrap_names = list(self.wraps.keys()) if wrap_name == "all" else [wrap_name]
+        all_prompt_names, all_wrap_names = list(self.prompts.keys()), list(self.wraps.keys())
+
+        input_kinds = {
+            "print": ["list"],
+            "append": ["list", "int"],
+            "add_all": ["list", "int"],
+            "insert_middle": ["list", "int"],
+            "swap_indices": ["list", "int", "int", "str"],
+            "find_index": ["list", "int", "str"],
+        }
+        tables = {"output": [], "input_2_str": ["zero", "one"], "input_3_str": ["zero", "one"]}
+
+        # Inputs are zero for the rows of prompts which don't have that input
+        parts = []
+        for p_name in prompt_names:
+            prompt = self.prompts[p_name]
+            for w_name in wrap_names:
+                batch = self.generate_batch_inputs(p_name, n)
+                zeros = np.zeros(n, dtype=np.int64)
+                part = {
+                    "prompt_id": np.full(n, all_prompt_names.index(p_name), dtype=np.int16),
+                    "wrap_id": np.full(n, all_wrap_names.index(w_name), dtype=np.int16),
+                    "case_number": np.arange(prompt.case_counter, prompt.case_counter + n, dtype=np.int64),
+                    "input_0_list": batch["lists"].astype(np.int64),
+                    "input_0_list_len": np.full(n, self.list_size, dtype=np.int32),
+                    "input_1_int": batch.get("values", batch.get("i1", batch.get("target", zeros))).astype(np.int64),
+                    "input_2_int": batch.get("i2", zeros).astype(np.int64),
+                    "input_2_str": (batch["indexing"] == "one").astype(np.int32) if p_name == "find_index" else zeros.astype(np.int32),
+                    "input_3_str": (batch["indexing"] == "one").astype(np.int32) if p_name == "swap_indices" else zeros.astype(np.int32),
+                }
+                prompt.case_counter += n
+                parts.append(part)
+
+        columns = {name: np.concatenate([part[name] for part in parts]) for name in parts[0]}
+        self.cases = CaseStore(self, columns, all_prompt_names, all_wrap_names, input_kinds, tables)
+        return self.cases
+
     def analyze_tokens(self, case: PromptCase, model: HookedTransformer) -> Dict:
         tokens = model.to_tokens(case.prompt)[0]
         token_strs = model.to_str_tokens(tokens)
@@ -0,0 +1,132 @@
+# %%
+
+import json
+import random
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from typing import Optional, List, Dict
+import httpx
+from tqdm.auto import tqdm
+
+# %%
+
+class ModelBackend:
+    '''
+    Something which can generate text for a batch of prompts, so that `PromptFamily.evaluate_all` can run on models other
+    than a `HookedTransformer` (which `PromptFamily.run_cases` handles directly, with batched generation).
+
+    Subclasses implement `generate`, which returns one output string per prompt, in the same order as the prompts, and
+    `get_model_id`, which identifies the model (and anything else which changes its outputs) for the `OutputCache`.
+    '''
+    def generate(self, prompts: List[str], max_tokens: int = 30, stop_sequences: Optional[List[str]] = None) -> List[str]:
+        raise NotImplementedError()
+
+    def get_model_id(self) -> str:
+        raise NotImplementedError()
+
+
+class OllamaBackend(ModelBackend):
+    '''
+    Runs prompts against an Ollama server (or anything else which speaks its `/api/generate` HTTP API), with up to
+    `max_concurrency` requests in flight at once, over a single pooled connection.
+
+    Each request is sent with temperature 0 (i.e. greedy decoding), and streamed back, so a request which hits one of the
+    stop sequences finishes as soon as the server stops. Requests which fail with a connection error, a timeout or a
+    429 / 5xx status are retried up to `max_retries` times, with exponential backoff.
+
+    The output for each prompt is just the model's response (not the prompt + response, as for a `HookedTransformer`).
+
+    `transport` is passed on to the `httpx.AsyncClient`, e.g. an `httpx.MockTransport` to run against a stub server in tests.
+
+    Usage:
+        backend = OllamaBackend("llama3.2", max_concurrency=32)
+        family.evaluate_all(backend, max_tokens=30)
+    '''
+    def __init__(
+        self,
+        model_name: str,
+        host: str = "http://localhost:11434",
+        max_concurrency: int = 16,
+        max_retries: int = 3,
+        backoff: float = 0.5,
+        timeout: float = 120.0,
+        raw: bool = False,
+        options: Optional[Dict] = None,
+        transport: Optional[httpx.AsyncBaseTransport] = None,
+        verbose: bool = True,
+    ):
+        self.model_name = model_name
+        self.host = host
+        self.max_concurrency = max_concurrency
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.raw = raw
+        self.options = options or {}
+        self.transport = transport
+        self.verbose = verbose
+
+    def get_model_id(self) -> str:
+        return "Ollama:" + json.dumps({"model": self.model_name, "raw": self.raw, "options": self.options}, sort_keys=True)
+
+    def get_payload(self, prompt: str, max_tokens: int, stop_sequences: Optional[List[str]]) -> Dict:
+        options = {"temperature": 0.0, "num_predict": max_tokens, **self.options}
+        if stop_sequences:
+            options["stop"] = list(stop_sequences)
+        return {"model": self.model_name, "prompt": prompt, "stream": True, "raw": self.raw, "options": options}
+
+    async def generate_one(self, client: httpx.AsyncClient, semaphore: asyncio.Semaphore, payload: Dict) -> str:
+        async with semaphore:
+            for attempt in range(self.max_retries + 1):
+                try:
+                    response_text = []
+                    async with client.stream("POST", "/api/generate", json=payload) as response:
+                        if response.status_code >= 400:
+                            await response.aread()
+                        response.raise_for_status()
+                        async for line in response.aiter_lines():
+                            if not line.strip():
+                                continue
+                            chunk = json.loads(line)
+                            if "error" in chunk:
+                                raise RuntimeError(f"Ollama error: {chunk['error']}")
+                            response_text.append(chunk.get("response", ""))
+                            if chunk.get("done"):
+                                break
+                    return "".join(response_text)
+                except (httpx.TransportError, httpx.HTTPStatusError) as e:
+                    # Only retry errors which might go away (client errors like a 404 for an unknown model won't)
+                    retryable = not isinstance(e, httpx.HTTPStatusError) or e.response.status_code == 429 or e.response.status_code >= 500
+                    if not retryable or attempt == self.max_retries:
+                        raise
+                    await asyncio.sleep(self.backoff * 2 ** attempt * (1 + random.random()))
+
+    async def agenerate(self, prompts: List[str], max_tokens: int = 30, stop_sequences: Optional[List[str]] = None) -> List[str]:
+        '''Async version of `generate`, e.g. for use inside an existing event loop.'''
+        semaphore = asyncio.Semaphore(self.max_concurrency)
+        limits = httpx.Limits(max_connections=self.max_concurrency, max_keepalive_connections=self.max_concurrency)
+        async with httpx.AsyncClient(base_url=self.host, limits=limits, timeout=self.timeout, transport=self.transport) as client:
+            tasks = [
+                asyncio.ensure_future(self.generate_one(client, semaphore, self.get_payload(prompt, max_tokens, stop_sequences)))
+                for prompt in prompts
+            ]
+            progress_bar = tqdm(total=len(tasks), desc="Evaluating prompt cases", disable=not self.verbose)
+            for task in tasks:
+                task.add_done_callback(lambda _: progress_bar.update(1))
+            try:
+                outputs = await asyncio.gather(*tasks)
+            finally:
+                for task in tasks:
+                    task.cancel()
+                progress_bar.close()
+        return [output.strip() for output in outputs]
+
+    def generate(self, prompts: List[str], max_tokens: int = 30, stop_sequences: Optional[List[str]] = None) -> List[str]:
+        coroutine = self.agenerate(prompts, max_tokens=max_tokens, stop_sequences=stop_sequences)
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            return asyncio.run(coroutine)
+        # We're already inside an event loop (e.g. in a Jupyter notebook), so we run ours in another thread
+        with ThreadPoolExecutor(1) as executor:
+            return executor.submit(asyncio.run, coroutine).result()
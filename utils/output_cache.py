@@ -0,0 +1,137 @@
+# %%
+
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import torch as t
+from typing import Optional, Union, Dict, List
+from transformer_lens import HookedTransformer
+
+from utils.model_backend import ModelBackend
+
+# %%
+
+class OutputCache:
+    '''
+    On-disk cache of model outputs, so that rerunning an evaluation (e.g. after changing the report, or the eval_type) doesn't
+    regenerate every output. Outputs are keyed by a hash of (model, prompt, decoding params), e.g. max_tokens and the stop
+    sequences.
+
+    The outputs are stored in a sqlite database, along with when each one was last used. Once there are more than
+    `max_entries` outputs, we evict the least recently used ones.
+
+    Models with hooks attached aren't cached (see `has_hooks`), since the hooks can change the outputs.
+
+    Usage:
+        output_cache = OutputCache("results/outputs.sqlite")
+        family.evaluate_all(model, output_cache=output_cache)
+    '''
+    def __init__(self, path: str, max_entries: int = 1_000_000):
+        self.path = path
+        self.max_entries = max_entries
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        self.connection.execute("CREATE TABLE IF NOT EXISTS outputs (key TEXT PRIMARY KEY, output TEXT NOT NULL, last_used INTEGER NOT NULL)")
+        self.connection.execute("CREATE INDEX IF NOT EXISTS outputs_last_used ON outputs (last_used)")
+        self.connection.commit()
+
+    @staticmethod
+    def get_key(model_id: str, prompt: str, **decoding_params) -> str:
+        # (model_id is from `get_model_id`, which we only compute once per run, rather than once per prompt)
+        description = {"model": model_id, "prompt": prompt, **decoding_params}
+        return hashlib.sha1(json.dumps(description, sort_keys=True).encode()).hexdigest()
+
+    def get_many(self, keys: List[str]) -> Dict[str, str]:
+        '''Returns {key: output} for all the keys which are in the cache (and marks them as just used).'''
+        keys = list(dict.fromkeys(keys))
+        outputs = {}
+        # (sqlite limits the number of parameters in a query, so we look them up in chunks)
+        for i in range(0, len(keys), 500):
+            chunk = keys[i: i + 500]
+            rows = self.connection.execute(f"SELECT key, output FROM outputs WHERE key IN ({', '.join('?' * len(chunk))})", chunk)
+            outputs.update(rows)
+        if len(outputs) > 0:
+            now = time.time_ns()
+            self.connection.executemany("UPDATE outputs SET last_used = ? WHERE key = ?", [(now, key) for key in outputs])
+            self.connection.commit()
+        return outputs
+
+    def put_many(self, outputs: Dict[str, str]):
+        '''Adds {key: output} to the cache, and evicts the least recently used outputs if we're over `max_entries`.'''
+        now = time.time_ns()
+        self.connection.executemany("INSERT OR REPLACE INTO outputs VALUES (?, ?, ?)", [(key, output, now) for key, output in outputs.items()])
+        n_evict = len(self) - self.max_entries
+        if n_evict > 0:
+            self.connection.execute("DELETE FROM outputs WHERE key IN (SELECT key FROM outputs ORDER BY last_used LIMIT ?)", (n_evict,))
+        self.connection.commit()
+
+    def __contains__(self, key: str) -> bool:
+        return self.connection.execute("SELECT 1 FROM outputs WHERE key = ?", (key,)).fetchone() is not None
+
+    def __getitem__(self, key: str) -> str:
+        outputs = self.get_many([key])
+        if key not in outputs:
+            raise KeyError(key)
+        return outputs[key]
+
+    def __setitem__(self, key: str, output: str):
+        self.put_many({key: output})
+
+    def __len__(self) -> int:
+        return self.connection.execute("SELECT COUNT(*) FROM outputs").fetchone()[0]
+
+    def clear(self):
+        self.connection.execute("DELETE FROM outputs")
+        self.connection.commit()
+
+
+def get_model_id(model: Union[HookedTransformer, ModelBackend]) -> str:
+    '''
+    Identifies the model for the `OutputCache`. For a `HookedTransformer`, this is its name plus a hash of its config,
+    whether it prepends a BOS token, and a fingerprint of its weights (see `get_weights_fingerprint`), so that e.g. a
+    fine-tuned model, or one with edited weights, doesn't reuse the original model's outputs.
+    '''
+    if not isinstance(model, HookedTransformer):
+        return model.get_model_id()
+    # (the device doesn't change the outputs, so we leave it out)
+    cfg = {name: value for name, value in model.cfg.to_dict().items() if name not in ("device", "n_devices")}
+    description = {
+        "cfg": cfg,
+        "default_prepend_bos": model.cfg.default_prepend_bos,
+        "tokenizer_prepends_bos": model.cfg.tokenizer_prepends_bos,
+        "weights": get_weights_fingerprint(model),
+    }
+    model_hash = hashlib.sha1(json.dumps(description, sort_keys=True, default=str).encode()).hexdigest()[:16]
+    return f"HookedTransformer:{model.cfg.model_name}:{model_hash}"
+
+
+@t.inference_mode()
+def get_weights_fingerprint(model: HookedTransformer, n_samples: int = 64) -> str:
+    '''
+    A cheap hash of the model's weights: for each parameter / buffer, its name, shape & dtype, its sum, and `n_samples`
+    evenly spaced values. This doesn't copy the weights off the device (only the sums and samples), so it's fast even for
+    big models, but it catches any edit which changes a sum or one of the sampled values.
+    '''
+    names, values = [], []
+    for name, tensor in sorted(model.state_dict().items()):
+        names.append((name, list(tensor.shape), str(tensor.dtype)))
+        flat = tensor.detach().flatten()
+        if flat.numel() == 0:
+            continue
+        values.append(flat.sum(dtype=t.float64).unsqueeze(0))
+        values.append(flat[::max(1, flat.numel() // n_samples)][:n_samples].to(t.float64))
+    values = t.cat([value.cpu() for value in values]) if len(values) > 0 else t.zeros(0, dtype=t.float64)
+    return hashlib.sha1(json.dumps(names).encode() + values.numpy().tobytes()).hexdigest()[:16]
+
+
+def has_hooks(model: Union[HookedTransformer, ModelBackend]) -> bool:
+    '''Whether the model has any forward hooks attached (e.g. inside `model.hooks(...)`, or from `model.add_hook`).'''
+    if not isinstance(model, HookedTransformer):
+        return False
+    return any(module._forward_hooks or module._forward_pre_hooks for module in model.modules())
+
+
+def get_output_cache(output_cache: Optional[Union[str, OutputCache]]) -> Optional[OutputCache]:
+    return OutputCache(output_cache) if isinstance(output_cache, str) else output_cache
@@ -14,7 +14,12 @@ from tqdm.auto import tqdm
 from jaxtyping import Float, Int
 from collections import defaultdict
 import einops
+import copy
+import inspect
 import re
+from utils.activation_store import ActivationStore
+from utils.journal import SweepJournal, get_journal
+from utils.output_cache import get_model_id
 
 # %%
 
@@ -29,13 +34,21 @@ def relevant_names_filter(name: str):
     ]])
 
 def hook_fn_generic_patching(activation: Float[Tensor, "..."], hook: HookPoint, cache: ActivationCache) -> Float[Tensor, "..."]:
-    '''Patches entire tensor of activations, from corresponding values in cache.'''
-    activation[:] = cache[hook.name][:]
+    '''
+    Patches entire tensor of activations, from corresponding values in cache.
+
+    If the activations come from a replicated batch (see `get_replica_indices`), every replica gets patched with the cached values.
+    '''
+    new_activations = cache[hook.name]
+    activation.unflatten(0, (-1, new_activations.shape[0]))[:] = new_activations
     return activation
 
-def hook_fn_generic_caching(activation: Float[Tensor, "..."], hook: HookPoint, name: str = "activation") -> Float[Tensor, "..."]:
-    '''Stores activations in hook context.'''
-    hook.ctx[name] = activation
+def hook_fn_generic_caching(activation: Float[Tensor, "..."], hook: HookPoint, name: str = "activation", clone: bool = False) -> Float[Tensor, "..."]:
+    '''
+    Stores activations in hook context. Use clone=True if a later hook might modify this tensor in place, e.g. resid_post at
+    one layer is the same tensor as resid_pre at the next layer, which patching hooks write into.
+    '''
+    hook.ctx[name] = activation.clone() if clone else activation
     return activation
 
 def hook_fn_generic_patching_from_context(activation: Float[Tensor, "..."], hook: HookPoint, name: str = "activation", add: bool = False) -> Float[Tensor, "..."]:
@@ -47,6 +60,66 @@ def hook_fn_generic_patching_from_context(activation: Float[Tensor, "..."], hook
             activation[:] = hook.ctx[name][:]
     return activation
 
+def get_ablated_activations(activation: Float[Tensor, "batch ..."], ablation: Literal["zero", "mean"]) -> Float[Tensor, "batch ..."]:
+    '''
+    Returns the values we patch in for zero / mean ablation, with the same shape as `activation`. These are expanded views
+    (of a single zero, or of the mean over the batch), so we never materialize a full tensor of zeros or means.
+    '''
+    if ablation == "zero":
+        return activation.new_zeros(()).expand_as(activation)
+    assert ablation == "mean", f"Unknown ablation type {ablation!r}, should be 'zero' or 'mean'."
+    return activation.mean(0, keepdim=True).expand_as(activation)
+
+def get_new_activations(
+    new_cache: Union[ActivationCache, Literal["zero", "mean"]],
+    name: str,
+    orig_activation: Float[Tensor, "batch ..."],
+) -> Float[Tensor, "batch ..."]:
+    '''
+    Returns the activations we're patching in at hook `name`. If new_cache is "zero" or "mean" then we don't need a cache at all,
+    we ablate the orig activations. Note that caches of means over a reference dataset (see `get_mean_cache`) have batch size 1,
+    so these need to be broadcast.
+    '''
+    if isinstance(new_cache, str):
+        return get_ablated_activations(orig_activation, new_cache)
+    return new_cache[name]
+
+def hook_fn_batched_patching(
+    activation: Float[Tensor, "..."],
+    hook: HookPoint,
+    index: Tuple[Int[Tensor, "n_idx"], ...],
+    cache: Union[str, ActivationCache],
+    source_index: Optional[Tuple[Int[Tensor, "n_idx"], ...]] = None,
+    batch_size: Optional[int] = None,
+) -> Float[Tensor, "..."]:
+    '''
+    Patches activations at `index` (a tuple of index tensors into the replicated batch, see `get_replica_indices`), from
+    corresponding values in cache (or in hook context, if cache is a string).
+
+    By default we take the values at the same index in the source tensor. The source tensor might have the original batch
+    size rather than the replicated one, so we take the batch index modulo its batch size (this is the identity otherwise).
+    If `source_index` is given, we use that instead.
+
+    If cache is "zero" or "mean", we ablate in place instead. For mean ablation, each replica gets the mean over its own batch
+    (so we need `batch_size`, to know where the replicas are).
+    '''
+    index = tuple(i.to(activation.device) for i in index)
+    if cache == "zero":
+        activation[index] = 0.0
+        return activation
+    elif cache == "mean":
+        assert batch_size is not None, "Need to know the batch size to do mean ablation on a replicated batch."
+        means = activation.unflatten(0, (-1, batch_size)).mean(1)
+        activation[index] = means[(index[0] // batch_size,) + index[1:]]
+        return activation
+    new_activations = hook.ctx[cache] if isinstance(cache, str) else cache[hook.name]
+    if source_index is None:
+        source_index = (index[0] % new_activations.shape[0],) + index[1:]
+    else:
+        source_index = tuple(i.to(activation.device) for i in source_index)
+    activation[index] = new_activations[source_index]
+    return activation
+
 def get_hook_name_filter(model: HookedTransformer):
     # TODO - this seems dumb, should it be fixed in TL? Add a pull request for it?
     '''
@@ -63,6 +136,10 @@ def get_hook_name_filter(model: HookedTransformer):
             return False
         elif any([name.endswith(f"{c}_normalized_input") for c in "qkv"]) and (not model.cfg.use_split_qkv_normalized_input):
             return False
+        elif name.endswith("attn_in") and (not model.cfg.use_attn_in):
+            return False
+        elif name.endswith("mlp_in") and (not model.cfg.use_hook_mlp_in):
+            return False
         elif name.endswith("hook)tokens") and (not model.cfg.use_hook_tokens):
             return False
         return True
@@ -246,6 +323,9 @@ class Node:
                 of receiver nodes with the values which were stored in context. In this case, cache
                 is actually a string (the key in the hook.ctx dict).
 
+        cache can also be "zero" or "mean", in which case we ablate the activations in place (mean
+        ablation uses the mean over the batch).
+
         The key feature of this method is that it gives us a function which patches at specific sequence positions / heads / neurons. It doesn't just patch everywhere!
         '''
         def hook_fn(activations: Float[Tensor, "..."], hook: HookPoint) -> Float[Tensor, "..."]:
@@ -266,12 +346,15 @@ class Node:
             if self.neuron is not None: idx[-1] = self.neuron
 
             # Now, patch the values in our activations tensor, and return the new activation values
-            if isinstance(cache, str):
+            # (the cache might have batch size 1 if it's a cache of means, so we broadcast it)
+            if cache in ["zero", "mean"]:
+                new_activations = get_ablated_activations(activations, cache)
+            elif isinstance(cache, str):
                 new_activations = hook.ctx[cache]
             else:
-                new_activations = cache[hook.name]
+                new_activations = cache[hook.name].expand_as(activations)
             
-            activations[idx] = new_activations[idx]
+            activations[tuple(idx)] = new_activations[tuple(idx)]
             return activations
 
         return hook_fn
@@ -463,10 +546,493 @@ def get_batch_and_seq_pos_indices(seq_pos, batch_size, seq_len):
         seq_sub_pos_len = seq_pos.shape[1]
         seq_pos_indices = seq_pos
         batch_indices = einops.repeat(t.arange(batch_size), "batch -> batch seq_sub_pos", seq_sub_pos=seq_sub_pos_len)
-    
+
     return batch_indices, seq_pos_indices
 
 
+def get_cache(
+    model: HookedTransformer,
+    input: Union[str, List[str], Int[Tensor, "batch seq_len"]],
+    names: List[str],
+    activation_store: Optional[ActivationStore] = None,
+) -> ActivationCache:
+    '''
+    Runs the model on `input` and returns a cache of the activations in `names`. If `activation_store` is given, we read them
+    from disk where possible (and write any new ones to disk), rather than always recomputing them.
+    '''
+    if activation_store is not None:
+        return activation_store.get_cache(model, input, names_filter=names)
+    _, cache = model.run_with_cache(input, return_type=None, names_filter=lambda name: name in names)
+    return cache
+
+
+def get_activation_names(model: HookedTransformer, nodes: Union[IterNode, Node, List[Node]], receiver: bool = False) -> List[str]:
+    '''
+    Returns the names of all the hook points that `nodes` refer to (for an `IterNode`, this is every layer of each component).
+
+    If `receiver` is True, we also include the names that receivers get split or converted into when we patch them, e.g. "pattern"
+    is split into "q" and "k", and "q" is converted into "q_input" when direct_includes_mlps=False.
+    '''
+    if isinstance(nodes, Node): nodes = [nodes]
+    if isinstance(nodes, IterNode):
+        components_and_layers = [(name, layer) for name in nodes.component_names for layer in range(model.cfg.n_layers)]
+    else:
+        components_and_layers = [(node.component_name, node.layer) for node in nodes]
+
+    names = []
+    for component_name, layer in components_and_layers:
+        component_names = [component_name]
+        if receiver:
+            if component_name == "pattern": component_names = ["q", "k"]
+            component_names += [f"{name}_input" for name in component_names if name in ["q", "k", "v"]]
+        names.extend([utils.get_act_name(name, layer) for name in component_names])
+
+    # Remove duplicates (keeping the order), and names which never fire (e.g. q_input if we're not using split qkv input). Note that
+    # we can't just check `model.hook_dict` for this, since those hook points exist whether or not the config uses them.
+    name_filter = get_hook_name_filter(model)
+    return [name for name in dict.fromkeys(names) if (name in model.hook_dict) and name_filter(name)]
+
+
+def get_path_patching_names(
+    model: HookedTransformer,
+    sender_nodes: Union[IterNode, Node, List[Node]],
+    receiver_nodes: Union[IterNode, Node, List[Node]],
+    direct_includes_mlps: bool = True,
+    resume_from_patched_layer: bool = False,
+) -> Tuple[List[str], List[str]]:
+    '''
+    Returns the names of the activations we need to cache in order to do path patching, as (orig_names, new_names). This way, the
+    caches scale with the circuit we're studying rather than with the model size.
+
+        orig: the senders (to compute the diffs), the receivers (we need their shapes), everything we freeze (if we freeze at all),
+              and resid_pre at every layer (if we're resuming forward passes from the first patched layer)
+        new:  the senders (we patch these in)
+    '''
+    sender_names = get_activation_names(model, sender_nodes)
+    receiver_names = get_activation_names(model, receiver_nodes, receiver=True)
+
+    # These are the same filters as in the freezing hooks of `_path_patch_single` (which we only use if we're doing the 3-step algorithm)
+    receiver_components = receiver_nodes.component_names if isinstance(receiver_nodes, IterNode) else [
+        node.component_name for node in ([receiver_nodes] if isinstance(receiver_nodes, Node) else receiver_nodes)
+    ]
+    freezing_names = []
+    if direct_includes_mlps or ("pre" in receiver_components):
+        freezing_names = [
+            name for name in model.hook_dict
+            if name.endswith("z") or ((not direct_includes_mlps) and name.endswith("post"))
+        ]
+
+    resid_pre_names = [utils.get_act_name("resid_pre", layer) for layer in range(model.cfg.n_layers)] if resume_from_patched_layer else []
+
+    orig_names = list(dict.fromkeys(sender_names + receiver_names + freezing_names + resid_pre_names))
+    return orig_names, sender_names
+
+
+def get_mean_cache(
+    model: HookedTransformer,
+    reference_input: Union[str, List[str], Int[Tensor, "batch seq_len"]],
+    names_filter: Optional[Union[Callable, List[str]]] = relevant_names_filter,
+) -> ActivationCache:
+    '''
+    Returns a cache of the mean activations over a reference dataset (e.g. the ABC dataset for IOI), which can be passed as
+    `new_cache` to `act_patch` or `path_patch` to do mean ablation.
+
+    Each activation has batch size 1 (it's broadcast over the batch when we patch), and we keep the seq_pos dimension, so the
+    reference dataset should have the same sequence length as orig_input.
+    '''
+    _, cache = model.run_with_cache(reference_input, return_type=None, names_filter=names_filter)
+    return ActivationCache({name: activation.mean(0, keepdim=True) for name, activation in cache.items()}, model=model)
+
+
+class ActivationStats:
+    '''
+    Running mean & variance of activations (per hook and per sequence position), accumulated over a dataset one minibatch at a
+    time. We only keep the summary statistics, not the activations, so the dataset can be much bigger than what we could fit
+    in a single `ActivationCache`.
+
+    Indexing gives the mean with batch size 1 (same as `get_mean_cache`), so this can be passed as `new_cache` to `act_patch` or
+    `path_patch` to do mean ablation over the dataset. As with `get_mean_cache`, the dataset's sequence length should be the same
+    as orig_input's (for IOI, padding positions are included in the statistics like any other position).
+
+    Usage:
+        stats = ActivationStats.from_dataset(model, ioi_dataset, batch_size=64)
+        stats.save("abc_stats.pt")
+        ...
+        stats = ActivationStats.load("abc_stats.pt")
+        results = act_patch(model, orig_input, IterNode("z"), patching_metric, new_cache=stats)
+    '''
+    def __init__(self):
+        self.count = 0
+        # Accumulate in float64, since we're summing over lots of minibatches
+        self.means: Dict[str, Float[Tensor, "pos ..."]] = {}
+        self.m2s: Dict[str, Float[Tensor, "pos ..."]] = {}
+        self.dtypes: Dict[str, t.dtype] = {}
+        # Sum of the non-finite values (e.g. the masked attention scores, which are -inf), only for hooks which have any
+        self.nonfinite_sums: Dict[str, Float[Tensor, "pos ..."]] = {}
+
+    def update(self, activations: Dict[str, Float[Tensor, "batch pos ..."]]):
+        '''
+        Adds a minibatch of activations (e.g. an `ActivationCache`) to the running statistics. We combine the minibatch's mean &
+        sum of squared deviations with the running ones (Chan et al's parallel version of Welford's algorithm).
+
+        Non-finite values would turn the running statistics into nan (since -inf - -inf = nan), so we accumulate their sum
+        separately and treat them as zero in the running mean. Adding the two back together gives the same result as taking the
+        mean over the whole dataset at once, e.g. -inf where the attention scores are masked.
+        '''
+        batch_size = next(iter(activations.values())).shape[0]
+        total = self.count + batch_size
+        for name, activation in activations.items():
+            activation = activation.detach().double()
+            finite = activation.isfinite()
+            if not finite.all():
+                nonfinite_sum = t.where(finite, t.zeros_like(activation), activation).sum(0)
+                self.nonfinite_sums[name] = nonfinite_sum if name not in self.nonfinite_sums else self.nonfinite_sums[name] + nonfinite_sum
+                activation = t.where(finite, activation, t.zeros_like(activation))
+            batch_mean = activation.mean(0)
+            batch_m2 = ((activation - batch_mean) ** 2).sum(0)
+            if self.count == 0:
+                self.means[name] = batch_mean
+                self.m2s[name] = batch_m2
+                self.dtypes[name] = activations[name].dtype
+            else:
+                delta = batch_mean - self.means[name]
+                self.means[name] = self.means[name] + delta * (batch_size / total)
+                self.m2s[name] = self.m2s[name] + batch_m2 + delta ** 2 * (self.count * batch_size / total)
+        self.count = total
+
+    @classmethod
+    def from_dataset(
+        cls,
+        model: HookedTransformer,
+        dataset: Union["IOIDataset", Int[Tensor, "batch seq_len"]],
+        batch_size: int = 32,
+        names_filter: Optional[Union[Callable, List[str]]] = relevant_names_filter,
+        verbose: bool = False,
+    ) -> "ActivationStats":
+        '''
+        Streams `dataset` (an `IOIDataset`, or a tensor of tokens) through the model in minibatches of size `batch_size`, and
+        returns the statistics of all activations which pass `names_filter`.
+        '''
+        tokens = dataset.toks if hasattr(dataset, "toks") else dataset
+        stats = cls()
+        model.reset_hooks()
+        for i in tqdm(range(0, tokens.shape[0], batch_size), disable=not verbose):
+            _, cache = model.run_with_cache(tokens[i: i + batch_size], return_type=None, names_filter=names_filter)
+            stats.update(cache)
+            del cache
+        return stats
+
+    def mean(self, name: str) -> Float[Tensor, "1 pos ..."]:
+        mean = self.means[name]
+        if name in self.nonfinite_sums:
+            # (finite + 0 where every value was finite, otherwise -inf / inf / nan like a mean over the non-finite values)
+            mean = mean + self.nonfinite_sums[name]
+        return mean.to(self.dtypes[name]).unsqueeze(0)
+
+    def var(self, name: str) -> Float[Tensor, "1 pos ..."]:
+        '''Population variance (i.e. same as `unbiased=False` in PyTorch, so nan wherever there were non-finite values).'''
+        var = self.m2s[name] / self.count
+        if name in self.nonfinite_sums:
+            var = var + self.nonfinite_sums[name] * 0
+        return var.to(self.dtypes[name]).unsqueeze(0)
+
+    def __getitem__(self, key: Union[str, Tuple]) -> Float[Tensor, "1 pos ..."]:
+        '''Same indexing as `ActivationCache`, e.g. stats["z", 0] or stats["blocks.0.attn.hook_z"].'''
+        name = key if isinstance(key, str) else utils.get_act_name(*key)
+        return self.mean(name)
+
+    def __contains__(self, name: str) -> bool:
+        return name in self.means
+
+    def keys(self):
+        return self.means.keys()
+
+    def to_cache(self, model: HookedTransformer) -> ActivationCache:
+        '''Returns the means as an `ActivationCache` (same format as `get_mean_cache`).'''
+        return ActivationCache({name: self.mean(name) for name in self.keys()}, model=model)
+
+    def save(self, path: str):
+        t.save({"count": self.count, "means": self.means, "m2s": self.m2s, "dtypes": self.dtypes, "nonfinite_sums": self.nonfinite_sums}, path)
+
+    @classmethod
+    def load(cls, path: str, map_location: Optional[Union[str, t.device]] = None) -> "ActivationStats":
+        state = t.load(path, map_location=map_location)
+        stats = cls()
+        stats.count, stats.means, stats.m2s, stats.dtypes = state["count"], state["means"], state["m2s"], state["dtypes"]
+        stats.nonfinite_sums = state.get("nonfinite_sums", {})
+        return stats
+
+
+def get_replica_indices(node: Node, seq_pos: SeqPos, replica: int, batch_size: int, seq_len: int) -> Tuple[Int[Tensor, "n_idx"], ...]:
+    '''
+    Used for batched patching, where we stack copies ("replicas") of our input along the batch dimension, and patch a different
+    node into each copy. The `replica`-th copy occupies rows [replica * batch_size, (replica + 1) * batch_size) of the batch.
+
+    Returns a tuple of 1D index tensors, which pick out exactly the activations that `node.get_patching_hook_fn` would patch
+    (i.e. same sequence positions / heads / neurons), but shifted into the rows of this replica. In other words:
+
+        activations[get_replica_indices(...)]
+
+    is the flattened set of values we patch for this replica.
+    '''
+    batch_indices, seq_pos_indices = get_batch_and_seq_pos_indices(seq_pos, batch_size, seq_len)
+    if isinstance(batch_indices, slice):
+        batch_indices, seq_pos_indices = t.meshgrid(t.arange(batch_size), t.arange(seq_len), indexing="ij")
+    batch_indices = (batch_indices + replica * batch_size).flatten()
+    seq_pos_indices = seq_pos_indices.flatten()
+
+    # Attn patterns have shape (batch, head, seqQ, seqK) not (batch, seq, ...), see `Node.get_patching_hook_fn`
+    if any(s in node.activation_name for s in ["pattern", "score"]):
+        assert seq_pos is None, "Can't patch attention patterns/scores at specific sequence positions (ambiguous whether this is query or key positions)."
+        batch_indices = t.arange(batch_size) + replica * batch_size
+        return (batch_indices,) if node.head is None else (batch_indices, t.full_like(batch_indices, node.head))
+
+    index = (batch_indices, seq_pos_indices)
+    if node.head is not None: index += (t.full_like(batch_indices, node.head),)
+    if node.neuron is not None: index += (t.full_like(batch_indices, node.neuron),)
+    return index
+
+
+def get_batched_patching_hooks(
+    nodes: List[Tuple[SeqPos, Union[Node, List[Node]]]],
+    cache: Union[str, ActivationCache],
+    batch_size: int,
+    seq_len: int,
+    source_replicas: Optional[List[int]] = None,
+) -> List[Tuple[str, Callable]]:
+    '''
+    Returns a list of (hook_name, hook_fn) tuples, which patch the i-th node in `nodes` into the i-th replica of the batch
+    (the i-th element of `nodes` can also be a list of nodes, in which case they're all patched into the i-th replica).
+
+    All the nodes at the same hook point get combined into a single hook function (so it's one vectorized indexing operation
+    per hook point, rather than one per node). We also group by the number of index tensors, so that e.g. a "z" node with
+    a head and a "z" node without one don't get concatenated together.
+
+    By default the values for the i-th replica are read from the same rows of the source (see `hook_fn_batched_patching`).
+    If `source_replicas` is given, they're read from replica `source_replicas[i]` of the source instead.
+    '''
+    indices_by_hook = defaultdict(list)
+    source_indices_by_hook = defaultdict(list)
+    for replica, (seq_pos, replica_nodes) in enumerate(nodes):
+        for node in ([replica_nodes] if isinstance(replica_nodes, Node) else replica_nodes):
+            index = get_replica_indices(node, seq_pos, replica, batch_size, seq_len)
+            indices_by_hook[(node.activation_name, len(index))].append(index)
+            if source_replicas is not None:
+                source_batch_indices = index[0] + (source_replicas[replica] - replica) * batch_size
+                source_indices_by_hook[(node.activation_name, len(index))].append((source_batch_indices,) + index[1:])
+
+    return [
+        (hook_name, partial(
+            hook_fn_batched_patching,
+            index=tuple(t.cat(i) for i in zip(*indices)),
+            cache=cache,
+            source_index=tuple(t.cat(i) for i in zip(*source_indices_by_hook[(hook_name, n_idx)])) if source_replicas is not None else None,
+            batch_size=batch_size,
+        ))
+        for (hook_name, n_idx), indices in indices_by_hook.items()
+    ]
+
+
+class CleanPrefix:
+    '''
+    Stores the residual stream at every layer boundary of the clean (orig) forward pass, so that we can restart the forward
+    pass from the first layer we're patching at. Everything before that layer is identical to the clean run, so there's no
+    point recomputing it for every single patch.
+
+    Usage:
+        clean_prefix = CleanPrefix(model, orig_input)
+        logits = clean_prefix.forward(start_at_layer=5)   # same as model(orig_input) with whatever hooks are added, as
+                                                          # long as none of them are before layer 5
+    '''
+    def __init__(
+        self,
+        model: HookedTransformer,
+        orig_input: Union[str, List[str], Int[Tensor, "batch pos"]],
+        orig_cache: Optional[ActivationCache] = None,
+    ):
+        self.model = model
+        model.reset_hooks()
+        # We need these for the resumed forward pass (tokens for the loss, the others are usually None)
+        _, self.tokens, self.shortformer_pos_embed, self.attention_mask = model.input_to_embed(orig_input)
+        # If we already have a clean cache with the residual stream in it, we don't need to do another forward pass
+        resid_pre_names = [utils.get_act_name("resid_pre", layer) for layer in range(model.cfg.n_layers)]
+        if (orig_cache is None) or any(name not in orig_cache.cache_dict for name in resid_pre_names):
+            _, orig_cache = model.run_with_cache(orig_input, return_type=None, names_filter=lambda name: name in resid_pre_names)
+        self.resid_pre = [orig_cache[name] for name in resid_pre_names]
+
+    @staticmethod
+    def get_start_layer(nodes: Union[Node, List[Node]]) -> Optional[int]:
+        '''
+        Returns the earliest layer we can resume the forward pass from, if we're patching at all of `nodes`. Everything in
+        a block (resid_pre, z, attn_out, mlp_out, post, ...) is computed after that block's resid_pre, so we can start at
+        the node's layer. Nodes without a layer (e.g. the embeddings) mean we have to run the whole thing, so we return None
+        (note that starting at layer 0 isn't enough, since TransformerLens skips the embedding hooks when start_at_layer=0).
+        '''
+        if isinstance(nodes, Node): nodes = [nodes]
+        if any(node.layer is None for node in nodes): return None
+        return min([node.layer for node in nodes])
+
+    @staticmethod
+    def get_stop_layer(nodes: Union[Node, List[Node]]) -> Optional[int]:
+        '''
+        Returns the layer we can stop the forward pass at (exclusive), if all we need is the value of `nodes`. If any of the
+        nodes don't have a layer (e.g. they're after the final layernorm), then we have to run the whole thing.
+        '''
+        if isinstance(nodes, Node): nodes = [nodes]
+        if any(node.layer is None for node in nodes): return None
+        return max([node.layer for node in nodes]) + 1
+
+    def forward(self, start_at_layer: Optional[int], n_replicas: int = 1, **kwargs):
+        '''
+        Runs the model from `start_at_layer` onwards (with all current hooks), on `n_replicas` copies of the clean input. If
+        `start_at_layer` is None, we run the whole forward pass from the tokens (see `get_start_layer`).
+        '''
+        repeat = lambda x: x if (x is None or n_replicas == 1) else einops.repeat(x, "batch ... -> (replica batch) ...", replica=n_replicas)
+        if start_at_layer is None:
+            return self.model(repeat(self.tokens), **kwargs)
+        return self.model(
+            # Clone, because patching hooks on `resid_pre` modify the activation in place
+            repeat(self.resid_pre[start_at_layer]).clone(),
+            start_at_layer=start_at_layer,
+            tokens=repeat(self.tokens),
+            shortformer_pos_embed=repeat(self.shortformer_pos_embed),
+            attention_mask=repeat(self.attention_mask),
+            **kwargs,
+        )
+
+    def run_with_hooks(self, start_at_layer: Optional[int], fwd_hooks: List[Tuple], n_replicas: int = 1, **kwargs):
+        '''Same as `forward`, but with temporary hooks (like `model.run_with_hooks`, this doesn't clear hook contexts).'''
+        with self.model.hooks(fwd_hooks=fwd_hooks):
+            return self.forward(start_at_layer, n_replicas, **kwargs)
+
+
+def get_metric_per_replica(
+    model: HookedTransformer,
+    tokens: Int[Tensor, "batch_replicated pos"],
+    n_replicas: int,
+    patching_metric: Union[Callable, Literal["loss", "loss_per_token"]],
+    apply_metric_to_cache: bool = False,
+    names_filter_for_cache_metric: Optional[Callable] = None,
+    clean_prefix: Optional[CleanPrefix] = None,
+    start_at_layer: Optional[int] = None,
+) -> List:
+    '''
+    Runs the model on a replicated batch of tokens (with whatever hooks are currently added), then splits the output back
+    into `n_replicas` pieces and applies the patching metric to each one separately. Returns a list of `n_replicas` results,
+    each of which is the same as what we'd have got by running the non-batched version of patching.
+
+    If `clean_prefix` is given, we skip the layers before `start_at_layer` and resume from the clean residual stream there.
+    '''
+    batch_size = tokens.shape[0] // n_replicas
+
+    if apply_metric_to_cache:
+        assert clean_prefix is None, "Can't resume from the clean prefix when applying the metric to the cache."
+        _, cache = model.run_with_cache(tokens, return_type=None, names_filter=names_filter_for_cache_metric)
+        model.reset_hooks()
+        return [
+            patching_metric(ActivationCache({k: v[i * batch_size: (i + 1) * batch_size] for k, v in cache.items()}, model=model))
+            for i in range(n_replicas)
+        ]
+
+    logits = model(tokens) if clean_prefix is None else clean_prefix.forward(start_at_layer, n_replicas)
+    model.reset_hooks()
+    results = []
+    for i in range(n_replicas):
+        replica_logits = logits[i * batch_size: (i + 1) * batch_size]
+        if isinstance(patching_metric, str):
+            results.append(model.loss_fn(replica_logits, tokens[i * batch_size: (i + 1) * batch_size], per_token=(patching_metric == "loss_per_token")))
+        else:
+            results.append(patching_metric(replica_logits))
+    return results
+
+
+
+def get_sender_diff(
+    model: HookedTransformer,
+    sender_node: Node,
+    orig_cache: ActivationCache,
+    new_cache: Union[ActivationCache, Literal["zero", "mean"]],
+    batch_indices: Union[slice, Int[Tensor, "batch pos"]],
+    seq_pos_indices: Union[slice, Int[Tensor, "batch pos"]],
+) -> Float[Tensor, "batch pos d_model"]:
+    '''
+    Calculates (new_sender_output - orig_sender_output) for this sender, as something of shape d_model (i.e. it's the change in
+    what the sender writes to the residual stream). Used for path patching when direct_includes_mlps = False. The new_cache can
+    also be "zero" or "mean" (see `get_new_activations`).
+    '''
+    orig_activation = orig_cache[sender_node.activation_name]
+    diff = get_new_activations(new_cache, sender_node.activation_name, orig_activation) - orig_activation
+    diff = diff[batch_indices, seq_pos_indices]
+
+    # If it's post neuron activations, we map through W_out (maybe just taking one neuron)
+    if sender_node.component_name == "post":
+        neuron_slice = slice(None) if sender_node.neuron is None else [sender_node.neuron]
+        diff = einops.einsum(
+            diff[..., neuron_slice], model.W_out[sender_node.layer, neuron_slice],
+            "batch pos d_mlp, d_mlp d_model -> batch pos d_model"
+        )
+    # If it's the "z" part of attn heads, we map through W_O (maybe just taking one head)
+    elif sender_node.component_name == "z":
+        head_slice = slice(None) if sender_node.head is None else [sender_node.head]
+        diff = einops.einsum(
+            diff[..., head_slice, :], model.W_O[sender_node.layer, head_slice],
+            "batch pos n_heads d_head, n_heads d_head d_model -> batch pos d_model"
+        )
+    # If not in these two cases, it's one of resid_pre/mid/post, or attn_out/mlp_out/result, and so should already be something with shape (batch, subseq_len, d_model)
+    return diff
+
+
+def add_sender_diff_to_receiver_context(
+    model: HookedTransformer,
+    diff: Float[Tensor, "batch pos d_model"],
+    receiver_node: Node,
+    orig_cache: ActivationCache,
+    batch_indices: Union[slice, Int[Tensor, "batch pos"]],
+    seq_pos_indices: Union[slice, Int[Tensor, "batch pos"]],
+    n_replicas: int = 1,
+) -> Node:
+    '''
+    Adds a sender diff (from `get_sender_diff`) into the "receiver_activations" context of this receiver's hook point, and adds a hook
+    which will add these values to the receiver's input when we run the model. Used for path patching when direct_includes_mlps = False.
+
+    If n_replicas > 1, the context tensor has n_replicas copies of the batch (and batch_indices should be offset to the right replica).
+
+    Returns the receiver node, which might have been converted (e.g. q -> q_input, since that's where we have to add the diff).
+    '''
+    if receiver_node.component_name in ["q", "k", "v", "q_input", "k_input", "v_input"]:
+        assert model.cfg.use_split_qkv_input, "Direct patching (direct_includes_mlps=False) requires use_split_qkv_input=True. Please change your model config."
+        
+        # q/k/v should be converted into q_input/k_input/v_input
+        if receiver_node.component_name in ["q", "k", "v"]: 
+            receiver_node = Node(f"{receiver_node.component_name}_input", layer=receiver_node.layer, head=receiver_node.head)
+
+    # If this is the first time we've used a receiver node within this activation, we populate the context dict
+    # (and add hooks to eventually do patching)
+    hook = model.hook_dict[receiver_node.activation_name]
+    if len(hook.ctx) == 0:
+        orig_activations = orig_cache[receiver_node.activation_name]
+        hook.ctx["receiver_activations"] = orig_activations.new_zeros((n_replicas * orig_activations.shape[0], *orig_activations.shape[1:]))
+        model.add_hook(
+            receiver_node.activation_name,
+            partial(hook_fn_generic_patching_from_context, name="receiver_activations", add=True), 
+            level=1
+        )
+
+    if receiver_node.component_name in ["q_input", "k_input", "v_input"]:
+        # The diff is (batch, pos, d_model) and q/k/v_input are (batch, pos, head, d_model), so we add a head dim to the diff
+        # and broadcast it over the heads we're patching. We slice the head (rather than indexing with [head]) so that the
+        # head dim is kept whether batch_indices & seq_pos_indices are slices or tensors
+        head_slice = slice(None) if (receiver_node.head is None) else slice(receiver_node.head, receiver_node.head + 1)
+        hook.ctx["receiver_activations"][batch_indices, seq_pos_indices, head_slice] += diff.unsqueeze(-2)
+    
+    # The remaining case (given that we aren't handling "pre" here) is when receiver is resid_pre/mid/post
+    else:
+        assert "resid_" in receiver_node.component_name
+        hook.ctx["receiver_activations"][batch_indices, seq_pos_indices] += diff
+
+    return receiver_node
+
+
 
 def _path_patch_single(
     model: HookedTransformer,
@@ -475,11 +1041,12 @@ def _path_patch_single(
     receiver: Union[Node, List[Node]],
     patching_metric: Union[Callable, Literal["loss", "loss_per_token"]],
     orig_cache: ActivationCache,
-    new_cache: ActivationCache,
+    new_cache: Union[ActivationCache, Literal["zero", "mean"]],
     seq_pos: _SeqPos = None,
     apply_metric_to_cache: bool = False,
     names_filter_for_cache_metric: Optional[Callable] = None,
     direct_includes_mlps: bool = True,
+    clean_prefix: Optional[CleanPrefix] = None,
 ) -> Float[Tensor, ""]:
     '''
     This function gets called by the main `path_patch` function, when direct_includes_mlps = False. It shouldn't be called directly by user.
@@ -509,6 +1076,8 @@ def _path_patch_single(
           we'll be patching at for the i-th element of the batch. The main path_patch function handles the conversion of seq_pos from ints to 2D tensors.
         * If one of the receiver nodes is 'pre', then we actually perform the 3-step algorithm rather than the 2-step algorithm. This is because there's no "mlp split input by neuron" in
           the same way as there's a "by head (and input type) split" for attention heads.
+        * If `clean_prefix` is given, we skip the layers which are the same as the orig forward pass. In step (2) everything before the earliest sender or receiver is unchanged (and we can
+          stop after the last receiver, since we only need to cache the receivers), and in step (3) everything before the earliest receiver is unchanged.
     '''
     # Call this at the start, just in case! This also clears context by default
     model.reset_hooks()
@@ -519,7 +1088,8 @@ def _path_patch_single(
     assert isinstance(_sender_nodes, list) and isinstance(_receiver_nodes, list)
 
     # Get slices for sequence position
-    batch_size, seq_len = orig_cache["z", 0].shape[:2]
+    orig_tokens = orig_input if isinstance(orig_input, Tensor) else model.to_tokens(orig_input)
+    batch_size, seq_len = orig_tokens.shape
     batch_indices, seq_pos_indices = get_batch_and_seq_pos_indices(seq_pos, batch_size, seq_len)
 
     # Check the nodes are valid, and split them, e.g. Node(pattern) becomes [Node(q), Node(k)]
@@ -551,15 +1121,23 @@ def _path_patch_single(
 
         # Get all the hooks we need for caching receiver nodes
         for node in receiver_nodes:
-            hooks_for_caching_receivers.append((node.activation_name, partial(hook_fn_generic_caching, name="receiver_activations")))
+            hooks_for_caching_receivers.append((node.activation_name, partial(hook_fn_generic_caching, name="receiver_activations", clone=True)))
 
         # Now add all the hooks in order. Note that patching should override freezing, and caching should happen before both.
-        model.run_with_hooks(
-            orig_input,
-            return_type=None,
-            fwd_hooks=hooks_for_caching_receivers + hooks_for_freezing + hooks_for_patching_senders,
-            clear_contexts=False # This is the default anyway, but just want to be sure!
-        )
+        if clean_prefix is None:
+            model.run_with_hooks(
+                orig_input,
+                return_type=None,
+                fwd_hooks=hooks_for_caching_receivers + hooks_for_freezing + hooks_for_patching_senders,
+                clear_contexts=False # This is the default anyway, but just want to be sure!
+            )
+        else:
+            clean_prefix.run_with_hooks(
+                start_at_layer=CleanPrefix.get_start_layer(sender_nodes + receiver_nodes),
+                fwd_hooks=hooks_for_caching_receivers + hooks_for_freezing + hooks_for_patching_senders,
+                stop_at_layer=CleanPrefix.get_stop_layer(receiver_nodes),
+                return_type=None,
+            )
         # Result - we've now cached the receiver nodes (i.e. stored them in the appropriate hook contexts)
 
 
@@ -574,84 +1152,39 @@ def _path_patch_single(
 
     else:
         # Calculate the (new_sender_output - orig_sender_output) for every sender, as something of shape d_model
-        sender_diffs = {}
-        for sender_node in sender_nodes:
-
-            diff = new_cache[sender_node.activation_name] - orig_cache[sender_node.activation_name]
-            diff = diff[batch_indices, seq_pos_indices]
-
-            # If it's post neuron activations, we map through W_out (maybe just taking one neuron)
-            if sender_node.component_name == "post":
-                neuron_slice = slice(None) if sender_node.neuron is None else [sender_node.neuron]
-                diff = einops.einsum(
-                    diff[..., neuron_slice], model.W_out[sender_node.layer, neuron_slice],
-                    "batch pos d_mlp, d_mlp d_model -> batch pos d_model"
-                )
-            # If it's the "z" part of attn heads, we map through W_O (maybe just taking one head)
-            elif sender_node.component_name == "z":
-                head_slice = slice(None) if sender_node.head is None else [sender_node.head]
-                diff = einops.einsum(
-                    diff[..., head_slice, :], model.W_O[sender_node.layer, head_slice],
-                    "batch pos n_heads d_head, n_heads d_head d_model -> batch pos d_model"
-                )
-            # If not in these two cases, it's one of resid_pre/mid/post, or attn_out/mlp_out/result, and so should already be something with shape (batch, subseq_len, d_model)
-            sender_diffs[sender_node] = diff
-
+        sender_diffs = {
+            sender_node: get_sender_diff(model, sender_node, orig_cache, new_cache, batch_indices, seq_pos_indices)
+            for sender_node in sender_nodes
+        }
 
         # Calculate the sum_over_senders{new_sender_output-orig_sender_output} for every receiver, by taking all the senders before the receiver
         # We add this diff into the hook context, 
         for sender_node, diff in sender_diffs.items():
-
             for i, receiver_node in enumerate(receiver_nodes):
-                
                 # If there's no causal path from sender -> receiver, we skip
                 if not (sender_node < receiver_node):
                     continue
+                receiver_nodes[i] = add_sender_diff_to_receiver_context(model, diff, receiver_node, orig_cache, batch_indices, seq_pos_indices)
 
-                if receiver_node.component_name in ["q", "k", "v", "q_input", "k_input", "v_input"]:
-                    assert model.cfg.use_split_qkv_input, "Direct patching (direct_includes_mlps=False) requires use_split_qkv_input=True. Please change your model config."
-                    
-                    # q/k/v should be converted into q_input/k_input/v_input
-                    if receiver_node.component_name in ["q", "k", "v"]: 
-                        receiver_node = Node(f"{receiver_node.component_name}_input", layer=receiver_node.layer, head=receiver_node.head)
-                        receiver_nodes[i] = receiver_node
-
-                # If this is the first time we've used a receiver node within this activation, we populate the context dict
-                # (and add hooks to eventually do patching)
-                if len(model.hook_dict[receiver_node.activation_name].ctx) == 0:
-                    model.hook_dict[receiver_node.activation_name].ctx["receiver_activations"] = t.zeros_like(orig_cache[receiver_node.activation_name])
-                    model.add_hook(
-                        receiver_node.activation_name,
-                        partial(hook_fn_generic_patching_from_context, name="receiver_activations", add=True), 
-                        level=1
-                    )
-
-                if receiver_node.component_name in ["q_input", "k_input", "v_input"]:
-                    head_slice = slice(None) if (receiver_node.head is None) else [receiver_node.head]
-                    # * TODO - why is this needed?
-                    if diff.shape != model.hook_dict[receiver_node.activation_name].ctx["receiver_activations"][batch_indices, seq_pos_indices, head_slice].shape:
-                        diff = diff.unsqueeze(-2)
-                    model.hook_dict[receiver_node.activation_name].ctx["receiver_activations"][batch_indices, seq_pos_indices, head_slice] += diff
-                
-                # The remaining case (given that we aren't handling "pre" here) is when receiver is resid_pre/mid/post
-                else:
-                    assert "resid_" in receiver_node.component_name
-                    model.hook_dict[receiver_node.activation_name].ctx["receiver_activations"][batch_indices, seq_pos_indices] += diff
-                
 
 
     # Run model on orig with receiver nodes patched from previously cached values.
+    if clean_prefix is not None:
+        forward = partial(clean_prefix.forward, start_at_layer=CleanPrefix.get_start_layer(receiver_nodes))
+    else:
+        forward = partial(model, orig_input)
+
     if apply_metric_to_cache:
         _, cache = model.run_with_cache(orig_input, return_type=None, names_filter=names_filter_for_cache_metric)
         model.reset_hooks()
         return patching_metric(cache)
     else:
         if isinstance(patching_metric, str):
-            loss = model(orig_input, return_type="loss", loss_per_token=(patching_metric=="loss_per_token"))
+            loss = forward(return_type="loss", loss_per_token=(patching_metric=="loss_per_token"))
             model.reset_hooks()
             return loss
         else:
-            logits = model(orig_input)
+            logits = forward()
             model.reset_hooks()
             return patching_metric(logits)
     
@@ -660,6 +1193,216 @@ def _path_patch_single(
 
 
 
+def _path_patch_batched(
+    model: HookedTransformer,
+    orig_input: Union[str, List[str], Int[Tensor, "batch pos"]],
+    senders: List[Union[Node, List[Node]]],
+    receivers: List[Union[Node, List[Node]]],
+    seq_pos: List[SeqPos],
+    patching_metric: Union[Callable, Literal["loss", "loss_per_token"]],
+    orig_cache: ActivationCache,
+    new_cache: Union[ActivationCache, Literal["zero", "mean"]],
+    apply_metric_to_cache: bool = False,
+    names_filter_for_cache_metric: Optional[Callable] = None,
+    direct_includes_mlps: bool = True,
+    clean_prefix: Optional[CleanPrefix] = None,
+) -> List:
+    '''
+    Batched version of `_path_patch_single`. The i-th instance of path patching is (senders[i] -> receivers[i]), at sequence
+    positions seq_pos[i]. Rather than doing each of these separately, we stack copies ("replicas") of orig_input along the batch
+    dimension, and every hook (freezing, patching senders, caching & patching receivers) is indexed per replica. So it's the same
+    algorithm as `_path_patch_single` (see that docstring), but with at most 2 forward passes for all instances together.
+
+    If several instances have the same senders and seq_pos (e.g. we're iterating over receivers), then the first forward pass
+    (patching senders and caching receivers) is the same for all of them, so we only run it on a single copy of orig_input.
+
+    If `clean_prefix` is given, then both forward passes skip the layers before the earliest node of any instance (same as in
+    `_path_patch_single`).
+
+    Returns a list of results, one for each instance of path patching.
+    '''
+    # Call this at the start, just in case! This also clears context by default
+    model.reset_hooks()
+
+    orig_tokens = orig_input if isinstance(orig_input, Tensor) else model.to_tokens(orig_input)
+    batch_size, seq_len = orig_tokens.shape
+    n_replicas = len(seq_pos)
+    assert len(senders) == len(receivers) == n_replicas
+
+    # Check the nodes are valid, and split them, e.g. Node(pattern) becomes [Node(q), Node(k)]
+    sender_nodes: List[List[Node]] = []
+    receiver_nodes: List[List[Node]] = []
+    for _sender_nodes, _receiver_nodes in zip(senders, receivers):
+        _sender_nodes = [_sender_nodes] if isinstance(_sender_nodes, Node) else _sender_nodes
+        _receiver_nodes = [_receiver_nodes] if isinstance(_receiver_nodes, Node) else _receiver_nodes
+        sender_nodes.append([node for sender in _sender_nodes for node in sender.check_sender(model)])
+        receiver_nodes.append([node for receiver in _receiver_nodes for node in receiver.check_and_split_receiver(model)])
+
+
+    if direct_includes_mlps or any([n.component_name == "pre" for nodes in receiver_nodes for n in nodes]):
+        # Run model on orig with sender nodes patched from new and all other nodes frozen. Cache the receiver nodes.
+        # Instances with the same senders and seq_pos have an identical forward pass here, so we only run one replica for each of them.
+        sender_replica_ids = {}
+        sender_replicas = []
+        source_replicas = []
+        for i, key in enumerate(zip(map(id, senders), map(id, seq_pos))):
+            if key not in sender_replica_ids:
+                sender_replica_ids[key] = len(sender_replicas)
+                sender_replicas.append((seq_pos[i], sender_nodes[i]))
+            source_replicas.append(sender_replica_ids[key])
+
+        hooks_for_freezing = [(lambda name: name.endswith("z"), partial(hook_fn_generic_patching, cache=orig_cache))]
+        if not direct_includes_mlps:
+            hooks_for_freezing.append((lambda name: name.endswith("post"), partial(hook_fn_generic_patching, cache=orig_cache)))
+
+        hooks_for_patching_senders = get_batched_patching_hooks(sender_replicas, new_cache, batch_size, seq_len)
+
+        receiver_names = sorted(set(node.activation_name for nodes in receiver_nodes for node in nodes))
+        hooks_for_caching_receivers = [(name, partial(hook_fn_generic_caching, name="receiver_activations", clone=True)) for name in receiver_names]
+
+        # Now add all the hooks in order. Note that patching should override freezing, and caching should happen before both.
+        if clean_prefix is None:
+            model.run_with_hooks(
+                einops.repeat(orig_tokens, "batch pos -> (replica batch) pos", replica=len(sender_replicas)),
+                return_type=None,
+                fwd_hooks=hooks_for_caching_receivers + hooks_for_freezing + hooks_for_patching_senders,
+                clear_contexts=False
+            )
+        else:
+            all_receiver_nodes = [node for nodes in receiver_nodes for node in nodes]
+            clean_prefix.run_with_hooks(
+                start_at_layer=CleanPrefix.get_start_layer([node for _, nodes in sender_replicas for node in nodes] + all_receiver_nodes),
+                fwd_hooks=hooks_for_caching_receivers + hooks_for_freezing + hooks_for_patching_senders,
+                n_replicas=len(sender_replicas),
+                stop_at_layer=CleanPrefix.get_stop_layer(all_receiver_nodes),
+                return_type=None,
+            )
+
+        # Lastly, we add the hooks for patching receivers (each replica patches its own receivers, from the cached values)
+        for hook_name, hook_fn in get_batched_patching_hooks(list(zip(seq_pos, receiver_nodes)), "receiver_activations", batch_size, seq_len, source_replicas):
+            model.add_hook(hook_name, hook_fn, level=1)
+
+
+    else:
+        # Same as `_path_patch_single`, except that the batch indices for the i-th instance are shifted to the i-th replica
+        for replica, (_seq_pos, _sender_nodes, _receiver_nodes) in enumerate(zip(seq_pos, sender_nodes, receiver_nodes)):
+            batch_indices, seq_pos_indices = get_batch_and_seq_pos_indices(_seq_pos, batch_size, seq_len)
+            sender_diffs = {
+                sender_node: get_sender_diff(model, sender_node, orig_cache, new_cache, batch_indices, seq_pos_indices)
+                for sender_node in _sender_nodes
+            }
+            if isinstance(batch_indices, slice):
+                batch_indices = slice(replica * batch_size, (replica + 1) * batch_size)
+            else:
+                batch_indices = batch_indices + replica * batch_size
+
+            for sender_node, diff in sender_diffs.items():
+                for i, receiver_node in enumerate(_receiver_nodes):
+                    if not (sender_node < receiver_node):
+                        continue
+                    _receiver_nodes[i] = add_sender_diff_to_receiver_context(model, diff, receiver_node, orig_cache, batch_indices, seq_pos_indices, n_replicas=n_replicas)
+
+
+    # Run model on all replicas of orig, with receiver nodes patched, and get the metric for each replica separately
+    tokens = einops.repeat(orig_tokens, "batch pos -> (replica batch) pos", replica=n_replicas)
+    if apply_metric_to_cache: clean_prefix = None
+    start_at_layer = None if clean_prefix is None else CleanPrefix.get_start_layer([node for nodes in receiver_nodes for node in nodes])
+    return get_metric_per_replica(
+        model, tokens, n_replicas, patching_metric, apply_metric_to_cache, names_filter_for_cache_metric, clean_prefix=clean_prefix, start_at_layer=start_at_layer
+    )
+
+
+
+
+
+def get_minibatch(x, batch_slice: slice, batch_size: int):
+    '''
+    Returns the part of `x` which corresponds to `batch_slice` of the full batch, if `x` has a batch dimension (i.e. tokens,
+    caches, per-example seq_pos, or nodes with per-example seq_pos). Anything else (ints, strings, caches of means with batch
+    size 1, etc) is returned unchanged.
+    '''
+    if isinstance(x, IterNode):
+        return IterNode(x.component_names, get_minibatch(x.seq_pos, batch_slice, batch_size))
+    elif isinstance(x, Node):
+        x = copy.copy(x)
+        x.seq_pos = get_minibatch(x.seq_pos, batch_slice, batch_size)
+        return x
+    elif isinstance(x, ActivationCache):
+        return ActivationCache({k: v[batch_slice] if v.shape[0] == batch_size else v for k, v in x.items()}, model=x.model)
+    elif isinstance(x, list) and (len(x) > 0) and isinstance(x[0], Node):
+        return [get_minibatch(node, batch_slice, batch_size) for node in x]
+    elif (isinstance(x, Tensor) and (x.ndim > 0) and (x.shape[0] == batch_size)) or (isinstance(x, list) and (len(x) == batch_size)):
+        return x[batch_slice]
+    return x
+
+
+def combine_minibatch_results(results: List, weights: List[int], metric_reduction: Literal["mean", "sum", "cat"]):
+    '''
+    Combines the results of patching on each minibatch (these can be floats, tensors, or dicts / lists of these, i.e. anything
+    which `act_patch` or `path_patch` returns). `weights` are the minibatch sizes, which we use for the weighted mean.
+    '''
+    if isinstance(results[0], dict):
+        return {k: combine_minibatch_results([r[k] for r in results], weights, metric_reduction) for k in results[0]}
+    elif isinstance(results[0], list):
+        return [combine_minibatch_results(list(r), weights, metric_reduction) for r in zip(*results)]
+    elif metric_reduction == "mean":
+        return sum(r * w for r, w in zip(results, weights)) / sum(weights)
+    elif metric_reduction == "sum":
+        return sum(results)
+    assert metric_reduction == "cat", f"Unknown metric_reduction {metric_reduction!r}, should be 'mean', 'sum' or 'cat'."
+    return t.cat([t.as_tensor(r) for r in results], dim=0)
+
+
+def patch_in_minibatches(
+    patching_fn: Callable,
+    model: HookedTransformer,
+    batch_size: int,
+    metric_reduction: Literal["mean", "sum", "cat"],
+    mean_names: List[str],
+    **kwargs,
+):
+    '''
+    Splits the inputs of `patching_fn` (which is `act_patch` or `path_patch`) into minibatches of size `batch_size`, calls it on
+    each of them, and combines the results with `metric_reduction`:
+
+        "mean" - weighted mean over minibatches (so it's the same as the full-batch result if the metric is a mean over the batch)
+        "sum"  - sum over minibatches (same as the full-batch result if the metric is a sum over the batch)
+        "cat"  - concatenate along the batch dimension (for metrics which return one value per example, e.g. "loss_per_token")
+
+    If the patching metric takes a `batch_slice` keyword argument, we pass it the slice of the full batch that each minibatch
+    corresponds to (e.g. so it can index into a tensor of correct / incorrect tokens for every example).
+
+    If new_cache is "mean" then we compute the mean over the whole orig batch first (at the hooks in `mean_names`), so that each
+    minibatch is ablated with the same values as we'd have used for the full batch.
+    '''
+    # Tokenize first (otherwise each minibatch of strings could get padded to a different length)
+    for input_name in ["orig_input", "new_input"]:
+        if (kwargs.get(input_name) is not None) and not isinstance(kwargs[input_name], Tensor):
+            kwargs[input_name] = model.to_tokens(kwargs[input_name])
+    full_batch_size = kwargs["orig_input"].shape[0]
+
+    if isinstance(kwargs.get("new_cache"), str) and kwargs["new_cache"] == "mean":
+        kwargs["new_cache"] = ActivationStats.from_dataset(model, kwargs["orig_input"], batch_size, names_filter=lambda name: name in mean_names)
+
+    patching_metric = kwargs["patching_metric"]
+    metric_takes_batch_slice = callable(patching_metric) and ("batch_slice" in inspect.signature(patching_metric).parameters)
+    # (we wrap the metric in a partial below, so if we're journalling then get its key from the original metric)
+    if kwargs.get("journal") is not None:
+        kwargs["metric_key"] = SweepJournal.get_metric_key(patching_metric, kwargs.get("metric_key"))
+
+    results = []
+    weights = []
+    for i in range(0, full_batch_size, batch_size):
+        batch_slice = slice(i, min(i + batch_size, full_batch_size))
+        minibatch_kwargs = {k: get_minibatch(v, batch_slice, full_batch_size) for k, v in kwargs.items() if k != "patching_metric"}
+        minibatch_kwargs["patching_metric"] = partial(patching_metric, batch_slice=batch_slice) if metric_takes_batch_slice else patching_metric
+        results.append(patching_fn(model=model, **minibatch_kwargs))
+        weights.append(batch_slice.stop - batch_slice.start)
+        t.cuda.empty_cache()
+
+    return combine_minibatch_results(results, weights, metric_reduction)
+
+
 def path_patch(
     model: HookedTransformer,
     orig_input: Union[str, List[str], Int[Tensor, "batch seq_len"]],
@@ -668,11 +1411,18 @@ def path_patch(
     receiver_nodes: Union[IterNode, Node, List[Node]] = [],
     patching_metric: Union[Callable, Literal["loss", "loss_per_token"]] = "loss",
     orig_cache: Optional[ActivationCache] = None,
-    new_cache: Optional[Union[ActivationCache, Literal["zero"]]] = None,
+    new_cache: Optional[Union[ActivationCache, ActivationStats, Literal["zero", "mean"]]] = None,
     seq_pos: SeqPos = None,
     apply_metric_to_cache: bool = False,
     names_filter_for_cache_metric: Optional[Callable] = None,
     direct_includes_mlps: bool = True,
+    chunk_size: Optional[int] = None,
+    resume_from_patched_layer: bool = False,
+    batch_size: Optional[int] = None,
+    metric_reduction: Literal["mean", "sum", "cat"] = "mean",
+    activation_store: Optional[ActivationStore] = None,
+    journal: Optional[Union[str, SweepJournal]] = None,
+    metric_key: Optional[str] = None,
     verbose: bool = False,
 ) -> Float[Tensor, "..."]:
     '''
@@ -707,9 +1457,44 @@ def path_patch(
             Should take in a tensor of logits, and output a scalar tensor.
             This is how we calculate the value we'll return.
 
+        new_cache:
+            If given, we patch in the sender values from this cache rather than running the model on new_input. It can also be
+            "zero" or "mean" for zero / mean ablation of the senders (mean is taken over the orig batch), or means over a
+            reference dataset (see `get_mean_cache` and `ActivationStats`).
+
         apply_metric_to_cache:
             If True, then we apply the metric to the cache we get on the final patched forward pass, rather than the logits.
 
+        chunk_size:
+            Only used if we're iterating over senders or receivers (see below). If None, we do each instance of path patching
+            separately. If it's an int, we do up to `chunk_size` instances at once, by stacking that many copies of orig_input
+            along the batch dimension (see `_path_patch_batched`). This is much faster, but uses `chunk_size` times as much memory.
+
+        resume_from_patched_layer:
+            If True, we start each forward pass from the orig residual stream (taken from `orig_cache`) at the first layer where
+            anything differs from the orig run, rather than from the embedding. The first pass (freezing & caching receivers)
+            starts at the earliest sender or receiver and stops after the last receiver, and the final pass starts at the earliest
+            receiver. Results are the same, but for circuits in the later layers this skips most of the computation.
+
+        batch_size:
+            If given, we split orig_input (and new_input, the caches, and any per-example seq_pos) into minibatches of this size,
+            do path patching on each of them separately, and combine the results using `metric_reduction` ("mean", "sum" or "cat",
+            see `patch_in_minibatches`). This way, large datasets don't need to fit in memory all at once. The results are the
+            same as for the full batch, as long as `metric_reduction` matches how your metric treats the batch.
+
+        activation_store:
+            If given, the orig and new caches are read from (and written to) this on-disk store, so they only get computed once
+            across sessions (see `ActivationStore` in `activation_store.py`).
+
+        journal:
+            Only used if we're iterating over senders or receivers. Path to a jsonl file (or a `SweepJournal`) which we append
+            each node's result to as soon as it's done. Nodes which already have a result in the journal are skipped, so if a
+            long sweep gets interrupted then rerunning the same call picks up where it left off (see `journal.py`).
+
+        metric_key:
+            String which identifies the patching metric in the journal. Needed if the metric is a lambda, a `functools.partial`
+            or a function defined inside another function (otherwise the metric's module & name are used).
+
         verbose: 
             Whether to print out extra info (in particular, about the shape of the final output).
 
@@ -737,23 +1522,59 @@ def path_patch(
     # Make sure we aren't iterating over both senders and receivers
     assert not all([isinstance(receiver_nodes, IterNode), isinstance(sender_nodes, IterNode)]), "Can't iterate over both senders and receivers!"
 
+    # If we're splitting the batch up, then call this function on each minibatch & combine the results
+    if batch_size is not None:
+        return patch_in_minibatches(
+            path_patch, model, batch_size, metric_reduction,
+            mean_names=get_path_patching_names(model, sender_nodes, receiver_nodes, direct_includes_mlps)[1],
+            orig_input=orig_input, new_input=new_input, sender_nodes=sender_nodes, receiver_nodes=receiver_nodes,
+            patching_metric=patching_metric, orig_cache=orig_cache, new_cache=new_cache, seq_pos=seq_pos,
+            apply_metric_to_cache=apply_metric_to_cache, names_filter_for_cache_metric=names_filter_for_cache_metric,
+            direct_includes_mlps=direct_includes_mlps, chunk_size=chunk_size, resume_from_patched_layer=resume_from_patched_layer,
+            activation_store=activation_store, journal=journal, metric_key=metric_key, verbose=verbose,
+        )
+
     # Check other arguments
-    assert any([isinstance(new_cache, ActivationCache), new_cache == "zero", new_cache is None]), "Invalid new_cache argument."
+    assert any([isinstance(new_cache, (ActivationCache, ActivationStats)), new_cache in ["zero", "mean"], new_cache is None]), "Invalid new_cache argument."
     # assert (new_input is not None) or (new_cache == "zero"), "If new_cache is not 'zero' then you must provide new_input."
     if isinstance(patching_metric, str): assert patching_metric in ["loss", "loss_per_token"], "Invalid patching_metric argument."
     assert not(isinstance(patching_metric, str) and apply_metric_to_cache), "Can't apply metric to cache if metric is 'loss' or 'loss_per_token'."
     assert sender_nodes != [], "You must specify sender nodes."
     assert receiver_nodes != [], "You must specify receiver nodes."
 
+    # If we're recording results in a journal, get the key for this sweep (before we replace new_cache with an actual cache)
+    journal = get_journal(journal) if any([isinstance(receiver_nodes, IterNode), isinstance(sender_nodes, IterNode)]) else None
+    if journal is not None:
+        sweep_key = SweepJournal.get_sweep_key(
+            function="path_patch",
+            model=get_model_id(model),
+            orig_input=orig_input if isinstance(orig_input, Tensor) else model.to_tokens(orig_input),
+            new_input=new_input if (new_input is None) or isinstance(new_input, Tensor) else model.to_tokens(new_input),
+            new_cache=SweepJournal.get_cache_key(new_cache),
+            sender_nodes=sender_nodes.component_names if isinstance(sender_nodes, IterNode) else sender_nodes,
+            receiver_nodes=receiver_nodes.component_names if isinstance(receiver_nodes, IterNode) else receiver_nodes,
+            patching_metric=SweepJournal.get_metric_key(patching_metric, metric_key),
+            apply_metric_to_cache=apply_metric_to_cache,
+            direct_includes_mlps=direct_includes_mlps,
+        )
+
     # ========== Step 1 ==========
-    # Gather activations on orig and new distributions (we only need attn heads and possibly MLPs)
+    # Gather activations on orig and new distributions (we only need the activations which the nodes actually use)
     # This is so that we can patch/freeze during step 2
+    orig_names, new_names = get_path_patching_names(model, sender_nodes, receiver_nodes, direct_includes_mlps, resume_from_patched_layer)
     if orig_cache is None:
-        _, orig_cache = model.run_with_cache(orig_input, return_type=None)
-    if new_cache == "zero":
-        new_cache = ActivationCache({k: t.zeros_like(v) for k, v in orig_cache.items()}, model=model)
-    elif new_cache is None:
-        _, new_cache = model.run_with_cache(new_input, return_type=None, names_filter=relevant_names_filter)
+        orig_cache = get_cache(model, orig_input, orig_names, activation_store)
+    # (if new_cache is "zero" we don't need a cache, since the hooks ablate the activations in place)
+    if new_cache is None:
+        new_cache = get_cache(model, new_input, new_names, activation_store)
+    elif new_cache == "mean":
+        # Patching one sender can change the activations of later senders, so we take the mean of the orig activations here
+        # rather than in the hook functions (this is cheap, since they have batch size 1)
+        new_cache = ActivationCache({name: orig_cache[name].mean(0, keepdim=True) for name in new_names}, model=model)
+    orig_tokens = orig_input if isinstance(orig_input, Tensor) else model.to_tokens(orig_input)
+
+    # Get the orig residual stream at each layer, if we're resuming forward passes from the first patched layer
+    clean_prefix = CleanPrefix(model, orig_input, orig_cache) if resume_from_patched_layer else None
 
 
     # Get out backend patching function (fix all the arguments we won't be changing)
@@ -770,6 +1591,19 @@ def path_patch(
         apply_metric_to_cache=apply_metric_to_cache,
         names_filter_for_cache_metric=names_filter_for_cache_metric,
         direct_includes_mlps=direct_includes_mlps,
+        clean_prefix=clean_prefix,
+    )
+    path_patch_batched = partial(
+        _path_patch_batched,
+        model=model,
+        orig_input=orig_input,
+        patching_metric=patching_metric,
+        orig_cache=orig_cache,
+        new_cache=new_cache,
+        apply_metric_to_cache=apply_metric_to_cache,
+        names_filter_for_cache_metric=names_filter_for_cache_metric,
+        direct_includes_mlps=direct_includes_mlps,
+        clean_prefix=clean_prefix,
     )
 
     # Case where we don't iterate, just single instance of path patching:
@@ -782,14 +1616,37 @@ def path_patch(
     
     # If we're fixing sender(s), and iterating over receivers:
     if isinstance(receiver_nodes, IterNode):
-        receiver_nodes_dict = receiver_nodes.get_node_dict(model, new_cache["q", 0])
+        receiver_nodes_dict = receiver_nodes.get_node_dict(model, orig_tokens)
         progress_bar = tqdm(total=sum(len(node_list) for node_list in receiver_nodes_dict.values()))
         for receiver_node_name, receiver_node_list in receiver_nodes_dict.items():
             progress_bar.set_description(f"Patching over {receiver_node_name!r}")
-            results_dict[receiver_node_name] = []
-            for (seq_pos, receiver_node) in receiver_node_list:
-                results_dict[receiver_node_name].append(path_patch_single(sender=sender_nodes, receiver=receiver_node, seq_pos=seq_pos))
-                progress_bar.update(1)
+            # Get the results we've already recorded in the journal (if any), and the indices of the nodes we still need to do
+            if journal is not None:
+                results, node_keys, order = journal.get_entries(sweep_key, receiver_node_name, receiver_node_list)
+                progress_bar.update(len(receiver_node_list) - len(order))
+            else:
+                results, order = [None for _ in receiver_node_list], list(range(len(receiver_node_list)))
+            if chunk_size is None:
+                for j in order:
+                    seq_pos, receiver_node = receiver_node_list[j]
+                    results[j] = path_patch_single(sender=sender_nodes, receiver=receiver_node, seq_pos=seq_pos)
+                    if journal is not None: journal.add(node_keys[j], results[j])
+                    progress_bar.update(1)
+            else:
+                for i in range(0, len(order), chunk_size):
+                    chunk_order = order[i: i + chunk_size]
+                    chunk = [receiver_node_list[j] for j in chunk_order]
+                    chunk_results = path_patch_batched(
+                        senders=[sender_nodes] * len(chunk),
+                        receivers=[receiver_node for (_, receiver_node) in chunk],
+                        seq_pos=[seq_pos for (seq_pos, _) in chunk],
+                    )
+                    for j, result in zip(chunk_order, chunk_results):
+                        results[j] = result
+                        if journal is not None: journal.add(node_keys[j], result)
+                    progress_bar.update(len(chunk))
+                    t.cuda.empty_cache()
+            results_dict[receiver_node_name] = results
         progress_bar.close()
         for node_name, node_shape_dict in receiver_nodes.shape_values.items():
             if verbose: print(f"results[{node_name!r}].shape = ({', '.join(f'{s}={v}' for s, v in node_shape_dict.items())})")
@@ -800,15 +1657,38 @@ def path_patch(
     
     # If we're fixing receiver(s), and iterating over senders:
     elif isinstance(sender_nodes, IterNode):
-        sender_nodes_dict = sender_nodes.get_node_dict(model, new_cache["q", 0])
+        sender_nodes_dict = sender_nodes.get_node_dict(model, orig_tokens)
         progress_bar = tqdm(total=sum(len(node_list) for node_list in sender_nodes_dict.values()))
         for sender_node_name, sender_node_list in sender_nodes_dict.items():
             progress_bar.set_description(f"Patching over {sender_node_name!r}")
-            results_dict[sender_node_name] = []
-            for (seq_pos, sender_node) in sender_node_list:
-                results_dict[sender_node_name].append(path_patch_single(sender=sender_node, receiver=receiver_nodes, seq_pos=seq_pos))
-                progress_bar.update(1)
-                t.cuda.empty_cache()
+            # Get the results we've already recorded in the journal (if any), and the indices of the nodes we still need to do
+            if journal is not None:
+                results, node_keys, order = journal.get_entries(sweep_key, sender_node_name, sender_node_list)
+                progress_bar.update(len(sender_node_list) - len(order))
+            else:
+                results, order = [None for _ in sender_node_list], list(range(len(sender_node_list)))
+            if chunk_size is None:
+                for j in order:
+                    seq_pos, sender_node = sender_node_list[j]
+                    results[j] = path_patch_single(sender=sender_node, receiver=receiver_nodes, seq_pos=seq_pos)
+                    if journal is not None: journal.add(node_keys[j], results[j])
+                    progress_bar.update(1)
+                    t.cuda.empty_cache()
+            else:
+                for i in range(0, len(order), chunk_size):
+                    chunk_order = order[i: i + chunk_size]
+                    chunk = [sender_node_list[j] for j in chunk_order]
+                    chunk_results = path_patch_batched(
+                        senders=[sender_node for (_, sender_node) in chunk],
+                        receivers=[receiver_nodes] * len(chunk),
+                        seq_pos=[seq_pos for (seq_pos, _) in chunk],
+                    )
+                    for j, result in zip(chunk_order, chunk_results):
+                        results[j] = result
+                        if journal is not None: journal.add(node_keys[j], result)
+                    progress_bar.update(len(chunk))
+                    t.cuda.empty_cache()
+            results_dict[sender_node_name] = results
         progress_bar.close()
         for node_name, node_shape_dict in sender_nodes.shape_values.items():
             if verbose: print(f"results[{node_name!r}].shape = ({', '.join(f'{s}={v}' for s, v in node_shape_dict.items())})")
@@ -827,15 +1707,21 @@ def _act_patch_single(
     orig_input: Union[str, List[str], Int[Tensor, "batch pos"]],
     patching_nodes: Union[Node, List[Node]],
     patching_metric: Union[Callable, Literal["loss", "loss_per_token"]],
-    new_cache: Union[ActivationCache, Literal["zero"]],
+    new_cache: Union[ActivationCache, Literal["zero", "mean"]],
     apply_metric_to_cache: bool = False,
+    clean_prefix: Optional[CleanPrefix] = None,
 ) -> Float[Tensor, ""]:
-    '''Same principle as path patching, but we just patch a single activation at the 'activation' node.'''
+    '''
+    Same principle as path patching, but we just patch a single activation at the 'activation' node.
+
+    If `clean_prefix` is given, we start the forward pass at the earliest patched layer rather than at the embedding.
+    '''
 
     # Call this at the start, just in case! This also clears context by default
     model.reset_hooks()
 
-    batch_size, seq_len = new_cache["z", 0].shape[:2]
+    orig_tokens = orig_input if isinstance(orig_input, Tensor) else model.to_tokens(orig_input)
+    batch_size, seq_len = orig_tokens.shape
 
     if isinstance(patching_nodes, Node): patching_nodes = [patching_nodes]
     for node in patching_nodes:
@@ -845,43 +1731,163 @@ def _act_patch_single(
             node.get_patching_hook_fn(new_cache, batch_indices, seq_pos_indices)
         )
 
+    if clean_prefix is not None:
+        forward = partial(clean_prefix.forward, start_at_layer=CleanPrefix.get_start_layer(patching_nodes))
+    else:
+        forward = partial(model, orig_input)
+
     if apply_metric_to_cache:
         _, cache = model.run_with_cache(orig_input, return_type=None)
         model.reset_hooks()
         return patching_metric(cache)
     else:
         if isinstance(patching_metric, str):
-            loss = model(orig_input, return_type="loss", loss_per_token=(patching_metric == "loss_per_token"))
+            loss = forward(return_type="loss", loss_per_token=(patching_metric == "loss_per_token"))
             model.reset_hooks()
             return loss
         else:
-            logits = model(orig_input)
+            logits = forward()
             model.reset_hooks()
             return patching_metric(logits)
 
 
+def _act_patch_batched(
+    model: HookedTransformer,
+    orig_input: Union[str, List[str], Int[Tensor, "batch pos"]],
+    patching_nodes: List[Tuple[SeqPos, Node]],
+    patching_metric: Union[Callable, Literal["loss", "loss_per_token"]],
+    new_cache: Union[ActivationCache, Literal["zero", "mean"]],
+    apply_metric_to_cache: bool = False,
+    clean_prefix: Optional[CleanPrefix] = None,
+) -> List:
+    '''
+    Batched version of `_act_patch_single`. Rather than one forward pass per node, we stack len(patching_nodes) copies of
+    orig_input along the batch dimension, and patch the i-th node into the i-th copy. Returns a list of results, one for
+    each node (same as what we'd get from calling `_act_patch_single` on each of them).
+
+    If `clean_prefix` is given, the whole chunk resumes from the earliest layer patched by any of its nodes.
+    '''
+    # Call this at the start, just in case! This also clears context by default
+    model.reset_hooks()
+
+    orig_tokens = orig_input if isinstance(orig_input, Tensor) else model.to_tokens(orig_input)
+    batch_size, seq_len = orig_tokens.shape
+    n_replicas = len(patching_nodes)
+
+    for hook_name, hook_fn in get_batched_patching_hooks(patching_nodes, new_cache, batch_size, seq_len):
+        model.add_hook(hook_name, hook_fn)
+
+    tokens = einops.repeat(orig_tokens, "batch pos -> (replica batch) pos", replica=n_replicas)
+    start_at_layer = None if clean_prefix is None else CleanPrefix.get_start_layer([node for _, node in patching_nodes])
+    return get_metric_per_replica(
+        model, tokens, n_replicas, patching_metric, apply_metric_to_cache, clean_prefix=clean_prefix, start_at_layer=start_at_layer
+    )
+
+
 def act_patch(
     model: HookedTransformer,
     orig_input: Union[str, List[str], Int[Tensor, "batch seq_len"]],
     patching_nodes: Union[IterNode, Node, List[Node]],
     patching_metric: Union[Callable, Literal["loss", "loss_per_token"]],
     new_input: Optional[Union[str, List[str], Int[Tensor, "batch seq_len"]]] = None,
-    new_cache: Optional[ActivationCache] = None,
+    new_cache: Optional[Union[ActivationCache, ActivationStats, Literal["zero", "mean"]]] = None,
     apply_metric_to_cache: bool = False,
+    chunk_size: Optional[int] = None,
+    resume_from_patched_layer: bool = False,
+    batch_size: Optional[int] = None,
+    metric_reduction: Literal["mean", "sum", "cat"] = "mean",
+    activation_store: Optional[ActivationStore] = None,
+    journal: Optional[Union[str, SweepJournal]] = None,
+    metric_key: Optional[str] = None,
     verbose: bool = False,
 ) -> Float[Tensor, "..."]:
+    '''
+    Performs a single instance / multiple instances of activation patching, i.e. patching the value of `patching_nodes`
+    from orig -> new, and measuring the effect with `patching_metric`.
+
+    If `patching_nodes` is an `IterNode`, we patch each node separately and return a dict of tensors (same as `path_patch`).
+
+    new_cache:
+        If given, we patch in values from this cache rather than running the model on new_input. It can also be "zero" or
+        "mean" for zero / mean ablation (mean is taken over the orig batch), or means over a reference dataset (see
+        `get_mean_cache` and `ActivationStats`).
+
+    chunk_size:
+        If None, we do one forward pass per node. If it's an int, we patch up to `chunk_size` nodes at once, by stacking
+        that many copies of orig_input along the batch dimension (each copy has a different node patched). This is much
+        faster, but the forward pass uses `chunk_size` times as much memory, so pick it to fit on your device.
+
+    resume_from_patched_layer:
+        If True, we do one clean forward pass up front and store the residual stream at every layer boundary. Then each
+        patched forward pass starts at the first layer we're patching at, rather than recomputing all the earlier layers
+        (which are identical to the clean run). For a sweep over layers, this roughly halves the total compute. When it's
+        combined with `chunk_size`, nodes are grouped by layer so each chunk can skip as many layers as possible.
+
+    batch_size:
+        If given, we split orig_input (and new_input, new_cache, and any per-example seq_pos in the nodes) into minibatches of
+        this size, and combine the results using `metric_reduction` (same as in `path_patch`, see `patch_in_minibatches`).
+
+    activation_store:
+        If given, the new cache (and the clean residual stream, if we're resuming from the patched layer) are read from / written
+        to this on-disk store, rather than recomputed (see `ActivationStore` in `activation_store.py`).
+
+    journal:
+        Path to a jsonl file (or a `SweepJournal`). If given when iterating over nodes, each node's result is appended to this
+        file as soon as it's done, and nodes which already have a result in it are skipped. So if a long sweep gets interrupted,
+        rerunning the same call picks up where it left off (see `SweepJournal` in `journal.py`).
+
+    metric_key:
+        String which identifies the patching metric in the journal (same as in `path_patch`).
+    '''
 
     # Check some arguments
     assert (new_input is not None) or (new_cache is not None), "Must specify either new_input or new_cache."
     if isinstance(patching_metric, str): assert patching_metric in ["loss", "loss_per_token"]
+
+    # If we're splitting the batch up, then call this function on each minibatch & combine the results
+    if batch_size is not None:
+        return patch_in_minibatches(
+            act_patch, model, batch_size, metric_reduction,
+            mean_names=get_activation_names(model, patching_nodes),
+            orig_input=orig_input, patching_nodes=patching_nodes, patching_metric=patching_metric, new_input=new_input,
+            new_cache=new_cache, apply_metric_to_cache=apply_metric_to_cache, chunk_size=chunk_size,
+            resume_from_patched_layer=resume_from_patched_layer, activation_store=activation_store, journal=journal, metric_key=metric_key, verbose=verbose,
+        )
     assert not(isinstance(patching_metric, str) and apply_metric_to_cache)
+    assert not(resume_from_patched_layer and apply_metric_to_cache), "Can't resume from the patched layer when applying the metric to the cache (earlier layers won't be in it)."
+
+    # If we're recording results in a journal, get the key for this sweep (before we replace new_cache with an actual cache)
+    journal = get_journal(journal) if isinstance(patching_nodes, IterNode) else None
+    if journal is not None:
+        sweep_key = SweepJournal.get_sweep_key(
+            function="act_patch",
+            model=get_model_id(model),
+            orig_input=orig_input if isinstance(orig_input, Tensor) else model.to_tokens(orig_input),
+            new_input=new_input if (new_input is None) or isinstance(new_input, Tensor) else model.to_tokens(new_input),
+            new_cache=SweepJournal.get_cache_key(new_cache),
+            patching_nodes=patching_nodes.component_names,
+            patching_metric=SweepJournal.get_metric_key(patching_metric, metric_key),
+            apply_metric_to_cache=apply_metric_to_cache,
+        )
 
-    # Get our cache for patching in (might be zero cache)
-    if new_cache == "zero":
-        _, cache = model.run_with_cache(orig_input, return_type=None)
-        new_cache = ActivationCache({k: t.zeros_like(v) for k, v in cache.items()}, model=model)
-    elif new_cache is None:
-        _, new_cache = model.run_with_cache(new_input, return_type=None)
+    # Get our cache for patching in. We only need the activations we're patching (and if new_cache is "zero" or "mean" we
+    # don't need a cache at all, since the hooks ablate the activations in place)
+    names = get_activation_names(model, patching_nodes)
+    if new_cache is None:
+        new_cache = get_cache(model, new_input, names, activation_store)
+    elif (new_cache == "mean") and isinstance(patching_nodes, list) and (len(patching_nodes) > 1):
+        # If we're patching several nodes at once, then earlier ones can change the activations of later ones, so we can't
+        # take the mean in the hook functions (we need the mean of the orig activations)
+        new_cache = get_mean_cache(model, orig_input, names_filter=lambda name: name in names)
+    orig_tokens = orig_input if isinstance(orig_input, Tensor) else model.to_tokens(orig_input)
+
+    # Get the clean residual stream at each layer, if we're resuming the forward pass from the patched layer
+    if resume_from_patched_layer:
+        resid_pre_names = [utils.get_act_name("resid_pre", layer) for layer in range(model.cfg.n_layers)]
+        orig_cache = get_cache(model, orig_input, resid_pre_names, activation_store) if (activation_store is not None) else None
+        clean_prefix = CleanPrefix(model, orig_input, orig_cache)
+    else:
+        clean_prefix = None
 
     # Get out backend patching function (fix all the arguments we won't be changing)
     act_patch_single = partial(
@@ -892,6 +1898,7 @@ def act_patch(
         patching_metric=patching_metric,
         new_cache=new_cache,
         apply_metric_to_cache=apply_metric_to_cache,
+        clean_prefix=clean_prefix,
     )
 
     # If we're not iterating over anything, i.e. it's just a single instance of activation patching:
@@ -900,15 +1907,48 @@ def act_patch(
 
     # If we're iterating over nodes:
     results_dict = defaultdict(list)
-    nodes_dict = patching_nodes.get_node_dict(model, new_cache["q", 0])
+    nodes_dict = patching_nodes.get_node_dict(model, orig_tokens)
     progress_bar = tqdm(total=sum(len(node_list) for node_list in nodes_dict.values()))
     for node_name, node_list in nodes_dict.items():
         progress_bar.set_description(f"Patching {node_name!r}")
-        for (seq_pos, node) in node_list:
-            node.seq_pos = seq_pos
-            results_dict[node_name].append(act_patch_single(patching_nodes=node))
-            progress_bar.update(1)
-            t.cuda.empty_cache()
+        # Get the results we've already recorded in the journal (if any), and the indices of the nodes we still need to do
+        if journal is not None:
+            results, node_keys, order = journal.get_entries(sweep_key, node_name, node_list)
+            progress_bar.update(len(node_list) - len(order))
+        else:
+            results, order = [None for _ in node_list], list(range(len(node_list)))
+        if chunk_size is None:
+            for j in order:
+                seq_pos, node = node_list[j]
+                node.seq_pos = seq_pos
+                results[j] = act_patch_single(patching_nodes=node)
+                if journal is not None: journal.add(node_keys[j], results[j])
+                progress_bar.update(1)
+                t.cuda.empty_cache()
+        else:
+            # If we're resuming from the patched layer, group nodes in the same layer into the same chunk (then put the
+            # results back in their original order at the end)
+            if clean_prefix is not None:
+                # (nodes without a start layer need the whole forward pass, so they go first)
+                start_layers = [CleanPrefix.get_start_layer(node) for _, node in node_list]
+                order = sorted(order, key=lambda j: -1 if start_layers[j] is None else start_layers[j])
+            for i in range(0, len(order), chunk_size):
+                chunk_order = order[i: i + chunk_size]
+                chunk_results = _act_patch_batched(
+                    model=model,
+                    orig_input=orig_input,
+                    patching_nodes=[node_list[j] for j in chunk_order],
+                    patching_metric=patching_metric,
+                    new_cache=new_cache,
+                    apply_metric_to_cache=apply_metric_to_cache,
+                    clean_prefix=clean_prefix,
+                )
+                for j, result in zip(chunk_order, chunk_results):
+                    results[j] = result
+                    if journal is not None: journal.add(node_keys[j], result)
+                progress_bar.update(len(chunk_order))
+                t.cuda.empty_cache()
+        results_dict[node_name].extend(results)
     progress_bar.close()
     for node_name, node_shape_dict in patching_nodes.shape_values.items():
         if verbose: print(f"results[{node_name!r}].shape = ({', '.join(f'{s}={v}' for s, v in node_shape_dict.items())})")
@@ -917,3 +1957,324 @@ def act_patch(
         for node_name, results in results_dict.items()
     }
 
+
+
+
+
+def hook_fn_requires_grad(activation: Float[Tensor, "..."], hook: HookPoint) -> Float[Tensor, "..."]:
+    '''Makes sure we can take gradients w.r.t. activations downstream of this hook (even if the model's params don't require grad).'''
+    if not activation.requires_grad:
+        activation.requires_grad_(True)
+    return activation
+
+
+def get_metric_and_activations_with_grad(
+    model: HookedTransformer,
+    orig_input: Union[str, List[str], Int[Tensor, "batch pos"]],
+    patching_metric: Union[Callable, Literal["loss"]],
+    names: List[str],
+) -> Tuple[Float[Tensor, ""], Dict[str, Float[Tensor, "..."]]]:
+    '''
+    Runs the model on orig_input, and returns the metric along with the activations at `names`. Unlike `run_with_cache`, these
+    activations are still attached to the computational graph, so we can take gradients of the metric w.r.t. them (or of one
+    activation w.r.t. another).
+    '''
+    model.reset_hooks()
+    model.add_hook("hook_embed", hook_fn_requires_grad)
+    for name in names:
+        model.add_hook(name, partial(hook_fn_generic_caching, name="activation"))
+
+    with t.enable_grad():
+        if isinstance(patching_metric, str):
+            metric = model(orig_input, return_type="loss")
+        else:
+            metric = patching_metric(model(orig_input))
+    assert isinstance(metric, Tensor) and metric.numel() == 1, "For attribution patching, the metric must return a scalar tensor (not a float), so we can take gradients."
+
+    activations = {name: model.hook_dict[name].ctx["activation"] for name in names}
+    model.reset_hooks()
+    return metric, activations
+
+
+def get_attribution_per_node(attribution: Float[Tensor, "batch ..."], component_name: str) -> Float[Tensor, "batch ..."]:
+    '''
+    Takes an elementwise attribution tensor (i.e. (new - orig) * grad) and sums over all the dimensions which `IterNode` doesn't
+    iterate over. The result has shape (batch, pos, head) for q/k/v/z, (batch, pos, neuron) for pre/post, (batch, head) for
+    attention patterns, (batch,) for attention scores (`IterNode` patches all heads of these at once), and (batch, pos) for
+    everything else.
+    '''
+    if component_name == "pattern":
+        return attribution.sum((-2, -1))
+    elif component_name == "attn_scores":
+        return attribution.sum((-3, -2, -1))
+    elif component_name in ["q", "k", "v", "z"]:
+        return attribution.sum(-1)
+    elif component_name in ["pre", "post"]:
+        return attribution
+    return attribution.flatten(2).sum(-1)
+
+
+def sum_over_seq_pos(attribution: Float[Tensor, "batch pos ..."], seq_pos: IterSeqPos) -> Float[Tensor, "..."]:
+    '''
+    Sums attribution over the batch, and over sequence positions according to the `seq_pos` argument of `IterNode`. If this is
+    "each" we keep the sequence position dimension, otherwise we sum over the positions we would have patched at.
+    '''
+    if isinstance(seq_pos, str):
+        assert seq_pos == "each"
+        return attribution.sum(0)
+    batch_indices, seq_pos_indices = get_batch_and_seq_pos_indices(seq_pos, *attribution.shape[:2])
+    return attribution[batch_indices, seq_pos_indices].flatten(0, 1).sum(0)
+
+
+def stack_over_layers(results_per_layer: List[Float[Tensor, "..."]], seq_pos: IterSeqPos) -> Float[Tensor, "..."]:
+    '''Stacks per-layer results, so they have the same shape as `IterNode.shape_values` (where seq_pos comes before layer).'''
+    return t.stack(results_per_layer, dim=1 if isinstance(seq_pos, str) else 0)
+
+
+def act_patch_attribution(
+    model: HookedTransformer,
+    orig_input: Union[str, List[str], Int[Tensor, "batch seq_len"]],
+    patching_nodes: IterNode,
+    patching_metric: Union[Callable, Literal["loss"]],
+    new_input: Optional[Union[str, List[str], Int[Tensor, "batch seq_len"]]] = None,
+    new_cache: Optional[Union[ActivationCache, ActivationStats, Literal["zero", "mean"]]] = None,
+    verbose: bool = False,
+) -> Dict[str, Float[Tensor, "..."]]:
+    '''
+    Linear approximation to `act_patch` (also called attribution patching). Rather than one forward pass per node, we do one
+    forward & backward pass on orig (plus one forward pass on new, if new_cache isn't supplied), and estimate the effect of
+    patching each node as:
+
+        patched_metric - orig_metric  ~=  (new_activation - orig_activation) . grad(metric w.r.t. orig_activation)
+
+    summed over the batch and over the positions / head / neuron of the node.
+
+    This is useful for screening lots of nodes quickly, then running exact patching on the most important ones. Note that we
+    return the *change* in the metric, rather than the patched metric itself like `act_patch` does.
+
+    The return value is a dict of tensors with the same keys & shapes as `act_patch` would give us for this IterNode. The
+    metric must return a scalar tensor (not a float), since we need to take gradients of it.
+    '''
+    assert isinstance(patching_nodes, IterNode), "Attribution patching is only supported for IterNode (it's for doing lots of nodes at once)."
+    assert (new_input is not None) or (new_cache is not None), "Must specify either new_input or new_cache."
+    if isinstance(patching_metric, str): assert patching_metric == "loss", "Attribution patching needs a scalar metric, so 'loss_per_token' isn't supported."
+
+    orig_tokens = orig_input if isinstance(orig_input, Tensor) else model.to_tokens(orig_input)
+    names = [utils.get_act_name(name, layer) for name in patching_nodes.component_names for layer in range(model.cfg.n_layers)]
+
+    # Get activations & gradients on orig, and activations on new
+    metric, orig_activations = get_metric_and_activations_with_grad(model, orig_tokens, patching_metric, names)
+    grads = dict(zip(names, t.autograd.grad(metric, [orig_activations[name] for name in names], allow_unused=True)))
+    if new_cache is None:
+        _, new_cache = model.run_with_cache(new_input, return_type=None, names_filter=lambda name: name in names)
+
+    results = {}
+    for component_name in patching_nodes.component_names:
+        results_per_layer = []
+        for layer in range(model.cfg.n_layers):
+            name = utils.get_act_name(component_name, layer)
+            orig_activation = orig_activations[name].detach()
+            new_activation = get_new_activations(new_cache, name, orig_activation)
+            grad = t.zeros_like(orig_activation) if grads[name] is None else grads[name]
+            # The masked attention scores are -inf in both runs (and have zero gradient), so we treat their diff as zero
+            # rather than letting -inf - -inf = nan (or inf * 0 = nan, for zero ablation) poison the sum
+            diff = new_activation - orig_activation
+            diff = t.where(t.isfinite(diff), diff, t.zeros_like(diff))
+            attribution = get_attribution_per_node(diff * grad, component_name)
+            if component_name in ["pattern", "attn_scores"]:
+                assert patching_nodes.seq_pos is None, "Can't patch attention patterns/scores at specific sequence positions (ambiguous whether this is query or key positions)."
+                results_per_layer.append(attribution.sum(0))
+            else:
+                results_per_layer.append(sum_over_seq_pos(attribution, patching_nodes.seq_pos))
+        results[component_name] = stack_over_layers(results_per_layer, patching_nodes.seq_pos)
+        if verbose: print(f"results[{component_name!r}].shape = {tuple(results[component_name].shape)}")
+
+    return results
+
+
+def get_receiver_input_name(model: HookedTransformer, receiver_node: Node) -> str:
+    '''
+    Returns the name of the residual stream activation which is the input to this receiver, i.e. the thing which a sender's
+    output is added to (for q/k/v this is resid_pre, for MLP neurons it's resid_mid, or resid_pre if attn & MLP are in parallel).
+    '''
+    if receiver_node.component_name in ["q", "k", "v"]:
+        return utils.get_act_name("resid_pre", receiver_node.layer)
+    elif receiver_node.component_name == "pre":
+        return utils.get_act_name("resid_pre" if model.cfg.parallel_attn_mlp else "resid_mid", receiver_node.layer)
+    return receiver_node.activation_name
+
+
+def get_receiver_mask(receiver_node: Node, activation: Float[Tensor, "batch ..."]) -> Float[Tensor, "..."]:
+    '''Returns a mask which is 1 on the head / neuron of this receiver node (or everywhere, if neither is specified).'''
+    mask = t.zeros_like(activation)
+    idx = [slice(None) for _ in range(activation.ndim)]
+    if receiver_node.head is not None: idx[2] = receiver_node.head
+    if receiver_node.neuron is not None: idx[-1] = receiver_node.neuron
+    mask[idx] = 1.0
+    return mask
+
+
+def get_receiver_resid_grad(
+    model: HookedTransformer,
+    receiver_node: Node,
+    orig_activations: Dict[str, Float[Tensor, "..."]],
+    grads: Dict[str, Float[Tensor, "..."]],
+) -> Float[Tensor, "batch pos d_model"]:
+    '''
+    Returns the gradient of the metric w.r.t. this receiver's residual stream input, but only via the receiver itself (e.g. for
+    a q receiver, only via the query of that head). So the dot product of this with a sender's output is the linear estimate
+    of the effect of patching the direct path from sender -> receiver.
+    '''
+    grad = grads[receiver_node.activation_name] * get_receiver_mask(receiver_node, orig_activations[receiver_node.activation_name])
+    if receiver_node.component_name in ["q", "k", "v", "pre"]:
+        grad, = t.autograd.grad(
+            orig_activations[receiver_node.activation_name],
+            orig_activations[get_receiver_input_name(model, receiver_node)],
+            grad_outputs=grad,
+            retain_graph=True,
+        )
+    elif receiver_node.component_name in ["q_input", "k_input", "v_input"]:
+        grad = grad.sum(2)
+    return grad
+
+
+def get_receiver_attribution(
+    model: HookedTransformer,
+    receiver_node: Node,
+    sender_diff: Float[Tensor, "batch pos d_model"],
+    orig_activations: Dict[str, Float[Tensor, "..."]],
+    grads: Dict[str, Float[Tensor, "..."]],
+) -> Float[Tensor, "batch pos ..."]:
+    '''
+    Returns the linear estimate of the effect of adding `sender_diff` to this receiver's input, separately for every head / neuron
+    of the receiver (so the output has the same shape as `get_attribution_per_node`).
+
+    For q/k/v/pre, we need the Jacobian-vector product J @ sender_diff (where J is the Jacobian of the receiver w.r.t. its input).
+    We get this with the double-backward trick: if v(u) = J^T u, then grad_u (v(u) . sender_diff) = J @ sender_diff.
+    '''
+    component_name = receiver_node.component_name
+    grad = grads[receiver_node.activation_name]
+    if component_name in ["q", "k", "v", "pre"]:
+        activation = orig_activations[receiver_node.activation_name]
+        u = t.zeros_like(activation, requires_grad=True)
+        vjp, = t.autograd.grad(activation, orig_activations[get_receiver_input_name(model, receiver_node)], grad_outputs=u, create_graph=True)
+        jvp, = t.autograd.grad(vjp, u, grad_outputs=sender_diff)
+        return get_attribution_per_node(jvp * grad, component_name)
+    elif component_name in ["q_input", "k_input", "v_input"]:
+        return (sender_diff.unsqueeze(2) * grad).sum((-2, -1))
+    return (sender_diff * grad).sum(-1)
+
+
+def path_patch_attribution(
+    model: HookedTransformer,
+    orig_input: Union[str, List[str], Int[Tensor, "batch seq_len"]],
+    new_input: Optional[Union[str, List[str], Int[Tensor, "batch seq_len"]]] = None,
+    sender_nodes: Union[IterNode, Node, List[Node]] = [],
+    receiver_nodes: Union[IterNode, Node, List[Node]] = [],
+    patching_metric: Union[Callable, Literal["loss"]] = "loss",
+    new_cache: Optional[Union[ActivationCache, ActivationStats, Literal["zero", "mean"]]] = None,
+    seq_pos: SeqPos = None,
+    verbose: bool = False,
+) -> Union[Float[Tensor, ""], Dict[str, Float[Tensor, "..."]]]:
+    '''
+    Linear approximation to `path_patch` with direct_includes_mlps=False (i.e. the direct path from sender -> receiver is just
+    the residual stream). The effect of patching the path from each sender to each receiver is estimated as:
+
+        (new_sender_output - orig_sender_output) . grad(metric w.r.t. receiver input, via that receiver only)
+
+    summed over batch & sequence positions, and over all (sender, receiver) pairs where sender comes before receiver.
+
+    All of this takes one forward & backward pass on orig (plus one forward pass on new if new_cache isn't given), plus one extra
+    backward pass through the receiver's input (e.g. LayerNorm and W_Q for a query receiver) per receiver node & layer.
+
+    Same arguments & return shapes as `path_patch` (we can iterate over senders or receivers with an IterNode), except that we
+    return the estimated *change* in the metric, and the metric must return a scalar tensor (not a float).
+    '''
+    # Make sure we aren't iterating over both senders and receivers
+    assert not all([isinstance(receiver_nodes, IterNode), isinstance(sender_nodes, IterNode)]), "Can't iterate over both senders and receivers!"
+
+    assert any([isinstance(new_cache, (ActivationCache, ActivationStats)), new_cache in ["zero", "mean"], new_cache is None]), "Invalid new_cache argument."
+    if isinstance(patching_metric, str): assert patching_metric == "loss", "Attribution patching needs a scalar metric, so 'loss_per_token' isn't supported."
+    assert sender_nodes != [], "You must specify sender nodes."
+    assert receiver_nodes != [], "You must specify receiver nodes."
+    if isinstance(sender_nodes, IterNode) or isinstance(receiver_nodes, IterNode):
+        assert seq_pos is None, "Can't specify seq_pos if you're iterating over nodes. Should use seq_pos='all' or 'each' in the IterNode class."
+
+    # Get lists of all the sender & receiver nodes we need (if iterating, then one node per component & layer)
+    def get_nodes(nodes: Union[IterNode, Node, List[Node]]) -> List[Node]:
+        if isinstance(nodes, IterNode):
+            return [Node(name, layer) for name in nodes.component_names for layer in range(model.cfg.n_layers)]
+        return [nodes] if isinstance(nodes, Node) else nodes
+    all_sender_nodes = [node for sender in get_nodes(sender_nodes) for node in sender.check_sender(model)]
+    all_receiver_nodes = [node for receiver in get_nodes(receiver_nodes) for node in receiver.check_and_split_receiver(model)]
+
+    # Get activations & gradients on orig, and activations on new
+    orig_tokens = orig_input if isinstance(orig_input, Tensor) else model.to_tokens(orig_input)
+    sender_names = sorted(set(node.activation_name for node in all_sender_nodes))
+    receiver_names = sorted(set(node.activation_name for node in all_receiver_nodes))
+    receiver_input_names = sorted(set(get_receiver_input_name(model, node) for node in all_receiver_nodes))
+    names = sorted(set(sender_names + receiver_names + receiver_input_names))
+    metric, orig_activations = get_metric_and_activations_with_grad(model, orig_tokens, patching_metric, names)
+    grads = dict(zip(receiver_names, t.autograd.grad(metric, [orig_activations[name] for name in receiver_names], retain_graph=True, allow_unused=True)))
+    grads = {name: t.zeros_like(orig_activations[name]) if grad is None else grad for name, grad in grads.items()}
+    orig_cache = ActivationCache({name: orig_activations[name].detach() for name in sender_names}, model=model)
+    if new_cache is None:
+        _, new_cache = model.run_with_cache(new_input, return_type=None, names_filter=lambda name: name in sender_names)
+
+    # Case where we don't iterate: sum over all (sender, receiver) pairs
+    if not any([isinstance(receiver_nodes, IterNode), isinstance(sender_nodes, IterNode)]):
+        attribution = 0.0
+        for receiver_node in all_receiver_nodes:
+            receiver_grad = get_receiver_resid_grad(model, receiver_node, orig_activations, grads)
+            for sender_node in all_sender_nodes:
+                if sender_node < receiver_node:
+                    sender_diff = get_sender_diff(model, sender_node, orig_cache, new_cache, slice(None), slice(None))
+                    attribution = attribution + sum_over_seq_pos((sender_diff * receiver_grad).sum(-1), seq_pos)
+        return attribution
+
+    results = {}
+
+    # If we're fixing sender(s), and iterating over receivers:
+    if isinstance(receiver_nodes, IterNode):
+        for component_name in receiver_nodes.component_names:
+            results_per_layer = []
+            for layer in range(model.cfg.n_layers):
+                # Split the receiver if needed (e.g. pattern -> q & k), and sum the attribution over the split receivers
+                attribution = 0.0
+                for receiver_node in Node(component_name, layer).check_and_split_receiver(model):
+                    sender_diffs = [
+                        get_sender_diff(model, sender_node, orig_cache, new_cache, slice(None), slice(None))
+                        for sender_node in all_sender_nodes if sender_node < receiver_node
+                    ]
+                    if len(sender_diffs) == 0:
+                        attribution = attribution + get_attribution_per_node(t.zeros_like(grads[receiver_node.activation_name]), receiver_node.component_name)
+                    else:
+                        attribution = attribution + get_receiver_attribution(model, receiver_node, sum(sender_diffs), orig_activations, grads)
+                results_per_layer.append(sum_over_seq_pos(attribution, receiver_nodes.seq_pos))
+            results[component_name] = stack_over_layers(results_per_layer, receiver_nodes.seq_pos)
+
+    # If we're fixing receiver(s), and iterating over senders:
+    elif isinstance(sender_nodes, IterNode):
+        receiver_grads = [(node, get_receiver_resid_grad(model, node, orig_activations, grads)) for node in all_receiver_nodes]
+        for component_name in sender_nodes.component_names:
+            results_per_layer = []
+            for layer in range(model.cfg.n_layers):
+                sender_node = Node(component_name, layer)
+                orig_activation = orig_cache[sender_node.activation_name]
+                diff = get_new_activations(new_cache, sender_node.activation_name, orig_activation) - orig_activation
+                receiver_grad = sum(grad for receiver_node, grad in receiver_grads if sender_node < receiver_node)
+                if not isinstance(receiver_grad, Tensor):
+                    receiver_grad = t.zeros(*diff.shape[:2], model.cfg.d_model, device=diff.device)
+                # Get the attribution separately for each head / neuron, by mapping through W_O / W_out
+                if component_name == "z":
+                    attribution = einops.einsum(diff, model.W_O[layer], receiver_grad, "batch pos n_heads d_head, n_heads d_head d_model, batch pos d_model -> batch pos n_heads")
+                elif component_name == "post":
+                    attribution = einops.einsum(diff, model.W_out[layer], receiver_grad, "batch pos d_mlp, d_mlp d_model, batch pos d_model -> batch pos d_mlp")
+                else:
+                    attribution = (diff * receiver_grad).sum(-1)
+                results_per_layer.append(sum_over_seq_pos(attribution, sender_nodes.seq_pos))
+            results[component_name] = stack_over_layers(results_per_layer, sender_nodes.seq_pos)
+
+    for node_name, result in results.items():
+        if verbose: print(f"results[{node_name!r}].shape = {tuple(result.shape)}")
+    return {node_name: result.detach() for node_name, result in results.items()}
@@ -1,8 +1,312 @@
-from typing import Any, Callable, Dict, List, Optional
+from typing import Any, Callable, Dict, List, Optional, Tuple, Union
+from collections import OrderedDict
 from dataclasses import dataclass, field
+import torch as t
 from transformer_lens import HookedTransformer
+from transformer_lens.past_key_value_caching import HookedTransformerKeyValueCache, HookedTransformerKeyValueCacheEntry
 from tqdm import tqdm 
 
+from utils.model_backend import ModelBackend
+from utils.output_cache import OutputCache, get_model_id, get_output_cache, has_hooks
+
+
+def tokenize_prompts(model: HookedTransformer, prompts: List[str]) -> List[List[int]]:
+    # Same tokens as `model.to_tokens(prompt)` for each prompt, but in a single tokenizer call (and without padding)
+    prepend_bos, tokenizer_prepends_bos = model.cfg.default_prepend_bos, model.cfg.tokenizer_prepends_bos
+    if prepend_bos and not tokenizer_prepends_bos:
+        # We want a BOS token but the tokenizer doesn't add one, so we add it manually
+        prompts = [model.tokenizer.bos_token + prompt for prompt in prompts]
+    token_lists = model.tokenizer(prompts)["input_ids"]
+    if not prepend_bos and tokenizer_prepends_bos:
+        # We don't want a BOS token but the tokenizer adds one, so we remove it
+        token_lists = [tokens[1:] for tokens in token_lists]
+    return token_lists
+
+
+def left_pad(token_lists: List[List[int]], pad_token_id: int, device=None) -> Tuple[t.Tensor, t.Tensor]:
+    # Returns the left-padded tokens and the attention mask (so the last position is the last prompt token in every row)
+    max_len = max(len(tokens) for tokens in token_lists)
+    tokens = t.full((len(token_lists), max_len), pad_token_id, dtype=t.long)
+    attention_mask = t.zeros((len(token_lists), max_len), dtype=t.long)
+    for i, row in enumerate(token_lists):
+        tokens[i, max_len - len(row):] = t.tensor(row, dtype=t.long)
+        attention_mask[i, max_len - len(row):] = 1
+    return tokens.to(device), attention_mask.to(device)
+
+
+def schedule_batches(
+    token_lists: List[List[int]],
+    max_tokens: int = 30,
+    batch_size: Optional[int] = 32,
+    max_batch_tokens: Optional[int] = None,
+    bucket_width: int = 8,
+) -> List[List[int]]:
+    '''
+    Splits prompts into batches for `generate_greedy_batched`, returning a list of batches of indices into `token_lists`.
+
+    Prompts are grouped into buckets of similar length (`bucket_width` tokens wide), so each batch is padded as little as
+    possible. Within a bucket we sort the prompts by their tokens, so prompts with a shared prefix (e.g. the same wrap & prompt
+    template) end up next to each other in the same batch. A batch is closed once it has `batch_size` prompts, or once its
+    padded size (n prompts * (longest prompt + max_tokens)) would go over `max_batch_tokens`.
+    '''
+    order = sorted(range(len(token_lists)), key=lambda i: (len(token_lists[i]) // bucket_width, token_lists[i]))
+
+    batches, batch, batch_len = [], [], 0
+    for i in order:
+        seq_len = max(batch_len, len(token_lists[i]) + max_tokens)
+        batch_full = (batch_size is not None) and (len(batch) == batch_size)
+        over_budget = (max_batch_tokens is not None) and ((len(batch) + 1) * seq_len > max_batch_tokens)
+        if len(batch) > 0 and (batch_full or over_budget):
+            batches.append(batch)
+            batch, seq_len = [], len(token_lists[i]) + max_tokens
+        batch.append(i)
+        batch_len = seq_len
+    if len(batch) > 0:
+        batches.append(batch)
+    return batches
+
+
+def get_common_prefix_len(token_lists: List[List[int]]) -> int:
+    prefix_len = min(len(tokens) for tokens in token_lists)
+    for tokens in token_lists[1:]:
+        prefix_len = next((j for j in range(prefix_len) if tokens[j] != token_lists[0][j]), prefix_len)
+    return prefix_len
+
+
+class PrefixCache:
+    '''
+    KV cache for prompt prefixes which are shared by lots of prompts, e.g. the wrap's header ("<|system|> You are a helpful
+    assistant." or "Pretend you are a Python interpreter.\nTASK:") and the fixed text of the prompt before the list.
+
+    `fork(prefix, batch_size)` returns a KV cache for a batch of prompts which all start with `prefix`, so that only the rest
+    of each prompt has to be run through the model. Each prefix is run through the model once (with batch size 1), and
+    stored frozen. A new prefix which extends a stored one only runs the extra tokens. We keep the `max_entries` most recently
+    used prefixes.
+
+    Note, running the prefix and the rest of the prompt separately gives the same result as running the whole prompt, up to
+    floating point error.
+    '''
+    def __init__(self, model: HookedTransformer, max_entries: int = 16, min_prefix_len: int = 4):
+        self.model = model
+        self.max_entries = max_entries
+        self.min_prefix_len = min_prefix_len
+        self.entries = OrderedDict()
+
+    def get(self, prefix: List[int]) -> HookedTransformerKeyValueCache:
+        '''Returns the (frozen, batch size 1) KV cache for `prefix`, computing it if it isn't stored yet.'''
+        prefix = tuple(prefix)
+        if prefix not in self.entries:
+            # Start from the longest stored prefix of this prefix (if there is one), and run the rest of the tokens
+            base = max((key for key in self.entries if key == prefix[:len(key)]), key=len, default=())
+            cache = self.expand(self.entries[base], 1) if len(base) > 0 else HookedTransformerKeyValueCache.init_cache(self.model.cfg, self.model.cfg.device, 1)
+            new_tokens = t.tensor([prefix[len(base):]], dtype=t.long, device=self.model.cfg.device)
+            self.model(new_tokens, attention_mask=t.ones_like(new_tokens), past_kv_cache=cache, return_type=None)
+            cache.freeze()
+            self.entries[prefix] = cache
+            if len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+        self.entries.move_to_end(prefix)
+        return self.entries[prefix]
+
+    @staticmethod
+    def expand(cache: HookedTransformerKeyValueCache, batch_size: int) -> HookedTransformerKeyValueCache:
+        # New (unfrozen) cache with the same contents for every row. We don't copy the tensors, which is fine because the
+        # cache entries are only ever replaced (never modified in place) when the model appends to them
+        return HookedTransformerKeyValueCache(
+            entries=[
+                HookedTransformerKeyValueCacheEntry(
+                    past_keys=entry.past_keys.expand(batch_size, *entry.past_keys.shape[1:]),
+                    past_values=entry.past_values.expand(batch_size, *entry.past_values.shape[1:]),
+                )
+                for entry in cache.entries
+            ],
+            previous_attention_mask=cache.previous_attention_mask.expand(batch_size, -1),
+        )
+
+    def fork(self, prefix: List[int], batch_size: int) -> HookedTransformerKeyValueCache:
+        return self.expand(self.get(prefix), batch_size)
+
+
+def generate_greedy(model: HookedTransformer, prompt: str, max_tokens: int = 30) -> str:
+    tokens = model.to_tokens(prompt)
+    generated = model.generate(
+        tokens,
+        max_new_tokens=max_tokens,
+        temperature=0.0,
+        top_k=0,
+    )
+    return model.tokenizer.decode(generated[0]).strip()
+
+
+@t.inference_mode()
+def generate_greedy_batched(
+    model: HookedTransformer,
+    prompts: List[str],
+    max_tokens: int = 30,
+    stop_sequences: Optional[List[str]] = None,
+    stop_at_eos: bool = True,
+    token_lists: Optional[List[List[int]]] = None,
+    prefix_cache: Optional[PrefixCache] = None,
+) -> List[str]:
+    '''
+    Greedy generation for a batch of prompts at once. The prompts are left-padded, we prefill them in one forward pass, and
+    then generate one token at a time using the KV cache. Each row stops when it generates EOS or one of `stop_sequences`,
+    and finished rows are dropped from the batch (and the cache), so they don't cost anything for the remaining steps.
+
+    Returns the decoded prompt + generated tokens for each prompt, i.e. the same as `PromptCase.run_model` gives for each
+    prompt on its own. If the prompts have already been tokenized (with `tokenize_prompts`), pass them as `token_lists`.
+
+    If `prefix_cache` is given, the prefix which all the prompts in the batch have in common comes from the prefix cache,
+    and we only prefill the rest of each prompt (the padding then goes in between the prefix and the rest of the prompt).
+    '''
+    eos_token_id = model.tokenizer.eos_token_id
+    pad_token_id = model.tokenizer.pad_token_id if model.tokenizer.pad_token_id is not None else eos_token_id
+    if token_lists is None:
+        token_lists = tokenize_prompts(model, prompts)
+
+    # (we always leave at least one token per prompt to prefill, since we need its logits)
+    prefix_len = get_common_prefix_len(token_lists) if prefix_cache is not None else 0
+    prefix_len = min(prefix_len, min(len(tokens) for tokens in token_lists) - 1)
+    if prefix_len >= (prefix_cache.min_prefix_len if prefix_cache is not None else 1):
+        cache = prefix_cache.fork(token_lists[0][:prefix_len], len(prompts))
+    else:
+        prefix_len = 0
+        cache = HookedTransformerKeyValueCache.init_cache(model.cfg, model.cfg.device, len(prompts))
+    tokens, attention_mask = left_pad([tokens[prefix_len:] for tokens in token_lists], pad_token_id, device=model.cfg.device)
+    logits = model(tokens, attention_mask=attention_mask, past_kv_cache=cache)
+
+    generated = [[] for _ in prompts]
+    active = t.arange(len(prompts))
+    for step in range(max_tokens):
+        next_tokens = logits[:, -1].argmax(-1)
+        finished = t.zeros(len(active), dtype=t.bool)
+        for j, (i, token) in enumerate(zip(active.tolist(), next_tokens.tolist())):
+            generated[i].append(token)
+            if stop_at_eos and token == eos_token_id:
+                finished[j] = True
+            elif stop_sequences and any(stop in model.tokenizer.decode(generated[i]) for stop in stop_sequences):
+                finished[j] = True
+
+        if finished.all() or step == max_tokens - 1:
+            break
+
+        # Drop finished rows from the batch & the cache
+        if finished.any():
+            keep = (~finished).nonzero().squeeze(-1)
+            active, next_tokens = active[keep], next_tokens[keep.to(next_tokens.device)]
+            for entry in cache.entries:
+                entry.past_keys = entry.past_keys[keep.to(entry.past_keys.device)]
+                entry.past_values = entry.past_values[keep.to(entry.past_values.device)]
+            cache.previous_attention_mask = cache.previous_attention_mask[keep.to(cache.previous_attention_mask.device)]
+
+        logits = model(
+            next_tokens.unsqueeze(-1),
+            attention_mask=t.ones((len(active), 1), dtype=t.long, device=model.cfg.device),
+            past_kv_cache=cache,
+        )
+
+    return [model.tokenizer.decode(prompt_tokens + new_tokens).strip() for prompt_tokens, new_tokens in zip(token_lists, generated)]
+
+
+@t.inference_mode()
+def score_answers_batched(
+    model: HookedTransformer,
+    prompts: List[str],
+    answers: List[str],
+) -> List[Dict]:
+    '''
+    Teacher-forced scoring: runs one forward pass over each `prompt + answer`, and returns how well the model predicts the
+    answer tokens, i.e. for each prompt a dict with:
+
+        answer_logprobs   - log-prob of each answer token
+        answer_logprob    - total log-prob of the answer
+        greedy_agreement  - fraction of answer tokens which are the model's top prediction
+        first_divergence  - index (in the answer tokens) of the first token which isn't the top prediction, or None
+        greedy_match      - whether every answer token is the top prediction (i.e. greedy generation would produce the answer)
+
+    We tokenize the prompt and the answer together, so tokens which are merged across the boundary are counted as part of
+    the answer. If that leaves no answer tokens (e.g. for an empty answer) there's nothing to score, so greedy_match is False.
+    '''
+    eos_token_id = model.tokenizer.eos_token_id
+    pad_token_id = model.tokenizer.pad_token_id if model.tokenizer.pad_token_id is not None else eos_token_id
+    prompt_token_lists = tokenize_prompts(model, prompts)
+    token_lists = tokenize_prompts(model, [prompt + answer for prompt, answer in zip(prompts, answers)])
+    # (the first answer token is wherever the tokens stop matching the prompt on its own, and we always leave at least one
+    # token before it)
+    answer_starts = [max(1, get_common_prefix_len([p_tokens, tokens])) for p_tokens, tokens in zip(prompt_token_lists, token_lists)]
+
+    # Right-padded, so we don't have to worry about positions
+    max_len = max(len(tokens) for tokens in token_lists)
+    tokens = t.tensor([row + [pad_token_id] * (max_len - len(row)) for row in token_lists], dtype=t.long, device=model.cfg.device)
+    attention_mask = t.tensor([[1] * len(row) + [0] * (max_len - len(row)) for row in token_lists], dtype=t.long, device=model.cfg.device)
+    logits = model(tokens, attention_mask=attention_mask)
+
+    # Only take the log-softmax at the positions which predict answer tokens (rather than over the whole batch & vocab)
+    rows = t.tensor([i for i, (start, row) in enumerate(zip(answer_starts, token_lists)) for _ in range(start, len(row))], dtype=t.long)
+    positions = t.tensor([pos for start, row in zip(answer_starts, token_lists) for pos in range(start, len(row))], dtype=t.long)
+    answer_logits = logits[rows.to(logits.device), positions.to(logits.device) - 1].float()
+    targets = tokens[rows.to(tokens.device), positions.to(tokens.device)].to(logits.device)
+    logprobs = answer_logits.log_softmax(-1).gather(-1, targets.unsqueeze(-1)).squeeze(-1).tolist()
+    correct = (answer_logits.argmax(-1) == targets).tolist()
+
+    results = []
+    i = 0
+    for start, row in zip(answer_starts, token_lists):
+        n_answer_tokens = len(row) - start
+        row_logprobs, row_correct = logprobs[i: i + n_answer_tokens], correct[i: i + n_answer_tokens]
+        i += n_answer_tokens
+        results.append({
+            "answer_logprobs": row_logprobs,
+            "answer_logprob": sum(row_logprobs),
+            "greedy_agreement": sum(row_correct) / max(1, n_answer_tokens),
+            "first_divergence": next((j for j, c in enumerate(row_correct) if not c), None),
+            "greedy_match": n_answer_tokens > 0 and all(row_correct),
+        })
+    return results
+
+
+def generate_outputs(
+    model: Union[HookedTransformer, ModelBackend],
+    prompts: List[str],
+    max_tokens: int = 30,
+    batch_size: Optional[int] = 32,
+    stop_sequences: Optional[List[str]] = None,
+    max_batch_tokens: Optional[int] = None,
+    share_prefixes: bool = True,
+) -> List[str]:
+    '''
+    Returns the greedy output for each prompt, in the same order as the prompts.
+
+    For a `ModelBackend`, the backend takes care of batching / concurrency itself. For a `HookedTransformer`, if batch_size
+    is None we run each prompt separately with `model.generate`, otherwise we use batched greedy generation, with the
+    prompts grouped into batches of similar length by `schedule_batches`. If share_prefixes, the prefix which is common to
+    each batch is only run through the model once (see `PrefixCache`).
+    '''
+    if isinstance(model, ModelBackend):
+        return model.generate(prompts, max_tokens=max_tokens, stop_sequences=stop_sequences)
+
+    if batch_size is None:
+        assert stop_sequences is None, "Stop sequences are only supported for batched generation."
+        return [generate_greedy(model, prompt, max_tokens=max_tokens) for prompt in tqdm(prompts, desc="Evaluating prompt cases")]
+
+    outputs = [None for _ in prompts]
+    token_lists = tokenize_prompts(model, prompts)
+    batches = schedule_batches(token_lists, max_tokens=max_tokens, batch_size=batch_size, max_batch_tokens=max_batch_tokens)
+    prefix_cache = PrefixCache(model) if share_prefixes else None
+    for batch in tqdm(batches, desc="Evaluating prompt cases"):
+        batch_outputs = generate_greedy_batched(
+            model,
+            [prompts[i] for i in batch],
+            max_tokens=max_tokens,
+            stop_sequences=stop_sequences,
+            token_lists=[token_lists[i] for i in batch],
+            prefix_cache=prefix_cache,
+        )
+        for i, output in zip(batch, batch_outputs):
+            outputs[i] = output
+    return outputs
+
+
 @dataclass
 class PromptCase:
     task_id: str
@@ -19,15 +323,20 @@ class PromptCase:
         core = self.prompt_fn(self.inputs)
         return self.wrap_fn(core, self.inputs) if self.wrap_fn else core
 
-    def run_model(self, model: HookedTransformer, max_tokens: int = 30) -> Dict:
-        tokens = model.to_tokens(self.prompt)
-        generated = model.generate(
-            tokens,
-            max_new_tokens=max_tokens,
-            temperature=0.0,
-            top_k=0,
-        )
-        decoded = model.tokenizer.decode(generated[0]).strip()
+    def run_model(self, model: HookedTransformer, max_tokens: int = 30, output_cache: Optional[Union[str, OutputCache]] = None) -> Dict:
+        output_cache = get_output_cache(output_cache)
+        # (hooks can change the outputs, so we don't cache the outputs of a hooked model)
+        if output_cache is None or has_hooks(model):
+            return self.record_output(generate_greedy(model, self.prompt, max_tokens=max_tokens))
+
+        key = output_cache.get_key(get_model_id(model), self.prompt, max_tokens=max_tokens, stop_sequences=None)
+        outputs = output_cache.get_many([key])
+        if key not in outputs:
+            outputs[key] = generate_greedy(model, self.prompt, max_tokens=max_tokens)
+            output_cache.put_many(outputs)
+        return self.record_output(outputs[key])
+
+    def record_output(self, decoded: str) -> Dict:
         self.generated_output = decoded
 
         self.evaluation_result = {
@@ -36,6 +345,10 @@ class PromptCase:
             "output": decoded,
         }
         return self.evaluation_result
+
+    def record_scores(self, scores: Dict) -> Dict:
+        self.evaluation_result.update(scores)
+        return self.evaluation_result
     
     def copy(self, **overrides) -> "PromptCase":
         return PromptCase(
@@ -62,9 +375,11 @@ class Prompt:
         inputs: Optional[List[Any]] = None,
         task_id: Optional[str] = None,
         metadata: Optional[Dict] = None,
+        ground_truth: Optional[Any] = None,
     ) -> PromptCase:
         inputs = inputs or self.random_inputs()
-        ground_truth = self.transform_fn(inputs) if self.transform_fn else inputs
+        if ground_truth is None:
+            ground_truth = self.transform_fn(inputs) if self.transform_fn else inputs
         task_id = task_id or f"{self.name}-{self.case_counter}"
         self.case_counter += 1
 
@@ -112,10 +427,9 @@ class PromptFamily:
 
         for p_name in prompt_names:
             for w_name in wrap_names:
-                prompt = self.prompts[p_name]
                 wrap_fn = self.wraps[w_name]
 
-                cases = prompt.create_cases(n)
+                cases = self.create_cases(p_name, n)
                 for case in cases:
                     case.wrap_fn = wrap_fn
                     case.metadata["wrap_name"] = w_name
@@ -125,17 +439,81 @@ class PromptFamily:
 
     def generate_all(self, n: int) -> List[PromptCase]:
         return self.generate(prompt_name="all", wrap_name="all", n=n)
+
+    def create_cases(self, prompt_name: str, n: int) -> List[PromptCase]:
+        # Families can override this to generate all n cases at once
+        return self.prompts[prompt_name].create_cases(n)
     
-    def evaluate_all(self, model: HookedTransformer, max_tokens: int = 30, eval_type = "substring_match") -> List[Dict]:
-        results = []
+    def run_cases(
+        self,
+        model: Union[HookedTransformer, ModelBackend],
+        max_tokens: int = 30,
+        batch_size: Optional[int] = 32,
+        stop_sequences: Optional[List[str]] = None,
+        max_batch_tokens: Optional[int] = None,
+        share_prefixes: bool = True,
+        output_cache: Optional[Union[str, OutputCache]] = None,
+    ) -> None:
+        # Runs the model on every case, and writes the results into the cases (see `generate_outputs`). Identical prompts
+        # are only run once, and if output_cache is given, we only run the prompts which aren't in the cache yet (unless the
+        # model has hooks attached, since they can change the outputs)
+        output_cache = get_output_cache(output_cache) if not has_hooks(model) else None
+        prompts = [case.prompt for case in self.cases]
+        unique_prompts = list(dict.fromkeys(prompts))
+
+        outputs = {}
+        if output_cache is not None:
+            model_id = get_model_id(model)
+            keys = {prompt: output_cache.get_key(model_id, prompt, max_tokens=max_tokens, stop_sequences=stop_sequences) for prompt in unique_prompts}
+            cached_outputs = output_cache.get_many(list(keys.values()))
+            outputs = {prompt: cached_outputs[key] for prompt, key in keys.items() if key in cached_outputs}
+
+        todo = [prompt for prompt in unique_prompts if prompt not in outputs]
+        if len(todo) > 0:
+            new_outputs = generate_outputs(
+                model,
+                todo,
+                max_tokens=max_tokens,
+                batch_size=batch_size,
+                stop_sequences=stop_sequences,
+                max_batch_tokens=max_batch_tokens,
+                share_prefixes=share_prefixes,
+            )
+            outputs.update(zip(todo, new_outputs))
+            if output_cache is not None:
+                output_cache.put_many({keys[prompt]: output for prompt, output in zip(todo, new_outputs)})
+
+        for case, prompt in zip(self.cases, prompts):
+            case.record_output(outputs[prompt])
+
+    def evaluate_all(
+        self,
+        model: Union[HookedTransformer, ModelBackend],
+        max_tokens: int = 30,
+        eval_type = "substring_match",
+        batch_size: Optional[int] = 32,
+        stop_sequences: Optional[List[str]] = None,
+        max_batch_tokens: Optional[int] = None,
+        share_prefixes: bool = True,
+        output_cache: Optional[Union[str, OutputCache]] = None,
+    ) -> List[Dict]:
+        self.run_cases(
+            model,
+            max_tokens=max_tokens,
+            batch_size=batch_size,
+            stop_sequences=stop_sequences,
+            max_batch_tokens=max_batch_tokens,
+            share_prefixes=share_prefixes,
+            output_cache=output_cache,
+        )
 
-        for case in tqdm(self.cases, desc="Evaluating prompt cases"):
-            result = case.run_model(model, max_tokens=max_tokens)
+        results = []
+        for case in self.cases:
             results.append({
                 "task_id": case.task_id,
                 "prompt": case.prompt,
                 "ground_truth": case.ground_truth,
-                **result
+                **case.evaluation_result
             })
 
         results.sort(key=lambda r: not r[eval_type])
@@ -154,6 +532,39 @@ class PromptFamily:
         return results
 
     
+    def score_all(
+        self,
+        model: HookedTransformer,
+        batch_size: Optional[int] = 32,
+        max_batch_tokens: Optional[int] = None,
+        answer_prefix: str = "",
+    ) -> List[Dict]:
+        # Cheap alternative to `evaluate_all`: rather than generating, we score `prompt + answer_prefix + str(ground_truth)`
+        # in one forward pass per batch (see `score_answers_batched`). The scores are also added to each case's
+        # evaluation_result. Results are in the same order as the cases
+        if len(self.cases) == 0:
+            return []
+        prompts = [case.prompt for case in self.cases]
+        answers = [answer_prefix + str(case.ground_truth) for case in self.cases]
+        token_lists = tokenize_prompts(model, [prompt + answer for prompt, answer in zip(prompts, answers)])
+        batches = schedule_batches(token_lists, max_tokens=0, batch_size=batch_size, max_batch_tokens=max_batch_tokens)
+
+        scores = [None for _ in self.cases]
+        for batch in tqdm(batches, desc="Scoring prompt cases"):
+            batch_scores = score_answers_batched(model, [prompts[i] for i in batch], [answers[i] for i in batch])
+            for i, score in zip(batch, batch_scores):
+                scores[i] = score
+                self.cases[i].record_scores(score)
+
+        results = [
+            {"task_id": case.task_id, "prompt": case.prompt, "ground_truth": case.ground_truth, **score}
+            for case, score in zip(self.cases, scores)
+        ]
+        n_matches = sum(r["greedy_match"] for r in results)
+        mean_logprob = sum(r["answer_logprob"] for r in results) / len(results)
+        print(f"\nScoring Summary: {n_matches}/{len(results)} greedy matches ({(n_matches/len(results))*100:.1f}%), mean answer log-prob {mean_logprob:.3f}")
+        return results
+    
     def random_inputs(self, **kwargs) -> List[Any]:
         raise NotImplementedError("Implement random input generation for your family.")
 
@@ -0,0 +1,253 @@
+# %%
+
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+from typing import Optional, Union, Dict, Callable, List, Tuple
+from typing_extensions import Literal
+import torch as t
+import torch.multiprocessing as mp
+from torch import Tensor
+from jaxtyping import Float, Int
+from transformer_lens import HookedTransformer, ActivationCache
+from tqdm.auto import tqdm
+
+from utils.path_patching import (
+    Node,
+    IterNode,
+    ActivationStats,
+    get_activation_names,
+    get_path_patching_names,
+    _act_patch_single,
+    _act_patch_batched,
+    _path_patch_single,
+    _path_patch_batched,
+)
+
+# %%
+
+# Each worker process loads the model once (in `_init_worker`) and keeps it here, along with the shared caches
+_worker_state = {}
+
+
+def _share_cache(cache: Union[ActivationCache, ActivationStats, str, None]):
+    '''
+    Converts a cache into something we can send to the workers cheaply: tensors are moved into shared memory, so every worker
+    reads the same copy rather than getting its own.
+    '''
+    if isinstance(cache, ActivationCache):
+        return {name: activation.cpu().share_memory_() for name, activation in cache.items()}
+    return cache
+
+
+def _init_worker(model_factory: Callable[[], HookedTransformer], shared_caches: Dict, n_threads: int):
+    t.set_num_threads(n_threads)
+    model = model_factory()
+    _worker_state["model"] = model
+    _worker_state["caches"] = {
+        key: ActivationCache(cache, model=model) if isinstance(cache, dict) else cache
+        for key, cache in shared_caches.items()
+    }
+
+
+def _run_shard(
+    mode: Literal["act_patch", "path_patch"],
+    shard: List[Tuple[str, int, Optional[Tensor], Node]],
+    kwargs: Dict,
+    chunk_size: Optional[int],
+) -> List[Tuple[str, int, Float[Tensor, "..."]]]:
+    '''
+    Runs one shard of the sweep in a worker process. Each element of the shard is (node_name, index, seq_pos, node), and we
+    return (node_name, index, result) so the results can be put back in the right place.
+    '''
+    model = _worker_state["model"]
+    caches = _worker_state["caches"]
+    if mode == "act_patch":
+        kwargs = dict(kwargs, model=model, new_cache=caches["new_cache"])
+    else:
+        kwargs = dict(kwargs, model=model, orig_cache=caches["orig_cache"], new_cache=caches["new_cache"])
+    fixed_nodes = kwargs.pop("fixed_nodes", None)
+    iterating_over = kwargs.pop("iterating_over", None)
+
+    results = []
+    chunk_size = chunk_size or 1
+    for i in range(0, len(shard), chunk_size):
+        chunk = shard[i: i + chunk_size]
+        if mode == "act_patch":
+            if len(chunk) == 1:
+                (_, _, seq_pos, node), = chunk
+                node.seq_pos = seq_pos
+                chunk_results = [_act_patch_single(patching_nodes=node, **kwargs)]
+            else:
+                chunk_results = _act_patch_batched(patching_nodes=[(seq_pos, node) for (_, _, seq_pos, node) in chunk], **kwargs)
+        else:
+            nodes = [node for (_, _, _, node) in chunk]
+            senders, receivers = ([fixed_nodes] * len(chunk), nodes) if iterating_over == "receivers" else (nodes, [fixed_nodes] * len(chunk))
+            if len(chunk) == 1:
+                chunk_results = [_path_patch_single(sender=senders[0], receiver=receivers[0], seq_pos=chunk[0][2], **kwargs)]
+            else:
+                chunk_results = _path_patch_batched(senders=senders, receivers=receivers, seq_pos=[seq_pos for (_, _, seq_pos, _) in chunk], **kwargs)
+        # (tensors have to be detached before they can be sent back to the main process)
+        results.extend(
+            (node_name, index, result.detach() if isinstance(result, Tensor) else result)
+            for (node_name, index, _, _), result in zip(chunk, chunk_results)
+        )
+    return results
+
+
+def run_sharded_sweep(
+    mode: Literal["act_patch", "path_patch"],
+    model_factory: Callable[[], HookedTransformer],
+    nodes_dict: Dict[str, List[Tuple[Tensor, Node]]],
+    shared_caches: Dict,
+    kwargs: Dict,
+    n_workers: Optional[int] = None,
+    n_shards: Optional[int] = None,
+    chunk_size: Optional[int] = None,
+    max_retries: int = 2,
+    verbose: bool = False,
+) -> Dict[str, List]:
+    '''
+    Splits all the nodes in `nodes_dict` (the output of `IterNode.get_node_dict`) into shards, and runs them in a pool of
+    `n_workers` processes. Returns a dict of {node_name: list of results}, in the same order as `nodes_dict`.
+
+    If a worker crashes, the pool breaks and all unfinished shards fail. When that happens we start a new pool and retry
+    those shards, up to `max_retries` times each.
+    '''
+    n_workers = n_workers or os.cpu_count()
+    n_threads = max(1, t.get_num_threads() // n_workers)
+    items = [(node_name, index, seq_pos, node) for node_name, node_list in nodes_dict.items() for index, (seq_pos, node) in enumerate(node_list)]
+    n_shards = n_shards or 4 * n_workers
+    shard_size = max(1, -(-len(items) // n_shards))
+    shards = [items[i: i + shard_size] for i in range(0, len(items), shard_size)]
+
+    results_dict = {node_name: [None for _ in node_list] for node_name, node_list in nodes_dict.items()}
+    pending = dict(enumerate(shards))
+    attempts = {shard_id: 0 for shard_id in pending}
+    progress_bar = tqdm(total=len(items), disable=not verbose)
+
+    while len(pending) > 0:
+        # Spawn (rather than fork), so that each worker can safely load the model and use torch threads
+        with ProcessPoolExecutor(n_workers, mp_context=mp.get_context("spawn"), initializer=_init_worker, initargs=(model_factory, shared_caches, n_threads)) as executor:
+            futures = {executor.submit(_run_shard, mode, shard, kwargs, chunk_size): shard_id for shard_id, shard in pending.items()}
+            for future in as_completed(futures):
+                shard_id = futures[future]
+                try:
+                    shard_results = future.result()
+                except BrokenProcessPool as e:
+                    attempts[shard_id] += 1
+                    if attempts[shard_id] > max_retries:
+                        raise RuntimeError(f"Shard {shard_id} failed {attempts[shard_id]} times, giving up.") from e
+                    continue
+                for node_name, index, result in shard_results:
+                    results_dict[node_name][index] = result
+                progress_bar.update(len(shard_results))
+                del pending[shard_id]
+    progress_bar.close()
+
+    return results_dict
+
+
+def format_sweep_results(results_dict: Dict[str, List], iter_node: IterNode) -> Dict[str, Float[Tensor, "..."]]:
+    '''Same output format as `act_patch` and `path_patch` (tensors with the IterNode's shape, if the metric returns floats).'''
+    return {
+        node_name: t.tensor(results).reshape(list(iter_node.shape_values[node_name].values())) if isinstance(results[0], float) else results
+        for node_name, results in results_dict.items()
+    }
+
+
+def act_patch_sweep(
+    model_factory: Callable[[], HookedTransformer],
+    orig_input: Union[List[str], Int[Tensor, "batch seq_len"]],
+    patching_nodes: IterNode,
+    patching_metric: Union[Callable, Literal["loss", "loss_per_token"]],
+    new_input: Optional[Union[List[str], Int[Tensor, "batch seq_len"]]] = None,
+    new_cache: Optional[Union[ActivationCache, ActivationStats, Literal["zero", "mean"]]] = None,
+    model: Optional[HookedTransformer] = None,
+    n_workers: Optional[int] = None,
+    n_shards: Optional[int] = None,
+    chunk_size: Optional[int] = None,
+    max_retries: int = 2,
+    verbose: bool = False,
+) -> Dict[str, Float[Tensor, "..."]]:
+    '''
+    Same as `act_patch` with an `IterNode`, but the nodes are split into shards which are run in parallel, in a pool of
+    `n_workers` processes (by default, one per CPU core). This is useful on CPU-only machines, where a single process doesn't
+    make use of all the cores.
+
+    model_factory:
+        A function which returns the model. Each worker calls this once, so it must be picklable (i.e. defined at the top level
+        of a module, not a lambda or a function defined in a notebook cell). The patching metric must be picklable too.
+
+    model:
+        If given, we use this in the main process to compute the new cache (otherwise we call `model_factory`). The caches are
+        put in shared memory, so every worker reads the same copy.
+
+    chunk_size:
+        Within each shard, we patch up to `chunk_size` nodes at once (same as in `act_patch`).
+    '''
+    model = model or model_factory()
+    orig_tokens = orig_input if isinstance(orig_input, Tensor) else model.to_tokens(orig_input)
+    if new_cache is None:
+        names = get_activation_names(model, patching_nodes)
+        _, new_cache = model.run_with_cache(new_input, return_type=None, names_filter=lambda name: name in names)
+
+    results_dict = run_sharded_sweep(
+        "act_patch", model_factory,
+        nodes_dict=patching_nodes.get_node_dict(model, orig_tokens),
+        shared_caches={"new_cache": _share_cache(new_cache)},
+        kwargs=dict(orig_input=orig_tokens, patching_metric=patching_metric),
+        n_workers=n_workers, n_shards=n_shards, chunk_size=chunk_size, max_retries=max_retries, verbose=verbose,
+    )
+    return format_sweep_results(results_dict, patching_nodes)
+
+
+def path_patch_sweep(
+    model_factory: Callable[[], HookedTransformer],
+    orig_input: Union[List[str], Int[Tensor, "batch seq_len"]],
+    new_input: Optional[Union[List[str], Int[Tensor, "batch seq_len"]]] = None,
+    sender_nodes: Union[IterNode, Node, List[Node]] = [],
+    receiver_nodes: Union[IterNode, Node, List[Node]] = [],
+    patching_metric: Union[Callable, Literal["loss", "loss_per_token"]] = "loss",
+    orig_cache: Optional[ActivationCache] = None,
+    new_cache: Optional[Union[ActivationCache, ActivationStats, Literal["zero", "mean"]]] = None,
+    direct_includes_mlps: bool = True,
+    model: Optional[HookedTransformer] = None,
+    n_workers: Optional[int] = None,
+    n_shards: Optional[int] = None,
+    chunk_size: Optional[int] = None,
+    max_retries: int = 2,
+    verbose: bool = False,
+) -> Dict[str, Float[Tensor, "..."]]:
+    '''
+    Same as `path_patch` when iterating over senders or receivers, but the nodes are split into shards which are run in
+    parallel in a pool of processes. See `act_patch_sweep` for the arguments which are specific to this.
+    '''
+    assert isinstance(sender_nodes, IterNode) != isinstance(receiver_nodes, IterNode), "Must iterate over exactly one of senders and receivers."
+    iter_node = receiver_nodes if isinstance(receiver_nodes, IterNode) else sender_nodes
+
+    model = model or model_factory()
+    orig_tokens = orig_input if isinstance(orig_input, Tensor) else model.to_tokens(orig_input)
+    orig_names, new_names = get_path_patching_names(model, sender_nodes, receiver_nodes, direct_includes_mlps)
+    if orig_cache is None:
+        _, orig_cache = model.run_with_cache(orig_tokens, return_type=None, names_filter=lambda name: name in orig_names)
+    if new_cache is None:
+        _, new_cache = model.run_with_cache(new_input, return_type=None, names_filter=lambda name: name in new_names)
+    elif isinstance(new_cache, str) and new_cache == "mean":
+        # Same as in `path_patch`: mean of the orig activations, with batch size 1
+        new_cache = ActivationCache({name: orig_cache[name].mean(0, keepdim=True) for name in new_names}, model=model)
+
+    results_dict = run_sharded_sweep(
+        "path_patch", model_factory,
+        nodes_dict=iter_node.get_node_dict(model, orig_tokens),
+        shared_caches={"orig_cache": _share_cache(orig_cache), "new_cache": _share_cache(new_cache)},
+        kwargs=dict(
+            orig_input=orig_tokens,
+            patching_metric=patching_metric,
+            direct_includes_mlps=direct_includes_mlps,
+            fixed_nodes=sender_nodes if iter_node is receiver_nodes else receiver_nodes,
+            iterating_over="receivers" if iter_node is receiver_nodes else "senders",
+        ),
+        n_workers=n_workers, n_shards=n_shards, chunk_size=chunk_size, max_retries=max_retries, verbose=verbose,
+    )
+    return format_sweep_results(results_dict, iter_node)